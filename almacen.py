@@ -0,0 +1,104 @@
+"""Histórico persistente de comprobantes ya parseados, por contribuyente y mes (SQLite). Los informes de cualquier rango
+de meses salen de aquí sin volver a subir ni parsear los XML; cada carga nueva sólo agrega o reemplaza sus documentos."""
+import json
+import os
+import sqlite3
+import threading
+import time
+
+ALMACEN_RUTA = os.environ.get("ALMACEN_RUTA", "almacen.db")
+# Tipos que se guardan en cada libro. Las retenciones recibidas van con las ventas, que es donde se concilian; las
+# liquidaciones de compra con las compras, como en el reporte de la descarga SRI
+TIPOS_LIBRO = {"COMPRAS": ("FC", "LC", "NC"), "VENTAS": ("FC", "NC", "RET")}
+
+def contribuyente_de(d, libro):
+    """(RUC, nombre) del contribuyente dueño del documento: el comprador en compras y en retenciones (sujeto retenido),
+    el emisor en facturas y NC de venta. La liquidación de compra la emite el propio comprador"""
+    if (libro == "VENTAS" and d["TIPO"] != "RET") or d["TIPO"] == "LC": return d.get("RUC", ""), d.get("NOMBRE", "")
+    return d.get("RUC CLIENTE", ""), d.get("CLIENTE", "")
+
+def clave_de(d):
+    """Identidad del comprobante en el histórico: tipo+emisor+número, igual venga del XML suelto (claveAcceso) o de la
+    respuesta SOAP (numeroAutorizacion, que en el esquema antiguo no coincide). La autorización sólo si falta el número"""
+    if d.get("RUC") and d.get("N. FACTURA") and d["N. FACTURA"] != "000-000-000000000": return f"{d['TIPO']}|{d['RUC']}|{d['N. FACTURA']}"
+    return d.get("N AUTORIZACION") or f"{d['TIPO']}|{d.get('RUC', '')}|{d.get('N. FACTURA', '')}"
+
+def periodo_de(fecha):
+    """'dd/mm/aaaa' -> 'aaaa-mm'; None si la fecha no tiene ese formato"""
+    partes = str(fecha).split("/")
+    if len(partes) != 3 or not all(p.isdigit() for p in partes) or not 1 <= int(partes[1]) <= 12: return None
+    return f"{partes[2]}-{int(partes[1]):02d}"
+
+class AlmacenDocumentos:
+    """Una fila por comprobante con clave primaria (contribuyente, libro, periodo, clave) en tabla WITHOUT ROWID: cada
+    partición contribuyente/mes queda contigua en disco y un rango de meses se lee con un solo recorrido del índice"""
+    def __init__(self, ruta=ALMACEN_RUTA):
+        self.lock = threading.Lock()
+        self.con = sqlite3.connect(ruta, timeout=30, check_same_thread=False)
+        self.con.execute("PRAGMA journal_mode=WAL")
+        self.con.execute("CREATE TABLE IF NOT EXISTS documentos (contribuyente TEXT NOT NULL, libro TEXT NOT NULL, periodo TEXT NOT NULL, clave TEXT NOT NULL, "
+                         "tipo TEXT NOT NULL, registro TEXT NOT NULL, actualizado REAL NOT NULL, PRIMARY KEY (contribuyente, libro, periodo, clave)) WITHOUT ROWID")
+        self.con.execute("CREATE TABLE IF NOT EXISTS contribuyentes (ruc TEXT PRIMARY KEY, nombre TEXT NOT NULL, actualizado REAL NOT NULL)")
+        self.con.execute("CREATE TABLE IF NOT EXISTS accesos (usuario TEXT NOT NULL, ruc TEXT NOT NULL, PRIMARY KEY (usuario, ruc)) WITHOUT ROWID")
+        self.con.commit()
+        if self.con.execute("PRAGMA user_version").fetchone()[0] < 1: self._migrar_claves()
+
+    def _migrar_claves(self):
+        """Versión 1: las filas guardadas con la autorización como clave pasan a clave_de(); de las que quedan repetidas
+        (el mismo comprobante suelto y en SOAP) se conserva la más reciente"""
+        with self.con:
+            filas = self.con.execute("SELECT contribuyente, libro, periodo, tipo, registro, actualizado FROM documentos ORDER BY actualizado").fetchall()
+            self.con.execute("DELETE FROM documentos")
+            self.con.executemany("INSERT OR REPLACE INTO documentos VALUES (?,?,?,?,?,?,?)",
+                                 [(ruc, libro, periodo, clave_de(json.loads(reg)), tipo, reg, act) for ruc, libro, periodo, tipo, reg, act in filas])
+            self.con.execute("PRAGMA user_version = 1")
+
+    def guardar(self, registros, libro, usuario=None):
+        """Agrega o reemplaza los registros del libro. `usuario` queda con acceso a esos contribuyentes.
+        Devuelve (guardados, omitidos): omitidos son los de otro tipo o sin RUC/fecha válidos"""
+        tipos, ahora = TIPOS_LIBRO[libro], time.time()
+        filas, nombres, omitidos = [], {}, 0
+        for d in registros:
+            ruc, nombre = contribuyente_de(d, libro)
+            periodo = periodo_de(d.get("FECHA", ""))
+            if d["TIPO"] not in tipos or not ruc or not periodo: omitidos += 1; continue
+            filas.append((ruc, libro, periodo, clave_de(d), d["TIPO"], json.dumps(d, ensure_ascii=False, separators=(",", ":")), ahora))
+            if nombre: nombres[ruc] = nombre
+        with self.lock:
+            self.con.executemany("INSERT OR REPLACE INTO documentos VALUES (?,?,?,?,?,?,?)", filas)
+            self.con.executemany("INSERT INTO contribuyentes VALUES (?,?,?) ON CONFLICT(ruc) DO UPDATE SET nombre=excluded.nombre, actualizado=excluded.actualizado",
+                                 [(ruc, nm, ahora) for ruc, nm in nombres.items()])
+            if usuario: self.con.executemany("INSERT OR IGNORE INTO accesos VALUES (?,?)", [(usuario, ruc) for ruc in {f[0] for f in filas}])
+            self.con.commit()
+        return len(filas), omitidos
+
+    def borrar(self, ruc, libro=None, desde=None, hasta=None):
+        """Borra los documentos del contribuyente entre los periodos indicados (ambos incluidos), de un libro o de los dos,
+        p. ej. para volver a cargar un mes corregido. Sin documentos, el contribuyente sale de la lista. Devuelve cuántos"""
+        with self.lock:
+            n = self.con.execute("DELETE FROM documentos WHERE contribuyente = ? AND libro LIKE ? AND periodo BETWEEN ? AND ?",
+                                 (ruc, libro or "%", desde or "0000-00", hasta or "9999-99")).rowcount
+            if not self.con.execute("SELECT EXISTS (SELECT 1 FROM documentos WHERE contribuyente = ?)", (ruc,)).fetchone()[0]:
+                self.con.execute("DELETE FROM contribuyentes WHERE ruc = ?", (ruc,))
+                self.con.execute("DELETE FROM accesos WHERE ruc = ?", (ruc,))
+            self.con.commit()
+        return n
+
+    def contribuyentes(self, usuario=None):
+        """[(ruc, nombre)] con documentos guardados; con `usuario`, sólo a los que tiene acceso"""
+        with self.lock:
+            if usuario is None: filas = self.con.execute("SELECT ruc, nombre FROM contribuyentes ORDER BY nombre").fetchall()
+            else: filas = self.con.execute("SELECT c.ruc, c.nombre FROM contribuyentes c JOIN accesos a ON a.ruc = c.ruc WHERE a.usuario = ? ORDER BY c.nombre", (usuario,)).fetchall()
+        return filas
+
+    def periodos(self, ruc):
+        """[(periodo, libro, documentos)] del contribuyente, en orden"""
+        with self.lock:
+            return self.con.execute("SELECT periodo, libro, COUNT(*) FROM documentos WHERE contribuyente = ? GROUP BY libro, periodo ORDER BY periodo, libro", (ruc,)).fetchall()
+
+    def consultar(self, ruc, libro, desde=None, hasta=None):
+        """Registros del libro entre los periodos 'aaaa-mm' indicados (ambos incluidos), por mes y número de comprobante"""
+        with self.lock:
+            filas = self.con.execute("SELECT registro FROM documentos WHERE contribuyente = ? AND libro = ? AND periodo BETWEEN ? AND ? ORDER BY periodo, clave",
+                                     (ruc, libro, desde or "0000-00", hasta or "9999-99")).fetchall()
+        return [json.loads(r) for r, in filas]
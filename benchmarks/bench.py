@@ -0,0 +1,127 @@
+"""Benchmark de extremo a extremo con documentos sintéticos y el servidor SRI de prueba.
+
+    python benchmarks/bench.py                      # 100, 1000 y 10000 documentos
+    python benchmarks/bench.py -n 100000 --claves 5000 --latencia-ms 80 --tasa-error 0.02 --json resultados.json
+
+Etapas: ingesta+parseo (ZIP -> extraer_flujo), ventas (procesar_ventas_con_retenciones), excel (generar_excel_multiexcel),
+sri (descargar_autorizaciones + parseo contra el servidor local) y pdf (EtapaPDF). La etapa pdf usa el ThrottleAdaptativo
+de producción (ajustable con --pdf-intervalo/--pdf-minimo), que a ~20 peticiones/s mide sobre todo el freno; "pdf sin freno"
+repite la descarga sin intervalo mínimo para ver el costo propio de la etapa. Cada tamaño corre en un proceso aparte
+para que el RSS pico sea el de ese tamaño."""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+AQUI = os.path.dirname(os.path.abspath(__file__))
+RAIZ = os.path.dirname(AQUI)
+sys.path[:0] = [AQUI, RAIZ]
+
+try: import resource
+except ImportError: resource = None # Windows: sin RSS pico
+
+def rss_pico_mb():
+    """RSS pico del proceso y de sus hijos ya terminados (los trabajadores del pool de parseo)"""
+    if resource is None: return None
+    escala = 1 if sys.platform == "darwin" else 1024 # ru_maxrss: bytes en macOS, KB en Linux
+    propio = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * escala
+    hijos = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * escala
+    return round(propio / 2**20, 1), round(hijos / 2**20, 1)
+
+class Etapas:
+    def __init__(self): self.filas = []
+    def medir(self, nombre, docs, fn, *args, **kwargs):
+        t0 = time.perf_counter()
+        res = fn(*args, **kwargs)
+        seg = time.perf_counter() - t0
+        self.filas.append({"etapa": nombre, "docs": docs, "seg": round(seg, 3), "docs_seg": round(docs / seg, 1) if seg else None, "rss_pico_mb": rss_pico_mb()})
+        return res
+
+def correr(n, a):
+    from generador import generar, generar_claves, escribir_zip
+    from servidor_sri import ServidorSRI
+    from motor_xml import extraer_datos_robusto, extraer_flujo, procesar_archivos_entrada
+    import io
+    etapas = Etapas()
+    memoria = {"empresas": {}, "rucs": {}}
+    with tempfile.TemporaryDirectory() as tmp:
+        ruta_zip = os.path.join(tmp, f"bench_{n}.zip")
+        etapas.medir("generar", n, escribir_zip, ruta_zip, generar(n, soap=a.soap, detalles=a.detalles))
+        with open(ruta_zip, "rb") as f:
+            ingesta = procesar_archivos_entrada([f])
+            data, errores = etapas.medir("ingesta+parseo", n, extraer_flujo, ingesta, memoria, total=ingesta.total_estimado)
+        data = [d for d in data if d]
+        with ServidorSRI(a.latencia_ms, a.jitter_ms, a.tasa_error, a.tasa_429, a.tasa_no_autorizado, a.tasa_html, a.detalles) as srv:
+            os.environ["SRI_URL_WS"], os.environ["SRI_URL_PDF"] = srv.url_ws, srv.url_pdf
+            from integracion import procesar_ventas_con_retenciones
+            from reportes import generar_excel_multiexcel
+            from descarga_sri import EtapaPDF, ThrottleAdaptativo, descargar_autorizaciones
+            compras = [d for d in data if d["TIPO"] in ("FC", "NC", "LC")]
+            ventas = etapas.medir("ventas", len(data), procesar_ventas_con_retenciones, data)
+            etapas.medir("excel", len(compras) + len(ventas), generar_excel_multiexcel, compras, ventas, formulas_resumen=a.formulas)
+
+            claves = generar_claves(min(n, a.claves)) if a.claves else []
+            def sri():
+                ok = 0
+                for _, estado, contenido, _ in descargar_autorizaciones(claves, max_hilos=a.hilos, rps=a.rps, timeout=a.timeout):
+                    if estado == "OK" and extraer_datos_robusto(io.BytesIO(contenido), memoria): ok += 1
+                return ok
+            def pdf(throttle):
+                etapa = EtapaPDF(claves, max_hilos=a.hilos_pdf, throttle=throttle)
+                for _ in etapa.recoger(bloquear=True): pass
+                etapa.cerrar()
+                return etapa.ok
+            ok_sri = etapas.medir("sri", len(claves), sri) if claves else 0
+            ok_pdf = etapas.medir("pdf", len(claves), pdf, ThrottleAdaptativo(a.pdf_intervalo, a.pdf_minimo)) if claves and a.pdf else 0
+            if claves and a.pdf: etapas.medir("pdf sin freno", len(claves), pdf, ThrottleAdaptativo(1e-4, 0.0)) # Sigue frenando ante 429
+            servidor = dict(srv.peticiones)
+    from metricas import METRICAS
+    return {"n": n, "errores_parseo": len(errores), "ok_sri": ok_sri, "ok_pdf": ok_pdf, "servidor": servidor, "etapas": etapas.filas, "metricas": METRICAS.instantanea()}
+
+def imprimir(res):
+    print(f"\n== {res['n']} documentos  (errores de parseo: {res['errores_parseo']}, SRI ok: {res['ok_sri']}, PDF ok: {res['ok_pdf']}, peticiones: {res['servidor']})")
+    print(f"{'etapa':<16}{'docs':>8}{'seg':>10}{'docs/seg':>12}{'RSS pico MB (proc, hijos)':>30}")
+    for f in res["etapas"]: print(f"{f['etapa']:<16}{f['docs']:>8}{f['seg']:>10}{str(f['docs_seg']):>12}{str(f['rss_pico_mb']):>30}")
+    print(f"{'total':<16}{'':>8}{round(sum(f['seg'] for f in res['etapas'] if f['etapa'] not in ('generar', 'pdf sin freno')), 3):>10}")
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("-n", type=int, nargs="+", default=[100, 1000, 10000], help="cantidades de documentos")
+    ap.add_argument("--soap", type=float, default=0.3, help="fracción envuelta en SOAP")
+    ap.add_argument("--detalles", type=int, default=3, help="líneas de detalle por documento (tamaño)")
+    ap.add_argument("--formulas", action="store_true", help="resúmenes con fórmulas SUMIFS")
+    ap.add_argument("--claves", type=int, default=1000, help="máximo de claves para las etapas sri/pdf (0 = omitirlas)")
+    ap.add_argument("--sin-pdf", dest="pdf", action="store_false")
+    ap.add_argument("--hilos", type=int, default=8); ap.add_argument("--hilos-pdf", type=int, default=4)
+    ap.add_argument("--rps", type=float, default=200); ap.add_argument("--timeout", type=float, default=10)
+    ap.add_argument("--pdf-intervalo", type=float, default=0.5, help="intervalo inicial del throttle de PDFs (s)")
+    ap.add_argument("--pdf-minimo", type=float, default=0.05, help="intervalo mínimo del throttle de PDFs (s)")
+    ap.add_argument("--latencia-ms", type=float, default=30); ap.add_argument("--jitter-ms", type=float, default=20)
+    ap.add_argument("--tasa-error", type=float, default=0.0); ap.add_argument("--tasa-429", type=float, default=0.0)
+    ap.add_argument("--tasa-no-autorizado", type=float, default=0.0); ap.add_argument("--tasa-html", type=float, default=0.0)
+    ap.add_argument("--json", help="guarda los resultados en este archivo")
+    ap.add_argument("--uno", action="store_true", help=argparse.SUPPRESS) # Proceso hijo: un solo tamaño, JSON por stdout
+    a = ap.parse_args()
+    if a.uno:
+        print(json.dumps(correr(a.n[0], a)))
+        return
+    resultados = []
+    for n in a.n:
+        args = list(sys.argv[1:])
+        if "-n" in args: # Se reemplazan los tamaños por el de este hijo
+            i = args.index("-n"); j = i + 1
+            while j < len(args) and not args[j].startswith("-"): j += 1
+            del args[i:j]
+        salida = subprocess.run([sys.executable, os.path.abspath(__file__), "--uno", "-n", str(n), *args], capture_output=True, text=True)
+        if salida.returncode != 0:
+            print(salida.stderr, file=sys.stderr); sys.exit(salida.returncode)
+        res = json.loads(salida.stdout.strip().splitlines()[-1])
+        imprimir(res); resultados.append(res)
+    if a.json:
+        with open(a.json, "w", encoding="utf-8") as f: json.dump(resultados, f, indent=2)
+
+if __name__ == "__main__":
+    main()
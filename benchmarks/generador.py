@@ -0,0 +1,126 @@
+"""Generador de comprobantes sintéticos del SRI (FC, NC, LC, RET), planos o envueltos en SOAP con el comprobante escapado.
+Todo es determinista a partir del índice del documento, así el servidor de prueba puede reconstruir el XML desde la clave."""
+import html
+import io
+import os
+import random
+import zipfile
+
+CODIGOS_TIPO = {"FC": "01", "LC": "03", "NC": "04", "RET": "07"}
+TIPOS_CODIGO = {v: k for k, v in CODIGOS_TIPO.items()}
+MEZCLA_DEFECTO = {"FC": 0.5, "NC": 0.1, "LC": 0.1, "RET": 0.3}
+RUC_EMPRESA = "1790011223001" # Empresa que compra, vende y recibe las retenciones
+CLIENTES = [f"09{n:08d}001" for n in range(50)]
+PROVEEDORES = [f"17{n:08d}001" for n in range(200)]
+
+def digito_mod11(cadena):
+    """Dígito verificador módulo 11 del SRI (pesos 2..7 desde la derecha)"""
+    suma = sum(int(d) * (2 + i % 6) for i, d in enumerate(reversed(cadena)))
+    dv = 11 - suma % 11
+    return 0 if dv == 11 else 1 if dv == 10 else dv
+
+def clave_acceso(fecha, tipo, ruc, estab, pto, secuencial, ambiente="2", codigo="12345678"):
+    base = f"{fecha.replace('/', '')}{CODIGOS_TIPO[tipo]}{ruc}{ambiente}{estab}{pto}{secuencial:09d}{codigo}1"
+    return base + str(digito_mod11(base))
+
+def _fecha(i, anio):
+    return f"{i % 28 + 1:02d}/{i % 12 + 1:02d}/{anio}"
+
+def _detalles(r, n):
+    return "".join(f"<detalle><codigoPrincipal>P{k:05d}</codigoPrincipal><descripcion>PRODUCTO {k} &amp; SERVICIO</descripcion><cantidad>{r.randint(1, 20)}</cantidad>"
+                   f"<precioUnitario>{r.uniform(1, 80):.2f}</precioUnitario><descuento>0.00</descuento><precioTotalSinImpuesto>{r.uniform(1, 500):.2f}</precioTotalSinImpuesto>"
+                   f"<impuestos><impuesto><codigo>2</codigo><codigoPorcentaje>4</codigoPorcentaje><tarifa>15</tarifa><baseImponible>{r.uniform(1, 500):.2f}</baseImponible>"
+                   f"<valor>{r.uniform(0, 75):.2f}</valor></impuesto></impuestos></detalle>" for k in range(n))
+
+def comprobante(tipo, i, detalles=3, anio=2025):
+    """Devuelve (clave, xml) del documento número i del tipo dado"""
+    r = random.Random(f"{tipo}{i}")
+    fecha = _fecha(i, anio)
+    if tipo == "RET":
+        # La retención la emite el cliente de la factura i y la sustenta esa factura
+        emisor, razon, estab, pto = CLIENTES[i % len(CLIENTES)], f"CLIENTE {i % len(CLIENTES)} S.A.", "003", "001"
+    else: emisor, razon, estab, pto = PROVEEDORES[i % len(PROVEEDORES)], f"PROVEEDOR {i % len(PROVEEDORES)} CIA. LTDA.", "001", "002"
+    clave = clave_acceso(fecha, tipo, emisor, estab, pto, i)
+    info_trib = (f"<infoTributaria><ambiente>2</ambiente><tipoEmision>1</tipoEmision><razonSocial>{razon}</razonSocial><ruc>{emisor}</ruc>"
+                 f"<claveAcceso>{clave}</claveAcceso><codDoc>{CODIGOS_TIPO[tipo]}</codDoc><estab>{estab}</estab><ptoEmi>{pto}</ptoEmi><secuencial>{i:09d}</secuencial></infoTributaria>")
+    if tipo == "RET":
+        items = "".join(f"<impuesto><codigo>{cod}</codigo><codigoRetencion>{'303' if cod == '1' else '3'}</codigoRetencion><baseImponible>{r.uniform(10, 500):.2f}</baseImponible>"
+                        f"<porcentajeRetener>10</porcentajeRetener><valorRetenido>{r.uniform(1, 50):.2f}</valorRetenido><codDocSustento>01</codDocSustento>"
+                        f"<numDocSustento>001002{i:09d}</numDocSustento><fechaEmisionDocSustento>{fecha}</fechaEmisionDocSustento></impuesto>" for cod in ("1", "2"))
+        xml = (f'<?xml version="1.0" encoding="UTF-8"?><comprobanteRetencion id="comprobante" version="1.0.0">{info_trib}<infoCompRetencion><fechaEmision>{fecha}</fechaEmision>'
+               f"<tipoIdentificacionSujetoRetenido>04</tipoIdentificacionSujetoRetenido><razonSocialSujetoRetenido>EMPRESA DE PRUEBA S.A.</razonSocialSujetoRetenido>"
+               f"<identificacionSujetoRetenido>{RUC_EMPRESA}</identificacionSujetoRetenido><periodoFiscal>{fecha[3:]}</periodoFiscal></infoCompRetencion><impuestos>{items}</impuestos></comprobanteRetencion>")
+        return clave, xml
+    raiz, info = {"FC": ("factura", "infoFactura"), "NC": ("notaCredito", "infoNotaCredito"), "LC": ("liquidacionCompra", "infoLiquidacionCompra")}[tipo]
+    base0, base15 = round(r.uniform(0, 300), 2), round(r.uniform(10, 900), 2)
+    iva = round(base15 * 0.15, 2)
+    impuestos = (f"<totalImpuesto><codigo>2</codigo><codigoPorcentaje>0</codigoPorcentaje><baseImponible>{base0:.2f}</baseImponible><valor>0.00</valor></totalImpuesto>"
+                 f"<totalImpuesto><codigo>2</codigo><codigoPorcentaje>4</codigoPorcentaje><baseImponible>{base15:.2f}</baseImponible><valor>{iva:.2f}</valor></totalImpuesto>")
+    total = f"<valorModificado>{base0 + base15 + iva:.2f}</valorModificado>" if tipo == "NC" else f"<propina>0.00</propina><importeTotal>{base0 + base15 + iva:.2f}</importeTotal>"
+    sustento = f"<codDocModificado>01</codDocModificado><numDocModificado>001-002-{i:09d}</numDocModificado>" if tipo == "NC" else ""
+    cliente = CLIENTES[i % len(CLIENTES)] if tipo in ("FC", "NC") else RUC_EMPRESA # La NC k anula parte de la FC k, del mismo cliente
+    xml = (f'<?xml version="1.0" encoding="UTF-8"?><{raiz} id="comprobante" version="1.1.0">{info_trib}<{info}><fechaEmision>{fecha}</fechaEmision>'
+           f"<tipoIdentificacionComprador>04</tipoIdentificacionComprador><razonSocialComprador>COMPRADOR {cliente[-6:]}</razonSocialComprador>"
+           f"<identificacionComprador>{cliente}</identificacionComprador>{sustento}<totalSinImpuestos>{base0 + base15:.2f}</totalSinImpuestos>"
+           f"<totalConImpuestos>{impuestos}</totalConImpuestos>{total}</{info}><detalles>{_detalles(r, detalles)}</detalles></{raiz}>")
+    return clave, xml
+
+def envolver_soap(xml, clave):
+    """Respuesta de AutorizacionComprobantesOffline con el comprobante escapado, tal como la guarda el SRI"""
+    return ('<soap:Envelope xmlns:soap="http://schemas.xmlsoap.org/soap/envelope/"><soap:Body><ns2:autorizacionComprobanteResponse xmlns:ns2="http://ec.gob.sri.ws.autorizacion">'
+            f"<RespuestaAutorizacionComprobante><claveAccesoConsultada>{clave}</claveAccesoConsultada><numeroComprobantes>1</numeroComprobantes><autorizaciones><autorizacion>"
+            f"<estado>AUTORIZADO</estado><numeroAutorizacion>{clave}</numeroAutorizacion><fechaAutorizacion>2025-01-01T10:00:00-05:00</fechaAutorizacion><ambiente>PRODUCCIÓN</ambiente>"
+            f"<comprobante>{html.escape(xml, quote=False)}</comprobante><mensajes/></autorizacion></autorizaciones></RespuestaAutorizacionComprobante>"
+            "</ns2:autorizacionComprobanteResponse></soap:Body></soap:Envelope>")
+
+def comprobante_desde_clave(clave, detalles=3):
+    """Reconstruye el documento a partir de su clave (tipo en posiciones 9-10, índice en el secuencial)"""
+    tipo = TIPOS_CODIGO.get(clave[8:10])
+    if tipo is None or not clave[30:39].isdigit(): return None
+    anio = int(clave[4:8])
+    return comprobante(tipo, int(clave[30:39]), detalles, anio)[1]
+
+def _tipos(n, mezcla, semilla):
+    """(tipo, índice dentro del tipo): la RET k y la NC k se refieren a la FC k, que existe mientras haya más facturas"""
+    r = random.Random(semilla)
+    tipos, pesos = zip(*mezcla.items())
+    contador = dict.fromkeys(tipos, 0)
+    for tipo in r.choices(tipos, weights=pesos, k=n):
+        yield tipo, contador[tipo]
+        contador[tipo] += 1
+
+def generar(n, mezcla=MEZCLA_DEFECTO, soap=0.3, detalles=3, semilla=0):
+    """Genera (nombre, bytes) de n documentos; la fracción `soap` sale envuelta como respuesta del WS"""
+    r = random.Random(semilla + 1)
+    for tipo, i in _tipos(n, mezcla, semilla):
+        clave, xml = comprobante(tipo, i, detalles)
+        if r.random() < soap: xml = envolver_soap(xml, clave)
+        yield f"{tipo}_{clave}.xml", xml.encode("utf-8")
+
+def generar_claves(n, mezcla=MEZCLA_DEFECTO, semilla=0):
+    return [comprobante(tipo, i, 0)[0] for tipo, i in _tipos(n, mezcla, semilla)]
+
+def escribir_zip(destino, documentos):
+    """Empaqueta (nombre, bytes) en un ZIP, en disco o en un BytesIO si destino es None"""
+    salida = destino or io.BytesIO()
+    with zipfile.ZipFile(salida, "w", zipfile.ZIP_DEFLATED) as zf:
+        for nombre, datos in documentos: zf.writestr(nombre, datos)
+    return salida
+
+if __name__ == "__main__":
+    import argparse
+    ap = argparse.ArgumentParser(description="Genera comprobantes sintéticos en un ZIP o en un directorio")
+    ap.add_argument("n", type=int)
+    ap.add_argument("destino", help="ruta .zip o directorio")
+    ap.add_argument("--soap", type=float, default=0.3)
+    ap.add_argument("--detalles", type=int, default=3)
+    ap.add_argument("--semilla", type=int, default=0)
+    ap.add_argument("--claves", action="store_true", help="escribe sólo las claves de acceso en un TXT")
+    a = ap.parse_args()
+    if a.claves:
+        with open(a.destino, "w", encoding="utf-8") as f: f.write("\n".join(generar_claves(a.n, semilla=a.semilla)))
+    elif a.destino.lower().endswith(".zip"): escribir_zip(a.destino, generar(a.n, soap=a.soap, detalles=a.detalles, semilla=a.semilla))
+    else:
+        os.makedirs(a.destino, exist_ok=True)
+        for nombre, datos in generar(a.n, soap=a.soap, detalles=a.detalles, semilla=a.semilla):
+            with open(os.path.join(a.destino, nombre), "wb") as f: f.write(datos)
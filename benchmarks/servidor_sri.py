@@ -0,0 +1,102 @@
+"""Servidor local que imita AutorizacionComprobantesOffline (SOAP) y el endpoint público del RIDE en PDF,
+con latencia y errores inyectables. Se usa apuntando SRI_URL_WS y SRI_URL_PDF a él."""
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+from generador import comprobante_desde_clave, envolver_soap
+
+PDF_MINIMO = b"%PDF-1.4\n1 0 obj<</Type/Catalog/Pages 2 0 R>>endobj 2 0 obj<</Type/Pages/Kids[]/Count 0>>endobj\ntrailer<</Root 1 0 R>>\n%%EOF\n"
+SIN_AUTORIZACION = ('<soap:Envelope xmlns:soap="http://schemas.xmlsoap.org/soap/envelope/"><soap:Body><ns2:autorizacionComprobanteResponse xmlns:ns2="http://ec.gob.sri.ws.autorizacion">'
+                    "<RespuestaAutorizacionComprobante><claveAccesoConsultada>{}</claveAccesoConsultada><numeroComprobantes>0</numeroComprobantes><autorizaciones/>"
+                    "</RespuestaAutorizacionComprobante></ns2:autorizacionComprobanteResponse></soap:Body></soap:Envelope>")
+
+class ServidorSRI:
+    """latencia_ms/jitter_ms por respuesta; tasa_error (500), tasa_429 (con Retry-After), tasa_no_autorizado y
+    tasa_html (el PDF responde HTML, como cuando el SRI se satura). Las tasas son probabilidades por petición"""
+    def __init__(self, latencia_ms=50, jitter_ms=20, tasa_error=0.0, tasa_429=0.0, tasa_no_autorizado=0.0, tasa_html=0.0, detalles=3, semilla=0):
+        self.latencia_ms, self.jitter_ms = latencia_ms, jitter_ms
+        self.tasa_error, self.tasa_429, self.tasa_no_autorizado, self.tasa_html = tasa_error, tasa_429, tasa_no_autorizado, tasa_html
+        self.detalles = detalles
+        self.azar, self.lock = random.Random(semilla), threading.Lock()
+        self.peticiones = {"ws": 0, "pdf": 0, "500": 0, "429": 0}
+        servidor = self
+
+        class Manejador(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1" # keep-alive, como el SRI
+            def log_message(self, *a): pass
+
+            def _responder(self, codigo, cuerpo=b"", tipo="text/xml;charset=UTF-8", extra=None):
+                self.send_response(codigo)
+                self.send_header("Content-Type", tipo); self.send_header("Content-Length", str(len(cuerpo)))
+                for k, v in (extra or {}).items(): self.send_header(k, v)
+                self.end_headers(); self.wfile.write(cuerpo)
+
+            def _fallo_inyectado(self):
+                falla = servidor._sortear()
+                if falla == "500": self._responder(500, b"Internal Server Error", "text/plain"); return True
+                if falla == "429": self._responder(429, b"Too Many Requests", "text/plain", {"Retry-After": "1"}); return True
+                return False
+
+            def do_POST(self):
+                cuerpo = self.rfile.read(int(self.headers.get("Content-Length", 0))).decode("utf-8", "replace")
+                servidor._contar("ws"); servidor._esperar()
+                if self._fallo_inyectado(): return
+                m = re.search(r"<claveAccesoComprobante>(\d{49})</claveAccesoComprobante>", cuerpo)
+                clave = m.group(1) if m else ""
+                xml = comprobante_desde_clave(clave, servidor.detalles) if clave else None
+                if xml is None or servidor._azar() < servidor.tasa_no_autorizado: self._responder(200, SIN_AUTORIZACION.format(clave).encode("utf-8")); return
+                self._responder(200, envolver_soap(xml, clave).encode("utf-8"))
+
+            def do_GET(self):
+                servidor._contar("pdf"); servidor._esperar()
+                if self._fallo_inyectado(): return
+                clave = parse_qs(urlparse(self.path).query).get("claveAcceso", [""])[0]
+                if servidor._azar() < servidor.tasa_html: self._responder(200, b"<html><body>Servicio no disponible</body></html>", "text/html"); return
+                self._responder(200, PDF_MINIMO + clave.encode("ascii", "ignore"), "application/pdf")
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Manejador)
+        self.httpd.daemon_threads = True
+        self.puerto = self.httpd.server_address[1]
+        self.url_ws = f"http://127.0.0.1:{self.puerto}/comprobantes-electronicos-ws/AutorizacionComprobantesOffline"
+        self.url_pdf = f"http://127.0.0.1:{self.puerto}/facturacion-internet/consultas/publico/pdf-comprobante.jsp"
+
+    def _azar(self):
+        with self.lock: return self.azar.random()
+
+    def _sortear(self):
+        x = self._azar()
+        if x < self.tasa_error: self._contar("500"); return "500"
+        if x < self.tasa_error + self.tasa_429: self._contar("429"); return "429"
+        return None
+
+    def _contar(self, clave):
+        with self.lock: self.peticiones[clave] += 1
+
+    def _esperar(self):
+        if self.latencia_ms or self.jitter_ms: time.sleep(max(0.0, self.latencia_ms + self._azar() * self.jitter_ms) / 1000)
+
+    def __enter__(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown(); self.httpd.server_close()
+
+if __name__ == "__main__":
+    import argparse
+    ap = argparse.ArgumentParser(description="Levanta el servidor SRI de prueba hasta Ctrl+C")
+    ap.add_argument("--latencia-ms", type=float, default=50)
+    ap.add_argument("--jitter-ms", type=float, default=20)
+    ap.add_argument("--tasa-error", type=float, default=0.0)
+    ap.add_argument("--tasa-429", type=float, default=0.0)
+    ap.add_argument("--tasa-no-autorizado", type=float, default=0.0)
+    ap.add_argument("--tasa-html", type=float, default=0.0)
+    a = ap.parse_args()
+    with ServidorSRI(a.latencia_ms, a.jitter_ms, a.tasa_error, a.tasa_429, a.tasa_no_autorizado, a.tasa_html) as srv:
+        print(f"SRI_URL_WS={srv.url_ws}\nSRI_URL_PDF={srv.url_pdf}")
+        try:
+            while True: time.sleep(3600)
+        except KeyboardInterrupt: pass
@@ -0,0 +1,127 @@
+import atexit
+import json
+import logging
+import os
+import queue
+import threading
+import time
+import uuid
+import requests
+from metricas import METRICAS
+
+log = logging.getLogger(__name__)
+
+URL_PUENTE = "https://script.google.com/macros/s/AKfycbyk0CWehcUec47HTGMjqsCs0sTKa_9J3ZU_Su7aRxfwmNa76-dremthTuTPf-FswZY/exec"
+BITACORA_SPOOL = os.environ.get("BITACORA_SPOOL", "bitacora_spool.jsonl")
+BITACORA_LOTE = int(os.environ.get("BITACORA_LOTE", "20"))
+BITACORA_REINTENTO = float(os.environ.get("BITACORA_REINTENTO", "60")) # Segundos entre reenvíos del spool
+BITACORA_TIMEOUT = 8
+
+class Bitacora:
+    """Registro de actividad asíncrono: cola en memoria + hilo que envía por lotes al puente de Apps Script.
+    Lo que no se pudo enviar queda en un spool local de sólo-anexar ({"id", "payload"} y luego {"ack": id})
+    que se reenvía más tarde y se vacía cuando todo está confirmado"""
+    def __init__(self, url=URL_PUENTE, ruta_spool=BITACORA_SPOOL, lote=BITACORA_LOTE, reintento=BITACORA_REINTENTO):
+        self.url, self.ruta_spool, self.lote, self.reintento = url, ruta_spool, lote, reintento
+        self.cola = queue.Queue(maxsize=10000)
+        self.lock_spool = threading.Lock()
+        self.sesion = requests.Session()
+        self.proximo_reenvio = 0.0 # El primer ciclo reenvía lo pendiente de ejecuciones anteriores
+        self.hilo = threading.Thread(target=self._trabajar, daemon=True)
+        self.hilo.start()
+        atexit.register(self._volcar_cola)
+
+    def registrar(self, usuario, accion, cantidad=None, sugerencia=None):
+        """No bloquea. Devuelve True cuando el evento quedó encolado; las sugerencias además se escriben al spool antes"""
+        detalle_accion = f"{accion} ({cantidad} XMLs)" if cantidad is not None else accion
+        payload = {"usuario": str(usuario), "accion": str(detalle_accion)}
+        if sugerencia: payload["sugerencia"] = str(sugerencia)
+        evento = {"id": uuid.uuid4().hex, "payload": payload, "en_spool": False}
+        try:
+            if sugerencia: self._al_spool([evento], sincronizar=True)
+            self.cola.put_nowait(evento)
+            return True
+        except queue.Full:
+            return evento["en_spool"] or self._al_spool([evento])
+        except OSError as e:
+            log.error("Bitácora: no se pudo escribir el spool: %s", e)
+            METRICAS.fallo("bitacora_errores_total", type(e).__name__, f"spool: {e}")
+            return False
+
+    def _al_spool(self, eventos, sincronizar=False):
+        lineas = "".join(json.dumps({"id": ev["id"], "payload": ev["payload"]}, ensure_ascii=False) + "\n" for ev in eventos if not ev["en_spool"])
+        if not lineas: return True
+        with self.lock_spool:
+            with open(self.ruta_spool, "a", encoding="utf-8") as f:
+                f.write(lineas)
+                if sincronizar: f.flush(); os.fsync(f.fileno())
+        for ev in eventos: ev["en_spool"] = True
+        return True
+
+    def _confirmar(self, ids):
+        if not ids: return
+        with self.lock_spool:
+            with open(self.ruta_spool, "a", encoding="utf-8") as f:
+                f.write("".join(json.dumps({"ack": i}) + "\n" for i in ids))
+
+    def _enviar(self, payload):
+        try: return self.sesion.post(self.url, json=payload, timeout=BITACORA_TIMEOUT).ok
+        except requests.RequestException: return False
+
+    def _enviar_lote(self, eventos):
+        """Envía en orden; al primer fallo el resto del lote va al spool sin insistir contra un puente caído"""
+        enviados = []
+        for n, ev in enumerate(eventos):
+            if not self._enviar(ev["payload"]):
+                try: self._al_spool(eventos[n:])
+                except OSError as e:
+                    log.error("Bitácora: se pierden %d eventos: %s", len(eventos) - n, e)
+                    METRICAS.fallo("bitacora_errores_total", type(e).__name__, f"{len(eventos) - n} eventos perdidos: {e}")
+                self._confirmar([e["id"] for e in enviados if e["en_spool"]])
+                return False
+            enviados.append(ev)
+        self._confirmar([e["id"] for e in enviados if e["en_spool"]])
+        return True
+
+    def _leer_spool(self):
+        """Eventos del spool aún sin ack, en orden. Se llama con lock_spool tomado"""
+        if not os.path.exists(self.ruta_spool): return []
+        with open(self.ruta_spool, "r", encoding="utf-8") as f: lineas = f.readlines()
+        pendientes, acks = {}, set()
+        for linea in lineas:
+            try: reg = json.loads(linea)
+            except ValueError: continue # Línea truncada por un cierre abrupto
+            if "ack" in reg: acks.add(reg["ack"])
+            else: pendientes[reg["id"]] = reg["payload"]
+        return [{"id": i, "payload": p, "en_spool": True} for i, p in pendientes.items() if i not in acks]
+
+    def _reenviar_spool(self):
+        with self.lock_spool: pendientes = self._leer_spool()
+        if pendientes and not self._enviar_lote(pendientes): return
+        with self.lock_spool: # Todo confirmado: se compacta si nadie anexó mientras tanto
+            if os.path.exists(self.ruta_spool) and not self._leer_spool(): os.remove(self.ruta_spool)
+
+    def _trabajar(self):
+        while True:
+            try: primero = self.cola.get(timeout=5)
+            except queue.Empty: primero = None
+            eventos = [primero] if primero else []
+            while eventos and len(eventos) < self.lote:
+                try: eventos.append(self.cola.get_nowait())
+                except queue.Empty: break
+            ok = self._enviar_lote(eventos) if eventos else True
+            if ok and time.time() >= self.proximo_reenvio:
+                self.proximo_reenvio = time.time() + self.reintento
+                try: self._reenviar_spool()
+                except OSError as e:
+                    log.warning("Bitácora: error al reenviar el spool: %s", e)
+                    METRICAS.fallo("bitacora_errores_total", type(e).__name__, f"reenvío: {e}")
+
+    def _volcar_cola(self):
+        """Al salir del proceso, lo que siga en memoria pasa al spool para el próximo arranque"""
+        eventos = []
+        while True:
+            try: eventos.append(self.cola.get_nowait())
+            except queue.Empty: break
+        try: self._al_spool(eventos, sincronizar=True)
+        except OSError: pass
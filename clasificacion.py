@@ -0,0 +1,85 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+CLASIF_RUTA = os.environ.get("CLASIF_RUTA", "clasificacion.db")
+CLASIF_JSON_INICIAL = "conocimiento_contable.json" # Memoria histórica: se migra la primera vez
+CLASIF_DEFECTO = {"DETALLE": "OTROS", "MEMO": "PROFESIONAL"}
+
+def normalizar_nombre(nombre):
+    return " ".join(str(nombre).upper().split())
+
+def clasificar_proveedor(razon_social, memoria, ruc=""):
+    """Búsqueda O(1): primero por RUC, luego por nombre normalizado. `memoria` es la instantánea {"empresas", "rucs"}"""
+    if ruc:
+        info = memoria.get("rucs", {}).get(ruc)
+        if info: return info
+    return memoria["empresas"].get(normalizar_nombre(razon_social), CLASIF_DEFECTO)
+
+class ClasificadorProveedores:
+    """Catálogo de proveedores en SQLite (indexado por nombre normalizado y RUC) con una instantánea en memoria por proceso"""
+    def __init__(self, ruta=CLASIF_RUTA, json_inicial=CLASIF_JSON_INICIAL):
+        self.lock = threading.Lock()
+        self.con = sqlite3.connect(ruta, timeout=30, check_same_thread=False)
+        self.con.execute("PRAGMA journal_mode=WAL")
+        self.con.execute("CREATE TABLE IF NOT EXISTS proveedores (nombre_norm TEXT PRIMARY KEY, nombre TEXT NOT NULL, ruc TEXT NOT NULL DEFAULT '', detalle TEXT NOT NULL, memo TEXT NOT NULL, actualizado REAL NOT NULL)")
+        self.con.execute("CREATE INDEX IF NOT EXISTS ix_proveedores_ruc ON proveedores (ruc) WHERE ruc <> ''")
+        self.con.commit()
+        self._infos = {} # Una sola instancia por par (DETALLE, MEMO): son pocos y se repiten en miles de proveedores
+        self.memoria = {"empresas": {}, "rucs": {}}
+        self.revision = 0 # Sube con cada instantánea nueva, escriba este proceso u otro
+        vacio = self.con.execute("SELECT NOT EXISTS (SELECT 1 FROM proveedores)").fetchone()[0]
+        if vacio and json_inicial and os.path.exists(json_inicial):
+            with open(json_inicial, "r", encoding="utf-8") as f: empresas = json.load(f).get("empresas", {})
+            self.upsert_lote([(nm, "", v.get("DETALLE", "OTROS"), v.get("MEMO", "PROFESIONAL")) for nm, v in empresas.items()])
+        self._recargar()
+
+    def _info(self, detalle, memo):
+        return self._infos.setdefault((detalle, memo), {"DETALLE": detalle, "MEMO": memo})
+
+    def _recargar(self):
+        empresas, rucs = {}, {}
+        for nm, ruc, det, memo in self.con.execute("SELECT nombre_norm, ruc, detalle, memo FROM proveedores"):
+            info = self._info(det, memo); empresas[nm] = info
+            if ruc: rucs[ruc] = info
+        self.memoria = {"empresas": empresas, "rucs": rucs}
+        self.version = self.con.execute("PRAGMA data_version").fetchone()[0]
+        self.revision += 1
+
+    def sincronizar(self):
+        """Recarga la instantánea sólo si otro proceso escribió en la base (PRAGMA data_version)"""
+        with self.lock:
+            if self.con.execute("PRAGMA data_version").fetchone()[0] != self.version: self._recargar()
+
+    def upsert_lote(self, filas):
+        """filas: iterable de (nombre, ruc, detalle, memo). Inserta o actualiza sólo esas filas"""
+        ahora = time.time()
+        datos = [(normalizar_nombre(nm), str(nm).strip(), str(ruc or "").strip(), str(det).upper(), str(memo).upper(), ahora) for nm, ruc, det, memo in filas]
+        datos = [d for d in datos if d[0]]
+        with self.lock:
+            self.con.executemany("INSERT INTO proveedores (nombre_norm, nombre, ruc, detalle, memo, actualizado) VALUES (?,?,?,?,?,?) "
+                                 "ON CONFLICT (nombre_norm) DO UPDATE SET detalle=excluded.detalle, memo=excluded.memo, "
+                                 "ruc=COALESCE(NULLIF(excluded.ruc, ''), proveedores.ruc), actualizado=excluded.actualizado", datos)
+            self.con.commit()
+            empresas, rucs = dict(self.memoria["empresas"]), dict(self.memoria["rucs"])
+            for nm, _, ruc, det, memo, _ in datos:
+                info = self._info(det, memo); empresas[nm] = info
+                if ruc: rucs[ruc] = info
+            # Se reemplaza la instantánea entera: quien ya la tenga (p. ej. un lote en curso) no la ve cambiar a medias
+            self.memoria = {"empresas": empresas, "rucs": rucs}
+            self.version = self.con.execute("PRAGMA data_version").fetchone()[0]
+            self.revision += 1
+        return len(datos)
+
+    def cargar_excel_maestro(self, df):
+        """Carga vectorizada del Excel maestro (columnas NOMBRE, DETALLE, MEMO y opcional RUC)"""
+        df = df.rename(columns=lambda c: str(c).upper().strip())
+        def col(nombre, defecto):
+            if nombre not in df.columns: return [defecto] * len(df)
+            return df[nombre].fillna(defecto).astype(str).str.strip().replace("", defecto).tolist()
+        rucs = col("RUC", "")
+        if "RUC" in df.columns and df["RUC"].dtype.kind in "fi": # Excel guarda el RUC como número y pierde el cero inicial
+            rucs = df["RUC"].astype("Int64").astype(str).replace("<NA>", "").str.zfill(13).replace("0" * 13, "").tolist()
+        return self.upsert_lote(zip(col("NOMBRE", ""), rucs, col("DETALLE", "OTROS"), col("MEMO", "PROFESIONAL")))
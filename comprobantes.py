@@ -0,0 +1,154 @@
+"""Comprobantes de la sesión en forma compacta. El parseo entrega un dict por documento sin columnas repetidas; la
+sesión los acumula en un DataFrame con los textos que se repiten entre documentos (mes, tipo, emisor, cliente, fecha,
+clasificación) como categorías y los montos en float64. Las columnas duplicadas del formato anterior (TIPO DE
+DOCUMENTO, CONTRIBUYENTE, ruc_recep, numreten...) se arman recién al exportar, con para_exportar()."""
+import hashlib
+import pandas as pd
+from pandas.api.types import union_categoricals
+from clasificacion import clasificar_proveedor
+from motor_xml import IngestaXML
+
+# Columna del formato de exportación -> columna del registro de la que sale
+ALIAS = {"TIPO DE DOCUMENTO": "TIPO", "CONTRIBUYENTE": "RUC CLIENTE",
+         "ruc_recep": "RUC CLIENTE", "nomrecep": "CLIENTE", "fechaemi": "FECHA", "razonsocial": "NOMBRE", "ruc_emisor": "RUC",
+         "numfact": "SUSTENTO", "numreten": "N. FACTURA", "numautori": "N AUTORIZACION"}
+CATEGORICAS = ["TIPO", "MES", "FECHA", "RUC", "NOMBRE", "RUC CLIENTE", "CLIENTE", "DETALLE", "MEMO", "fecautori"]
+_COLUMNAS_CLAVE = ["TIPO", "RUC", "N. FACTURA", "N AUTORIZACION"]
+
+def tabla(registros):
+    """DataFrame compacto a partir de una lista de registros"""
+    df = pd.DataFrame.from_records(registros) if len(registros) else pd.DataFrame(columns=_COLUMNAS_CLAVE)
+    for c in CATEGORICAS:
+        if c in df.columns: df[c] = df[c].astype("category")
+    return df
+
+def unir(a, b):
+    """Concatena dos tablas sin perder las categorías (pd.concat las vuelve texto cuando no coinciden)"""
+    if not len(a): return b
+    if not len(b): return a
+    df = pd.concat([a, b], ignore_index=True)
+    for c in CATEGORICAS:
+        if c in a.columns and c in b.columns: df[c] = union_categoricals([a[c], b[c]])
+        elif c in df.columns: df[c] = df[c].astype("category")
+    return df
+
+def para_exportar(datos, columnas):
+    """DataFrame con `columnas` en ese orden, desde una lista de registros o una tabla: los alias salen de su columna de
+    origen, lo que no existe queda vacío y los textos faltantes van como "" (xlsxwriter no escribe NaN)"""
+    df = datos if isinstance(datos, pd.DataFrame) else pd.DataFrame.from_records(datos)
+    salida = {}
+    for c in columnas:
+        origen = c if c in df.columns else ALIAS.get(c)
+        if origen not in df.columns: salida[c] = ""; continue
+        s = df[origen]
+        salida[c] = s.fillna(0.0) if s.dtype.kind in "fi" else s.astype(object).fillna("")
+    return pd.DataFrame(salida, index=df.index)
+
+# --- PROCESAMIENTO INCREMENTAL ---
+def huella(datos):
+    """Huella de 64 bits como int: en un set ocupa la mitad que el digest en bytes"""
+    return int.from_bytes(hashlib.blake2b(datos, digest_size=8).digest(), "little")
+
+def _huella_archivo(f):
+    h = hashlib.blake2b(digest_size=8)
+    f.seek(0)
+    for bloque in iter(lambda: f.read(1024 * 1024), b""): h.update(bloque)
+    f.seek(0)
+    return int.from_bytes(h.digest(), "little")
+
+def claves_documento(d):
+    """Identidades de un comprobante: autorización/clave de acceso y tipo+emisor+número. Se usan las dos porque en el
+    esquema en línea antiguo la respuesta SOAP trae un numeroAutorizacion distinto de la claveAcceso del XML firmado"""
+    claves = [d["N AUTORIZACION"]] if d.get("N AUTORIZACION") else []
+    if d.get("RUC") and d.get("N. FACTURA") != "000-000-000000000": claves.append((d["TIPO"], d["RUC"], d["N. FACTURA"]))
+    return claves
+
+def _estado_vacio():
+    return {"tabla": tabla([]), "archivos": frozenset(), "contenidos": frozenset(), "revision": None}
+
+class ConjuntoDocumentos:
+    """Documentos acumulados de una sesión, sin repetidos, en una tabla compacta (`registros`). Antes de parsear se
+    descartan los archivos y XML cuyo contenido ya se vio; después, los comprobantes con una autorización ya cargada
+    (el mismo XML suelto y en SOAP), comparando contra las columnas de la tabla en vez de guardar las claves aparte.
+    Uso: ingesta = c.preparar(archivos); resultados, _ = extraer_flujo(ingesta, ...); nuevos = c.agregar(resultados)
+
+    Con `deposito` (sesiones.DepositoSesiones) el estado no queda en el objeto sino en el depósito bajo `clave` =
+    (sesión, nombre): la tabla junto con las huellas ya vistas, para que bajen a disco, vuelvan y venzan juntas. Si el
+    depósito la descarta, la sesión empieza de cero y los mismos archivos se pueden volver a subir"""
+    def __init__(self, deposito=None, clave=None):
+        self._deposito, self._clave = deposito, clave
+        if deposito is None: self._local = _estado_vacio()
+        self.duplicados = [] # (nombre, motivo) de la última carga
+        self._pendientes, self._archivos_pendientes = [], []
+
+    def _estado(self):
+        """{"tabla", "archivos", "contenidos", "revision"}. Nunca se modifica en el sitio: el depósito puede estar escribiéndolo a disco"""
+        if self._deposito is None: return self._local
+        e = self._deposito.obtener(*self._clave)
+        return _estado_vacio() if e is None else e
+
+    def _guardar(self, e):
+        if self._deposito is None: self._local = e
+        else: self._deposito.guardar(*self._clave, e)
+
+    def preparar(self, archivos):
+        self.duplicados, self._pendientes, self._archivos_pendientes = [], [], []
+        e = self._estado()
+        nuevos = []
+        for f in archivos:
+            h = _huella_archivo(f)
+            if h in e["archivos"] or h in self._archivos_pendientes: self.duplicados.append((f.name, "Archivo ya procesado"))
+            else: nuevos.append(f); self._archivos_pendientes.append(h)
+        vistos = set()
+        def omitir(nombre, contenido):
+            h = huella(contenido)
+            if h in e["contenidos"] or h in vistos:
+                self.duplicados.append((nombre, "XML repetido")); return True
+            vistos.add(h); self._pendientes.append((nombre, h))
+            return False
+        return IngestaXML(nuevos, omitir=omitir)
+
+    def reclasificar(self, memoria, revision):
+        """Si el catálogo de proveedores cambió desde la última carga (`revision` de ClasificadorProveedores, p. ej. tras
+        un Excel Maestro nuevo), vuelve a poner DETALLE y MEMO a los comprobantes ya cargados. Así un archivo que ya no
+        se vuelve a parsear por estar procesado igual sale con la clasificación vigente. Devuelve cuántos cambiaron"""
+        e = self._estado()
+        if e["revision"] == revision: return 0
+        t, n = e["tabla"], 0
+        if len(t) and "DETALLE" in t.columns:
+            filas = t["DETALLE"].notna() & ~t["TIPO"].isin(["NC", "RET"]) # Las NC y RET no se clasifican al parsear
+            pares = list(zip(t.loc[filas, "NOMBRE"].astype(object).fillna(""), t.loc[filas, "RUC"].astype(object).fillna("")))
+            infos = {par: clasificar_proveedor(par[0], memoria, par[1]) for par in set(pares)} # Pocos proveedores, muchas filas
+            antes = t.loc[filas, ["DETALLE", "MEMO"]].astype(object)
+            despues = pd.DataFrame([infos[par] for par in pares], index=antes.index, columns=["DETALLE", "MEMO"])
+            n = int((antes != despues).any(axis=1).sum())
+            if n:
+                t = t.copy()
+                for c in ("DETALLE", "MEMO"):
+                    col = t[c].astype(object); col[filas] = despues[c]
+                    t[c] = col.astype("category")
+        self._guardar({**e, "tabla": t, "revision": revision})
+        return n
+
+    @property
+    def registros(self):
+        return self._estado()["tabla"]
+
+    def agregar(self, resultados):
+        """`resultados` alineados con lo que entregó la ingesta de preparar(). Devuelve sólo los registros nuevos (dicts)"""
+        e = self._estado()
+        registros = e["tabla"]
+        cargadas = {c for d in registros[_COLUMNAS_CLAVE].to_dict("records") for c in claves_documento(d)}
+        nuevos = []
+        for (nombre, h), d in zip(self._pendientes, resultados):
+            if not d: continue
+            claves = claves_documento(d)
+            repetida = next((c for c in claves if c in cargadas), None)
+            if repetida: self.duplicados.append((nombre, f"Comprobante repetido: {repetida if isinstance(repetida, str) else ' '.join(repetida)}")); continue
+            cargadas.update(claves); nuevos.append(d)
+        # Las huellas de los ilegibles también: volverían a fallar igual
+        self._guardar({**e, "tabla": unir(registros, tabla(nuevos)) if nuevos else registros,
+                       "archivos": e["archivos"] | frozenset(self._archivos_pendientes),
+                       "contenidos": e["contenidos"] | frozenset(h for _, h in self._pendientes)})
+        self._pendientes, self._archivos_pendientes = [], []
+        return nuevos
@@ -0,0 +1,344 @@
+import io
+import itertools
+import json
+import os
+import queue
+import random
+import re
+import sqlite3
+import threading
+import time
+import zipfile
+import zlib
+import requests
+import urllib3
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
+from motor_xml import extraer_datos_robusto
+from clasificacion import clasificar_proveedor
+from metricas import METRICAS
+
+urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+
+# URLs y Headers
+URL_WS = os.environ.get("SRI_URL_WS", "https://cel.sri.gob.ec/comprobantes-electronicos-ws/AutorizacionComprobantesOffline?wsdl")
+URL_PDF = os.environ.get("SRI_URL_PDF", "https://srienlinea.sri.gob.ec/facturacion-internet/consultas/publico/pdf-comprobante.jsp")
+HEADERS_WS = {"Content-Type": "text/xml;charset=UTF-8","User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/121.0.0.0 Safari/537.36"}
+# Parámetros del motor de descarga (ajustables por variables de entorno)
+SRI_MAX_HILOS = int(os.environ.get("SRI_MAX_HILOS", "8"))
+SRI_MAX_RPS = float(os.environ.get("SRI_MAX_RPS", "10"))
+SRI_REINTENTOS = int(os.environ.get("SRI_REINTENTOS", "3"))
+SRI_TIMEOUT = float(os.environ.get("SRI_TIMEOUT", "10"))
+PDF_MAX_HILOS = int(os.environ.get("PDF_MAX_HILOS", "4"))
+PDF_REINTENTOS = int(os.environ.get("PDF_REINTENTOS", "3"))
+CACHE_SRI_RUTA = os.environ.get("CACHE_SRI_RUTA", "cache_sri.db")
+CACHE_SRI_MAX_MB = float(os.environ.get("CACHE_SRI_MAX_MB", "500"))
+ZIP_NIVEL_XML = int(os.environ.get("ZIP_NIVEL_XML", "6")) # 0 = XML sin comprimir; 1 el más rápido, 9 el más chico
+
+# --- MOTOR DE DESCARGA XML SRI (CONCURRENTE) ---
+class LimitadorTasa:
+    """Token bucket compartido entre hilos: como máximo `rps` peticiones por segundo"""
+    def __init__(self, rps):
+        self.intervalo = 1.0 / rps if rps and rps > 0 else 0.0
+        self.siguiente = time.monotonic()
+        self.lock = threading.Lock()
+
+    def esperar(self):
+        if not self.intervalo: return
+        with self.lock:
+            ahora = time.monotonic()
+            turno = max(self.siguiente, ahora)
+            self.siguiente = turno + self.intervalo
+        if turno > ahora: time.sleep(turno - ahora)
+
+def crear_sesion_http(max_conexiones=SRI_MAX_HILOS):
+    """Session con conexiones keep-alive reutilizables por todos los hilos"""
+    s = requests.Session()
+    adapter = HTTPAdapter(pool_connections=max_conexiones, pool_maxsize=max_conexiones)
+    s.mount("https://", adapter); s.mount("http://", adapter)
+    s.verify = False
+    return s
+
+RE_ESTADO_WS = re.compile(r"<estado>\s*([^<]*?)\s*</estado>")
+
+def estado_autorizacion(texto):
+    """Estado de una respuesta 200 del WS: "OK" si alguna autorización está AUTORIZADO, "EN_PROCESO" si el SRI todavía la
+    procesa (se reintenta) y "NO_AUTORIZADO" si no hay autorizaciones o están NO AUTORIZADO/RECHAZADA"""
+    estados = RE_ESTADO_WS.findall(texto) if "<autorizaciones>" in texto else []
+    if "AUTORIZADO" in estados: return "OK"
+    if any(e.startswith("EN PROCES") for e in estados): return "EN_PROCESO"
+    return "NO_AUTORIZADO"
+
+def consultar_autorizacion(sesion, clave, limitador=None, reintentos=SRI_REINTENTOS, timeout=SRI_TIMEOUT):
+    """Consulta una clave en el WS del SRI. Devuelve (estado, contenido, intentos)"""
+    soap_body = f'<soapenv:Envelope xmlns:soapenv="http://schemas.xmlsoap.org/soap/envelope/" xmlns:ec="http://ec.gob.sri.ws.autorizacion"><soapenv:Body><ec:autorizacionComprobante><claveAccesoComprobante>{clave}</claveAccesoComprobante></ec:autorizacionComprobante></soapenv:Body></soapenv:Envelope>'
+    estado, contenido, intento = _consultar(sesion, soap_body, limitador, reintentos, timeout)
+    METRICAS.contar("sri_ws_consultas_total", estado=estado)
+    if intento > 1: METRICAS.contar("sri_ws_reintentos_total", intento - 1)
+    if estado != "OK": METRICAS.fallo("sri_ws_fallos_total", estado, clave)
+    return estado, contenido, intento
+
+def _consultar(sesion, soap_body, limitador, reintentos, timeout):
+    estado = "ERROR_RED"
+    for intento in range(1, reintentos + 2):
+        if limitador: limitador.esperar()
+        t0 = time.perf_counter()
+        try:
+            r = sesion.post(URL_WS, data=soap_body, headers=HEADERS_WS, timeout=timeout)
+            METRICAS.observar("sri_ws_segundos", time.perf_counter() - t0, codigo=r.status_code)
+            if r.status_code == 200:
+                estado = estado_autorizacion(r.text)
+                if estado == "OK": return "OK", r.content, intento
+                if estado != "EN_PROCESO": return estado, None, intento
+            else:
+                estado = f"HTTP_{r.status_code}"
+                if r.status_code < 500 and r.status_code != 429: return estado, None, intento
+        except requests.exceptions.Timeout: estado = "TIMEOUT"
+        except requests.exceptions.RequestException: estado = "ERROR_RED"
+        if estado in ("TIMEOUT", "ERROR_RED"): METRICAS.observar("sri_ws_segundos", time.perf_counter() - t0, codigo=estado)
+        if intento <= reintentos: time.sleep(min(0.5 * 2 ** (intento - 1), 8) + random.uniform(0, 0.25))
+    return estado, None, reintentos + 1
+
+def descargar_autorizaciones(claves, max_hilos=SRI_MAX_HILOS, rps=SRI_MAX_RPS, reintentos=SRI_REINTENTOS, timeout=SRI_TIMEOUT):
+    """Descarga concurrente acotada. Genera (clave, estado, contenido, intentos) según van terminando"""
+    limitador = LimitadorTasa(rps)
+    with crear_sesion_http(max_hilos) as sesion, ThreadPoolExecutor(max_workers=max_hilos) as pool:
+        futuros = {pool.submit(consultar_autorizacion, sesion, cl, limitador, reintentos, timeout): cl for cl in claves}
+        for fut in as_completed(futuros):
+            cl = futuros[fut]
+            try: estado, contenido, intentos = fut.result()
+            except Exception as e:
+                estado, contenido, intentos = "ERROR_INTERNO", None, 0
+                METRICAS.fallo("sri_ws_fallos_total", estado, f"{cl}: {e}")
+            yield cl, estado, contenido, intentos
+
+# --- CACHÉ PERSISTENTE DE AUTORIZACIONES ---
+class CacheComprobantes:
+    """Caché en disco (SQLite) de respuestas autorizadas y su registro parseado, por clave de acceso, con tope LRU. Sólo
+    guarda respuestas AUTORIZADO: las que no lo están se vuelven a consultar, el SRI puede autorizarlas después"""
+    def __init__(self, ruta=CACHE_SRI_RUTA, max_mb=CACHE_SRI_MAX_MB):
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.lock = threading.Lock()
+        self.con = sqlite3.connect(ruta, timeout=30, check_same_thread=False)
+        self.con.execute("PRAGMA journal_mode=WAL")
+        self.con.execute("CREATE TABLE IF NOT EXISTS comprobantes (clave TEXT PRIMARY KEY, respuesta BLOB NOT NULL, registro TEXT, tamano INTEGER NOT NULL, ultimo_acceso REAL NOT NULL)")
+        self.con.execute("CREATE INDEX IF NOT EXISTS ix_comprobantes_acceso ON comprobantes (ultimo_acceso)")
+        self.con.commit()
+
+    def obtener_varios(self, claves):
+        """Devuelve {clave: (respuesta, registro)} de las claves presentes y marca su último acceso. Las no autorizadas que
+        guardaron versiones anteriores se borran y cuentan como ausentes"""
+        encontrados, invalidas = {}, []
+        with self.lock:
+            for i in range(0, len(claves), 500):
+                lote = claves[i:i+500]
+                marcas = ",".join("?" * len(lote))
+                for cl, resp, reg in self.con.execute(f"SELECT clave, respuesta, registro FROM comprobantes WHERE clave IN ({marcas})", lote):
+                    resp = zlib.decompress(resp)
+                    if estado_autorizacion(resp.decode("utf-8", "replace")) != "OK": invalidas.append((cl,)); continue
+                    encontrados[cl] = (resp, json.loads(reg) if reg else None)
+            if invalidas:
+                self.con.executemany("DELETE FROM comprobantes WHERE clave=?", invalidas)
+                self.con.commit()
+            if encontrados:
+                self.con.executemany("UPDATE comprobantes SET ultimo_acceso=? WHERE clave=?", [(time.time(), cl) for cl in encontrados])
+                self.con.commit()
+        return encontrados
+
+    def guardar(self, clave, respuesta, registro):
+        """Sólo para respuestas con estado "OK" de consultar_autorizacion"""
+        blob = zlib.compress(respuesta, 6)
+        reg = json.dumps(registro, ensure_ascii=False) if registro else None
+        with self.lock:
+            self.con.execute("INSERT OR REPLACE INTO comprobantes VALUES (?,?,?,?,?)", (clave, blob, reg, len(blob) + len(reg or ""), time.time()))
+            self.con.commit()
+            self._expulsar()
+
+    def _expulsar(self):
+        total = self.con.execute("SELECT COALESCE(SUM(tamano), 0) FROM comprobantes").fetchone()[0]
+        if total <= self.max_bytes: return
+        exceso, borrar = total - self.max_bytes, []
+        for cl, tam in self.con.execute("SELECT clave, tamano FROM comprobantes ORDER BY ultimo_acceso"):
+            borrar.append((cl,)); exceso -= tam
+            if exceso <= 0: break
+        self.con.executemany("DELETE FROM comprobantes WHERE clave=?", borrar)
+        self.con.commit()
+
+# Tipos de documento que entran en cada reporte de descarga SRI
+TIPOS_SRI = {"FC": ("FC", "LC"), "NC": ("NC",), "RET": ("RET",)}
+
+# --- CLAVES DE ACCESO ---
+# 49 dígitos: fecha ddmmaaaa · tipo (2) · RUC emisor (13) · ambiente (1) · estab+pto (6) · secuencial (9) · código (8) · emisión (1) · verificador
+CODIGOS_COMPROBANTE = {"01": "FC", "03": "LC", "04": "NC", "05": "ND", "06": "GR", "07": "RET"}
+AMBIENTE_PRODUCCION = "2" # El WS de producción no autoriza comprobantes de pruebas (ambiente 1)
+RE_NUMERO = re.compile(r"\d+")
+
+def digito_mod11(cadena):
+    """Dígito verificador módulo 11 del SRI (pesos 2..7 desde la derecha)"""
+    suma = sum(int(d) * (2 + i % 6) for i, d in enumerate(reversed(cadena)))
+    dv = 11 - suma % 11
+    return 0 if dv == 11 else 1 if dv == 10 else dv
+
+def decodificar_clave(clave):
+    """(campos, None) si la clave es válida, (None, motivo) si no"""
+    if len(clave) != 49 or not clave.isdigit(): return None, "LONGITUD"
+    if int(clave[48]) != digito_mod11(clave[:48]): return None, "DIGITO_VERIFICADOR"
+    dia, mes = int(clave[0:2]), int(clave[2:4])
+    if not (1 <= dia <= 31 and 1 <= mes <= 12): return None, "FECHA"
+    tipo = CODIGOS_COMPROBANTE.get(clave[8:10])
+    if tipo is None: return None, "TIPO_DESCONOCIDO"
+    if clave[23] != AMBIENTE_PRODUCCION: return None, "AMBIENTE_PRUEBAS" if clave[23] == "1" else "AMBIENTE"
+    return {"FECHA": f"{clave[0:2]}/{clave[2:4]}/{clave[4:8]}", "TIPO": tipo, "RUC": clave[10:23],
+            "N. FACTURA": f"{clave[24:27]}-{clave[27:30]}-{clave[30:39]}"}, None
+
+class LecturaClaves:
+    """Claves de uno o varios TXT del SRI, validadas y filtradas por tipo de reporte antes de pedir nada a la red.
+    Se lee línea por línea: en el reporte de recibidos la clave y el n° de autorización suelen ir en la misma fila"""
+    def __init__(self, tipo=None):
+        self.tipos = TIPOS_SRI[tipo] if tipo else None
+        self.claves, self.vistas = [], set()
+        self.otro_tipo, self.duplicadas = Counter(), Counter()
+        self.invalidas = [] # (origen, línea, texto, motivo)
+
+    def leer(self, lineas, origen=""):
+        for n, linea in enumerate(lineas, 1):
+            en_linea = set()
+            for m in RE_NUMERO.finditer(linea):
+                texto = m.group()
+                if len(texto) != 49:
+                    if 40 <= len(texto) <= 60: self.invalidas.append((origen, n, texto, "LONGITUD")) # Clave cortada o pegada a otro número
+                    continue
+                if texto in en_linea: continue
+                en_linea.add(texto)
+                if texto in self.vistas: self.duplicadas[texto] += 1; continue
+                self.vistas.add(texto)
+                campos, motivo = decodificar_clave(texto)
+                if motivo: self.invalidas.append((origen, n, texto, motivo))
+                elif self.tipos and campos["TIPO"] not in self.tipos: self.otro_tipo[campos["TIPO"]] += 1
+                else: self.claves.append(texto)
+        return self
+
+    def resumen(self):
+        partes = [f"{len(self.claves)} claves a descargar"]
+        if self.otro_tipo: partes.append(f"{sum(self.otro_tipo.values())} de otro tipo (" + ", ".join(f"{t}: {n}" for t, n in self.otro_tipo.most_common()) + ")")
+        if self.invalidas: partes.append(f"{len(self.invalidas)} inválidas")
+        if self.duplicadas: partes.append(f"{sum(self.duplicadas.values())} repetidas")
+        return " · ".join(partes)
+
+def resolver_claves(claves, memoria, cache=None, **opciones_descarga):
+    """Trae cada clave de la caché o del WS y la parsea. Genera (clave, estado, contenido, intentos, registro) según van llegando"""
+    en_cache = cache.obtener_varios(claves) if cache else {}
+    faltantes = [cl for cl in claves if cl not in en_cache]
+    if cache: METRICAS.contar("sri_cache_total", len(en_cache), resultado="acierto"); METRICAS.contar("sri_cache_total", len(faltantes), resultado="fallo")
+    resultados = itertools.chain(((cl, "CACHE", resp, 0) for cl, (resp, _) in en_cache.items()), descargar_autorizaciones(faltantes, **opciones_descarga))
+    for cl, estado, contenido, intentos in resultados:
+        d = None
+        if estado in ("OK", "CACHE"): d = parsear_respuesta(cl, estado, contenido, memoria, cache, en_cache[cl][1] if estado == "CACHE" else None)
+        yield cl, estado, contenido, intentos, d
+
+def parsear_respuesta(clave, estado, contenido, memoria, cache=None, registro=None):
+    """Registro de una respuesta OK/CACHE. Si ya viene `registro` (de la caché) sólo se reclasifica el proveedor"""
+    if registro is None:
+        registro = extraer_datos_robusto(io.BytesIO(contenido), memoria)
+        if cache and (estado == "OK" or registro): cache.guardar(clave, contenido, registro)
+    elif registro["TIPO"] in ("FC", "LC"): # La memoria de proveedores pudo cambiar desde que se cacheó
+        info = clasificar_proveedor(registro["NOMBRE"], memoria, registro["RUC"]); registro["DETALLE"], registro["MEMO"] = info["DETALLE"], info["MEMO"]
+    return registro
+
+# --- EMPAQUETADO ZIP ---
+# El RIDE en PDF ya trae sus streams comprimidos: deflate casi no lo achica y cuesta tanto CPU como un XML, así que va
+# tal cual (ZIP_STORED). Los XML son texto repetitivo y se comprimen con el nivel ZIP_NIVEL_XML.
+YA_COMPRIMIDOS = (".pdf", ".zip", ".xlsx", ".png", ".jpg", ".jpeg")
+
+def opciones_zip(nombre):
+    """compress_type/compresslevel para el miembro `nombre` según su contenido (para ZipFile.write/writestr)"""
+    if nombre.lower().endswith(YA_COMPRIMIDOS) or ZIP_NIVEL_XML <= 0: return {"compress_type": zipfile.ZIP_STORED}
+    return {"compress_type": zipfile.ZIP_DEFLATED, "compresslevel": min(ZIP_NIVEL_XML, 9)}
+
+# --- MOTOR DE DESCARGA PDF ---
+def pedir_pdf(sesion, clave_acceso):
+    """Pide el RIDE (PDF) a la URL pública del SRI. Devuelve (estado, contenido, retry_after)"""
+    url_pdf = f"{URL_PDF}?claveAcceso={clave_acceso}"
+    headers_browser = {
+        "User-Agent": "Mozilla/4.0 (compatible; MSIE 7.0; Windows NT 6.2; WOW64; Trident/7.0; .NET4.0C; .NET4.0E; Zoom 3.6.0)",
+        "Accept": "application/pdf,application/xhtml+xml,application/xml",
+        "Referer": "https://srienlinea.sri.gob.ec/comprobantes-electronicos-internet/publico/validezComprobantes.jsf"
+    }
+    t0 = time.perf_counter()
+    try:
+        r = sesion.get(url_pdf, headers=headers_browser, verify=False, timeout=15)
+        METRICAS.observar("sri_pdf_segundos", time.perf_counter() - t0, codigo=r.status_code)
+        if r.status_code == 200 and "application/pdf" in r.headers.get("Content-Type", ""): return "OK", r.content, None
+        if r.status_code in (429, 503):
+            try: retry_after = float(r.headers.get("Retry-After", ""))
+            except ValueError: retry_after = None
+            return "LIMITADO", None, retry_after
+        if r.status_code == 200: return "NO_PDF", None, None # El SRI devuelve HTML cuando está saturado
+        return f"HTTP_{r.status_code}", None, None
+    except requests.exceptions.Timeout: return "TIMEOUT", None, None
+    except requests.exceptions.RequestException: return "ERROR_RED", None, None
+
+def descargar_pdf_publico(clave_acceso):
+    """Descarga el RIDE (PDF) usando la URL pública del SRI simulando navegador"""
+    _, pdf, _ = pedir_pdf(requests, clave_acceso)
+    return pdf
+
+class ThrottleAdaptativo(LimitadorTasa):
+    """Limitador cuyo intervalo crece ante 429/503/no-PDF y se reduce mientras el servidor responde bien"""
+    def __init__(self, intervalo_inicial=0.5, minimo=0.05, maximo=5.0):
+        super().__init__(1.0 / intervalo_inicial)
+        self.minimo, self.maximo = minimo, maximo
+
+    def exito(self):
+        with self.lock: self.intervalo = max(self.minimo, self.intervalo * 0.75)
+
+    def penalizar(self, espera=None):
+        with self.lock:
+            self.intervalo = min(self.maximo, self.intervalo * 2)
+            self.siguiente = max(self.siguiente, time.monotonic() + (espera or self.intervalo))
+
+def descargar_pdf(sesion, clave, throttle, reintentos=PDF_REINTENTOS):
+    """PDF de una clave con reintentos, frenando el `throttle` compartido si el SRI se satura. Devuelve (pdf o None, intentos)"""
+    pdf, intentos = None, 0
+    for intentos in range(1, reintentos + 2):
+        throttle.esperar()
+        estado, pdf, retry_after = pedir_pdf(sesion, clave)
+        if estado == "OK": throttle.exito(); break
+        if estado in ("LIMITADO", "NO_PDF"): throttle.penalizar(retry_after)
+        elif not (estado in ("TIMEOUT", "ERROR_RED") or estado.startswith("HTTP_5")): break
+    if pdf is None: METRICAS.fallo("sri_pdf_fallos_total", estado, clave)
+    METRICAS.contar("sri_pdf_total", resultado="OK" if pdf else estado)
+    return pdf, intentos
+
+class EtapaPDF:
+    """Etapa de descarga de PDFs que corre en paralelo a la de XML. Los resultados se recogen desde el hilo de la UI.
+    `throttle` permite otro ThrottleAdaptativo (p. ej. el benchmark, para medir sin el freno de producción)"""
+    def __init__(self, claves, max_hilos=PDF_MAX_HILOS, reintentos=PDF_REINTENTOS, throttle=None):
+        self.total, self.recibidos = len(claves), 0
+        self.ok = self.reintentados = self.fallidos = 0
+        self.reintentos = reintentos
+        self.throttle = throttle or ThrottleAdaptativo()
+        self.sesion = crear_sesion_http(max_hilos)
+        self.cola = queue.Queue()
+        self.pool = ThreadPoolExecutor(max_workers=max_hilos)
+        for cl in claves: self.pool.submit(self._trabajo, cl)
+
+    def _trabajo(self, clave):
+        pdf, intentos = None, 0
+        try: pdf, intentos = descargar_pdf(self.sesion, clave, self.throttle, self.reintentos)
+        finally: self.cola.put((clave, pdf, intentos))
+
+    def recoger(self, bloquear=False):
+        """Genera (clave, pdf) de lo que ya terminó; con bloquear=True espera hasta el último"""
+        while self.recibidos < self.total:
+            try: clave, pdf, intentos = self.cola.get(block=bloquear)
+            except queue.Empty: return
+            self.recibidos += 1
+            if intentos > 1: self.reintentados += 1
+            if pdf: self.ok += 1
+            else: self.fallidos += 1
+            yield clave, pdf
+
+    def cerrar(self):
+        self.pool.shutdown(wait=False, cancel_futures=True); self.sesion.close()
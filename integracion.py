@@ -0,0 +1,88 @@
+from operator import itemgetter
+import pandas as pd
+from metricas import METRICAS
+
+# --- LÓGICA DE INTEGRACIÓN ---
+# Conciliación columnar: la factura se identifica por (RUC del cliente, número). La retención la emite ese cliente
+# citando la factura en numDocSustento; la NC la emite la empresa al mismo cliente citándola en numDocModificado.
+CLAVE_FACTURA = ["RUC", "N. FACTURA"]
+TEXTOS_RET = {"FECHA": "FECHA RET", "N. FACTURA": "N° RET", "N AUTORIZACION": "N° AUTORIZACIÓN"}
+SUMAS_RET = {"rt_renta": "RET RENTA", "rt_iva": "RET IVA", "TOTAL RET": "TOTAL RET"}
+COLUMNAS_VENTAS = ["MES", "FECHA", "N. FACTURA", "RUC", "CLIENTE", "DETALLE", "MEMO", "MONTO REEMBOLS", "BASE. 0", "BASE. 12 / 15", "IVA", "TOTAL",
+                   "FECHA RET", "N° RET", "N° AUTORIZACIÓN", "RET RENTA", "RET IVA", "ISD", "TOTAL RET", "N° NC", "VALOR NC"]
+
+def _marco(registros, columnas):
+    """DataFrame sólo con las columnas pedidas ({columna: valor por defecto}). De una lista de dicts es mucho más barato
+    que pd.DataFrame(registros); de una tabla compacta (comprobantes.tabla) las categorías vuelven a ser texto"""
+    if isinstance(registros, pd.DataFrame):
+        plano = lambda s: s.astype(s.cat.categories.dtype) if isinstance(s.dtype, pd.CategoricalDtype) else s
+        return pd.DataFrame({c: plano(registros[c]) if c in registros.columns else v for c, v in columnas.items()}, index=registros.index).reset_index(drop=True)
+    try: filas = list(map(itemgetter(*columnas), registros))
+    except KeyError: filas = [tuple(d.get(c, v) for c, v in columnas.items()) for d in registros]
+    if len(columnas) == 1: filas = [(f,) for f in filas]
+    return pd.DataFrame.from_records(filas, columns=list(columnas), nrows=len(filas))
+
+def _agrupar(df, claves, textos, sumas):
+    """Una fila por clave: suma los montos y une con " | " los textos cuando hay más de un documento.
+    El join en Python sólo se hace sobre los grupos repetidos, que son la minoría"""
+    g = df.groupby(claves, sort=False)
+    res = g[list(sumas)].sum()
+    res[list(textos)] = g[list(textos)].first()
+    n = g.size()
+    repetidos = n.index[n > 1]
+    if len(repetidos):
+        sub = df.set_index(claves)
+        sub = sub[sub.index.isin(repetidos)]
+        res.loc[repetidos, list(textos)] = sub.groupby(level=list(range(len(claves))), sort=False)[list(textos)].agg(" | ".join)
+    res["DOCS"] = n
+    return res.rename(columns={**textos, **sumas}).reset_index()
+
+@METRICAS.cronometrado("etapa_segundos", etapa="conciliacion")
+def conciliar_ventas(lista_datos_crudos):
+    """Devuelve (ventas, retenciones_sin_factura, nc_sin_factura) como DataFrames. `ventas` tiene una fila por FC en el
+    orden de entrada, con todas sus retenciones (pueden ser varias, se suman) y sus NC. Acepta una lista de registros o
+    la tabla compacta de la sesión"""
+    if isinstance(lista_datos_crudos, pd.DataFrame):
+        t = lista_datos_crudos
+        fc, ret, nc = (t[t["TIPO"] == tipo] for tipo in ("FC", "RET", "NC"))
+        con = lambda df, c: df[df[c].fillna("").astype(bool)] if c in df.columns else df.iloc[:0]
+        ret_docs, nc_docs = con(ret, "SUSTENTO"), con(nc, "DOC MODIFICADO")
+        filas = lambda docs, pos: docs.iloc[pos].reset_index(drop=True)
+    else:
+        fc, ret, nc = [], [], []
+        por_tipo = {"FC": fc, "RET": ret, "NC": nc}
+        for d in lista_datos_crudos:
+            destino = por_tipo.get(d["TIPO"])
+            if destino is not None: destino.append(d)
+        ret_docs = [d for d in ret if d.get("SUSTENTO")]
+        nc_docs = [d for d in nc if d.get("DOC MODIFICADO")]
+        filas = lambda docs, pos: pd.DataFrame([docs[i] for i in pos])
+    fc = _marco(fc, {"MES": "", "FECHA": "", "N. FACTURA": "", "RUC CLIENTE": "", "CLIENTE": "", "BASE. 0": 0.0, "BASE. 12 / 15": 0.0, "IVA.": 0.0, "TOTAL": 0.0})
+    ventas = pd.DataFrame({
+        "MES": fc["MES"], "FECHA": fc["FECHA"], "N. FACTURA": fc["N. FACTURA"],
+        "RUC": fc["RUC CLIENTE"], "CLIENTE": fc["CLIENTE"],
+        "DETALLE": "SERVICIOS", "MEMO": "PROFESIONAL", "MONTO REEMBOLS": 0.0,
+        "BASE. 0": fc["BASE. 0"].fillna(0.0), "BASE. 12 / 15": fc["BASE. 12 / 15"].fillna(0.0),
+        "IVA": fc["IVA."].fillna(0.0), "TOTAL": fc["TOTAL"].fillna(0.0)})
+
+    ret = _marco(ret_docs, {"RUC": "", "SUSTENTO": "", **dict.fromkeys(TEXTOS_RET, ""), **dict.fromkeys(SUMAS_RET, 0.0)})
+    ret_agr = _agrupar(pd.DataFrame({"RUC": ret["RUC"], "N. FACTURA": ret["SUSTENTO"], **{v: ret[c].fillna("").astype(str) for c, v in TEXTOS_RET.items()},
+                                     **{c: ret[c].fillna(0.0) for c in SUMAS_RET}}), CLAVE_FACTURA, {v: v for v in TEXTOS_RET.values()}, SUMAS_RET)
+
+    nc = _marco(nc_docs, {"RUC CLIENTE": "", "DOC MODIFICADO": "", "N. FACTURA": "", "TOTAL": 0.0})
+    nc_agr = _agrupar(pd.DataFrame({"RUC": nc["RUC CLIENTE"], "N. FACTURA": nc["DOC MODIFICADO"], "N° NC": nc["N. FACTURA"], "VALOR NC": nc["TOTAL"].fillna(0.0)}),
+                      CLAVE_FACTURA, {"N° NC": "N° NC"}, {"VALOR NC": "VALOR NC"})
+
+    claves_fc = pd.MultiIndex.from_frame(ventas[CLAVE_FACTURA])
+    sueltas = lambda docs, df, cols: filas(docs, (~pd.MultiIndex.from_frame(df[cols]).isin(claves_fc)).nonzero()[0])
+    ret_sin_factura = sueltas(ret_docs, ret, ["RUC", "SUSTENTO"])
+    nc_sin_factura = sueltas(nc_docs, nc, ["RUC CLIENTE", "DOC MODIFICADO"])
+
+    ventas = ventas.merge(ret_agr.drop(columns="DOCS"), on=CLAVE_FACTURA, how="left").merge(nc_agr.drop(columns="DOCS"), on=CLAVE_FACTURA, how="left")
+    ventas = ventas.fillna({**dict.fromkeys(TEXTOS_RET.values(), ""), **dict.fromkeys(SUMAS_RET.values(), 0.0), "N° NC": "", "VALOR NC": 0.0})
+    ventas["ISD"] = 0.0
+    return ventas[COLUMNAS_VENTAS], ret_sin_factura, nc_sin_factura
+
+def procesar_ventas_con_retenciones(lista_datos_crudos):
+    """Hoja VENTAS como DataFrame (ver conciliar_ventas)"""
+    return conciliar_ventas(lista_datos_crudos)[0]
@@ -0,0 +1,155 @@
+"""Instrumentación en proceso: contadores, tiempos por etapa (histogramas) y las últimas fallas, exportables como JSON o
+texto Prometheus. Con METRICAS=0 cada llamada vuelve en la primera línea y `medir` no toma tiempos.
+
+Los trabajadores del pool de parseo tienen su propia instancia; extraer_flujo les pide el delta (volcar) con cada
+bloque y lo suma aquí (fusionar). Con fork la heredan: en el hijo empieza vacía y con un lock nuevo, porque otro hilo
+del servidor podía tenerlo tomado al momento del fork."""
+import contextlib
+import functools
+import os
+import threading
+import time
+from bisect import bisect_left
+from collections import deque
+
+METRICAS_ACTIVAS = os.environ.get("METRICAS", "1") != "0"
+METRICAS_PREFIJO = "rapidito_"
+CUBETAS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300) # Segundos
+_NULO = contextlib.nullcontext()
+
+def _escapar(valor):
+    return str(valor).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _etiquetas(etiquetas):
+    return tuple(sorted((k, str(v)) for k, v in etiquetas.items()))
+
+class _Cronometro:
+    __slots__ = ("metricas", "clave", "t0")
+    def __init__(self, metricas, clave): self.metricas, self.clave = metricas, clave
+    def __enter__(self): self.t0 = time.perf_counter(); return self
+    def __exit__(self, *exc): self.metricas._observar(self.clave, time.perf_counter() - self.t0)
+
+class Serie:
+    """Histograma con las etiquetas ya resueltas, para puntos calientes (una medición por documento)"""
+    __slots__ = ("metricas", "clave")
+    def __init__(self, metricas, nombre, etiquetas): self.metricas, self.clave = metricas, (nombre, _etiquetas(etiquetas))
+    def medir(self): return _Cronometro(self.metricas, self.clave) if self.metricas.activas else _NULO
+    def observar(self, segundos):
+        if self.metricas.activas: self.metricas._observar(self.clave, segundos)
+
+class Metricas:
+    def __init__(self, activas=METRICAS_ACTIVAS, cubetas=CUBETAS, max_fallas=50):
+        self.activas, self.cubetas = activas, cubetas
+        self.lock = threading.Lock()
+        self.contadores, self.histogramas = {}, {} # {(nombre, etiquetas): n} · {(nombre, etiquetas): [cuentas por cubeta, suma, n]}
+        self.fallas = deque(maxlen=max_fallas) # (hora, nombre, motivo, detalle)
+        self.desde = time.time()
+
+    def contar(self, nombre, n=1, **etiquetas):
+        if not self.activas: return
+        clave = (nombre, _etiquetas(etiquetas))
+        with self.lock: self.contadores[clave] = self.contadores.get(clave, 0) + n
+
+    def observar(self, nombre, segundos, **etiquetas):
+        if self.activas: self._observar((nombre, _etiquetas(etiquetas)), segundos)
+
+    def _observar(self, clave, segundos):
+        i = bisect_left(self.cubetas, segundos) # Cubeta "le": la primera con límite >= segundos
+        with self.lock:
+            h = self.histogramas.get(clave)
+            if h is None: h = self.histogramas[clave] = [[0] * (len(self.cubetas) + 1), 0.0, 0]
+            h[0][i] += 1; h[1] += segundos; h[2] += 1
+
+    def medir(self, nombre, **etiquetas):
+        """with METRICAS.medir("etapa_segundos", etapa="excel"): ..."""
+        return _Cronometro(self, (nombre, _etiquetas(etiquetas))) if self.activas else _NULO
+
+    def serie(self, nombre, **etiquetas): return Serie(self, nombre, etiquetas)
+
+    def cronometrado(self, nombre, **etiquetas):
+        """Decorador equivalente a envolver la función en medir(); con las métricas apagadas devuelve la función intacta"""
+        def decorar(fn):
+            if not self.activas: return fn
+            @functools.wraps(fn)
+            def envuelta(*args, **kwargs):
+                with self.medir(nombre, **etiquetas): return fn(*args, **kwargs)
+            return envuelta
+        return decorar
+
+    def fallo(self, nombre, motivo, detalle=""):
+        """Cuenta la falla por motivo y la guarda entre las últimas para el panel"""
+        if not self.activas: return
+        self.contar(nombre, motivo=motivo)
+        with self.lock: self.fallas.append((time.time(), nombre, motivo, str(detalle)[:300]))
+
+    def volcar(self):
+        """Devuelve lo acumulado y lo reinicia (delta de un trabajador)"""
+        with self.lock:
+            delta = {"contadores": self.contadores, "histogramas": self.histogramas, "fallas": list(self.fallas)}
+            self.contadores, self.histogramas = {}, {}; self.fallas.clear()
+        return delta
+
+    def fusionar(self, delta):
+        if not self.activas or not delta: return
+        with self.lock:
+            for clave, n in delta["contadores"].items(): self.contadores[clave] = self.contadores.get(clave, 0) + n
+            for clave, (cuentas, suma, n) in delta["histogramas"].items():
+                h = self.histogramas.get(clave)
+                if h is None: self.histogramas[clave] = [list(cuentas), suma, n]
+                else: h[0] = [a + b for a, b in zip(h[0], cuentas)]; h[1] += suma; h[2] += n
+            self.fallas.extend(delta["fallas"])
+
+    def reiniciar(self):
+        self.volcar(); self.desde = time.time()
+
+    def _tras_fork(self):
+        self.lock = threading.Lock()
+        self.contadores, self.histogramas = {}, {}; self.fallas.clear()
+
+    def _percentil(self, cuentas, n, q):
+        """Límite superior de la cubeta donde cae el percentil q (None si pasa de la última)"""
+        objetivo, acumulado = q * n, 0
+        for limite, c in zip(self.cubetas, cuentas):
+            acumulado += c
+            if acumulado >= objetivo: return limite
+        return None
+
+    def instantanea(self):
+        with self.lock:
+            contadores = sorted(self.contadores.items())
+            histogramas = sorted((k, (list(c), s, n)) for k, (c, s, n) in self.histogramas.items())
+            fallas = list(self.fallas)
+        return {
+            "desde": self.desde, "activas": self.activas,
+            "contadores": [{"nombre": nm, "etiquetas": dict(et), "valor": v} for (nm, et), v in contadores],
+            "histogramas": [{"nombre": nm, "etiquetas": dict(et), "n": n, "suma": round(s, 6), "media": round(s / n, 6) if n else None,
+                             "p50": self._percentil(c, n, 0.5), "p95": self._percentil(c, n, 0.95), "p99": self._percentil(c, n, 0.99),
+                             "cubetas": dict(zip([*map(str, self.cubetas), "+Inf"], c))} for (nm, et), (c, s, n) in histogramas],
+            "fallas": [{"hora": h, "nombre": nm, "motivo": m, "detalle": d} for h, nm, m, d in fallas],
+        }
+
+    def a_prometheus(self):
+        """Formato de exposición de texto de Prometheus (contadores e histogramas acumulados)"""
+        def etiquetas(et, extra=()):
+            pares = [*et, *extra]
+            return "{" + ",".join(f'{k}="{_escapar(v)}"' for k, v in pares) + "}" if pares else ""
+        with self.lock:
+            contadores = sorted(self.contadores.items())
+            histogramas = sorted((k, (list(c), s, n)) for k, (c, s, n) in self.histogramas.items())
+        lineas, tipos = [], set()
+        for (nm, et), v in contadores:
+            nombre = METRICAS_PREFIJO + nm
+            if nombre not in tipos: tipos.add(nombre); lineas.append(f"# TYPE {nombre} counter")
+            lineas.append(f"{nombre}{etiquetas(et)} {v}")
+        for (nm, et), (cuentas, suma, n) in histogramas:
+            nombre = METRICAS_PREFIJO + nm
+            if nombre not in tipos: tipos.add(nombre); lineas.append(f"# TYPE {nombre} histogram")
+            acumulado = 0
+            for limite, c in zip((*map(str, self.cubetas), "+Inf"), cuentas):
+                acumulado += c; lineas.append(f"{nombre}_bucket{etiquetas(et, [('le', limite)])} {acumulado}")
+            lineas.append(f"{nombre}_sum{etiquetas(et)} {suma}")
+            lineas.append(f"{nombre}_count{etiquetas(et)} {n}")
+        return "\n".join(lineas) + "\n"
+
+METRICAS = Metricas()
+if hasattr(os, "register_at_fork"): os.register_at_fork(after_in_child=METRICAS._tras_fork)
@@ -0,0 +1,394 @@
+import xml.etree.ElementTree as ET
+import io
+import os
+import re
+import multiprocessing
+import shutil
+import tempfile
+import time
+import zipfile
+from contextlib import ExitStack
+from concurrent.futures import ProcessPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from clasificacion import clasificar_proveedor
+from metricas import METRICAS
+
+# Parámetros del parseo por lotes
+XML_PROCESOS = int(os.environ.get("XML_PROCESOS", "0")) or os.cpu_count() or 1
+XML_TAM_BLOQUE = int(os.environ.get("XML_TAM_BLOQUE", "250"))
+XML_MIN_PARALELO = int(os.environ.get("XML_MIN_PARALELO", "500"))
+XML_MAX_VUELO_MB = float(os.environ.get("XML_MAX_VUELO_MB", "64")) # XML descomprimidos en memoria a la vez
+XML_MAX_MIEMBRO_MB = float(os.environ.get("XML_MAX_MIEMBRO_MB", "20")) # Un XML más grande no es un comprobante
+ZIP_MAX_ANIDADO_MB = float(os.environ.get("ZIP_MAX_ANIDADO_MB", "512"))
+ZIP_MAX_PROFUNDIDAD = 3
+
+# --- MOTOR DE EXTRACCIÓN XML (VERSION BLINDADA V2) ---
+# Campos de valor único: se guarda el texto de la primera aparición (equivale a find(".//tag"))
+CAMPOS_XML = frozenset(["razonSocial", "ruc", "estab", "ptoEmi", "secuencial", "fechaEmision", "numeroAutorizacion", "claveAcceso",
+                        "identificacionComprador", "identificacionSujetoRetenido", "razonSocialComprador", "razonSocialSujetoRetenido",
+                        "fechaAutorizacion", "importeTotal", "total", "valorModificado", "propina", "numDocSustento", "numDocModificado"])
+# Nodos repetidos: se guardan todos, en orden de documento (equivale a findall(".//tag"))
+NODOS_XML = ("totalImpuesto", "impuesto", "retencion", "detalle")
+_INDICE_XML = {**{t: True for t in CAMPOS_XML}, **{t: False for t in NODOS_XML}}
+_T_PARSEO, _T_DESEMPAQUETADO, _T_CLASIFICACION = (METRICAS.serie("documento_segundos", paso=p) for p in ("parseo", "desempaquetado", "clasificacion"))
+
+def _parsear_embebido(elem):
+    """Si el nodo trae un comprobante escapado o en CDATA, lo devuelve parseado"""
+    texto = elem.text
+    if not texto or not ("<" in texto or "&lt;" in texto) or 'comprobante' not in elem.tag.lower(): return None
+    try:
+        if "<?xml" in texto: texto = re.sub(r'<\?xml.*?\?>', '', texto)
+        return ET.fromstring(texto.strip())
+    except: return None
+
+def indexar_xml(nodo, desempaquetar=False):
+    """Un solo recorrido del árbol. Devuelve (comprobante_embebido, campos, nodos); si hay embebido, lo demás queda a medias"""
+    campos, nodos = {}, {t: [] for t in NODOS_XML}
+    indice = _INDICE_XML
+    if desempaquetar:
+        interno = _parsear_embebido(nodo)
+        if interno is not None: return interno, None, None
+    it = nodo.iter(); next(it) # Sólo descendientes, como ".//"
+    for elem in it:
+        if desempaquetar:
+            txt = elem.text
+            if txt and ("<" in txt or "&lt;" in txt):
+                interno = _parsear_embebido(elem)
+                if interno is not None: return interno, None, None
+        tag = elem.tag
+        es_campo = indice.get(tag)
+        if es_campo is None: continue
+        if es_campo:
+            if tag not in campos: campos[tag] = elem.text
+        else: nodos[tag].append(elem)
+    return None, campos, nodos
+
+def _extraer(xml_file, memoria):
+    if isinstance(xml_file, (io.BytesIO, io.StringIO)): xml_file.seek(0)
+    with _T_PARSEO.medir(): tree = ET.parse(xml_file)
+    root = tree.getroot()
+    
+    # Desempaquetar SOAP e indexar en el mismo recorrido
+    with _T_DESEMPAQUETADO.medir():
+        xml_data, campos, nodos = indexar_xml(root, desempaquetar=True)
+        if xml_data is None: xml_data = root
+        else: _, campos, nodos = indexar_xml(xml_data)
+
+    root_tag = xml_data.tag.lower()
+    if 'notacredito' in root_tag: tipo_doc = "NC"
+    elif 'comprobanteretencion' in root_tag: tipo_doc = "RET"
+    elif 'liquidacioncompra' in root_tag: tipo_doc = "LC"
+    else: tipo_doc = "FC" 
+
+    def buscar(tags):
+        for t in tags:
+            txt = campos.get(t)
+            if txt: return txt.strip()
+        return ""
+        
+    def buscar_float(tags):
+        val_str = buscar(tags)
+        try: return float(val_str) if val_str else 0.0
+        except: return 0.0
+
+    razon_social = buscar(["razonSocial"]).upper()
+    ruc_emisor = buscar(["ruc"])
+    
+    estab = buscar(["estab"]) or "000"
+    pto = buscar(["ptoEmi"]) or "000"
+    sec = buscar(["secuencial"]) or "000000000"
+    num_fact_completo = f"{estab}-{pto}-{sec}"
+    
+    fecha_emision = buscar(["fechaEmision"])
+    num_autori = buscar(["numeroAutorizacion"]) or buscar(["claveAcceso"])
+    
+    mes_nombre = "DESCONOCIDO"
+    if "/" in fecha_emision:
+        try:
+            meses_dict = {"01":"ENERO","02":"FEBRERO","03":"MARZO","04":"ABRIL","05":"MAYO","06":"JUNIO","07":"JULIO","08":"AGOSTO","09":"SEPTIEMBRE","10":"OCTUBRE","11":"NOVIEMBRE","12":"DICIEMBRE"}
+            mes_nombre = meses_dict.get(fecha_emision.split('/')[1], "DESCONOCIDO")
+        except: pass
+
+    ruc_cliente = buscar(["identificacionComprador", "identificacionSujetoRetenido"])
+    nombre_cliente = buscar(["razonSocialComprador", "razonSocialSujetoRetenido"]).upper()
+
+    # Sin columnas repetidas: TIPO DE DOCUMENTO, CONTRIBUYENTE y los nombres del formato de retenciones se arman al
+    # exportar (comprobantes.ALIAS)
+    base_data = {
+        "TIPO": tipo_doc, "MES": mes_nombre, "FECHA": fecha_emision, "N. FACTURA": num_fact_completo, 
+        "RUC": ruc_emisor, "NOMBRE": razon_social, "N AUTORIZACION": num_autori,
+        "RUC CLIENTE": ruc_cliente, "CLIENTE": nombre_cliente 
+    }
+
+    if tipo_doc == "RET":
+        rt_renta, rt_iva = 0.0, 0.0
+        base_renta, base_iva = 0.0, 0.0
+        sustento_formateado = ""
+        
+        doc_sus_raw = buscar(["numDocSustento"])
+        
+        if doc_sus_raw:
+            parts = doc_sus_raw.replace('-','').strip()
+            if len(parts) >= 15: 
+                sustento_formateado = f"{parts[0:3]}-{parts[3:6]}-{parts[6:]}"
+            elif len(doc_sus_raw.split('-')) == 3:
+                sustento_formateado = doc_sus_raw
+
+        lista_retenciones = nodos["impuesto"] + nodos["retencion"]
+
+        for item in lista_retenciones:
+            cod_node = item.find("codigo")
+            cod = cod_node.text.strip() if (cod_node is not None and cod_node.text) else ""
+            
+            try:
+                val_node = item.find("valorRetenido")
+                val_txt = val_node.text.strip() if (val_node is not None and val_node.text) else "0"
+                val = float(val_txt)
+            except: val = 0.0
+
+            try:
+                base_node = item.find("baseImponible")
+                base_txt = base_node.text.strip() if (base_node is not None and base_node.text) else "0"
+                base = float(base_txt)
+            except: base = 0.0
+            
+            if cod == "1": # Renta
+                rt_renta += val
+                base_renta += base
+            elif cod == "2": # IVA
+                rt_iva += val
+                base_iva += base
+
+        base_data.update({
+            "baserenta": base_renta,
+            "rt_renta": rt_renta,
+            "baseiva": base_iva,
+            "rt_iva": rt_iva,
+            "fecautori": buscar(["fechaAutorizacion"]) or fecha_emision,
+            "SUSTENTO": sustento_formateado,
+            "TOTAL RET": rt_renta + rt_iva
+        })
+        return base_data
+
+    else: 
+        m = -1 if tipo_doc == "NC" else 1
+        total = buscar_float(["importeTotal", "total", "valorModificado"]) * m
+        propina = buscar_float(["propina"]) * m
+        
+        base_0, base_12_15, iva_12_15 = 0.0, 0.0, 0.0
+        no_obj_iva, exento_iva = 0.0, 0.0
+        otra_base, otro_monto_iva, ice_val = 0.0, 0.0, 0.0
+        
+        for imp in nodos["totalImpuesto"]:
+            try:
+                cod = imp.find("codigo").text
+                cod_por = imp.find("codigoPorcentaje").text
+                base = float(imp.find("baseImponible").text or 0) * m
+                valor = float(imp.find("valor").text or 0) * m
+                
+                if cod == "2": # IVA
+                    if cod_por == "0": base_0 += base
+                    elif cod_por in ["2", "3", "4", "8", "10"]:
+                        base_12_15 += base; iva_12_15 += valor
+                    elif cod_por == "6": no_obj_iva += base
+                    elif cod_por == "7": exento_iva += base
+                    else:
+                        otra_base += base; otro_monto_iva += valor
+                elif cod == "3": ice_val += valor
+                else:
+                     otra_base += base; otro_monto_iva += valor
+            except: continue 
+
+        if tipo_doc == "NC":
+            detalle_final, memo_final = "", ""
+            doc_mod = buscar(["numDocModificado"]).replace('-','')
+            base_data["DOC MODIFICADO"] = f"{doc_mod[0:3]}-{doc_mod[3:6]}-{doc_mod[6:]}" if len(doc_mod) >= 15 else doc_mod
+        else:
+            with _T_CLASIFICACION.medir(): info = clasificar_proveedor(razon_social, memoria, ruc_emisor)
+            detalle_final = info["DETALLE"]
+            memo_final = info["MEMO"]
+        
+        items = [d.find("descripcion").text for d in nodos["detalle"] if d.find("descripcion") is not None]
+        subdetalle = " | ".join(items[:5]) if items else ""
+
+        base_data.update({
+            "DETALLE": detalle_final, "MEMO": memo_final, "SUBDETALLE": subdetalle,
+            "OTRA BASE IVA": otra_base, "OTRO IVA": otro_monto_iva, 
+            "MONTO ICE": ice_val, "PROPINAS": propina,
+            "EXENTO DE IVA": exento_iva, "NO OBJ IVA": no_obj_iva, 
+            "BASE. 0": base_0, "BASE. 12 / 15": base_12_15,
+            "IVA.": iva_12_15, "TOTAL": total
+        })
+        return base_data
+
+def extraer_datos_robusto(xml_file, memoria):
+    try: return _extraer(xml_file, memoria)
+    except Exception as e:
+        METRICAS.fallo("xml_errores_total", type(e).__name__, e)
+        return None
+
+# --- INGESTA DE ARCHIVOS (STREAMING) ---
+class IngestaXML:
+    """Recorre XML sueltos y ZIP (también anidados) abriendo cada miembro sólo cuando se consume.
+    Genera (nombre, bytes); lo omitido queda en `errores` como (nombre, motivo).
+    `omitir(nombre, bytes)`, si se da, descarta en silencio los XML para los que devuelva True (p. ej. repetidos)"""
+    def __init__(self, archivos, max_miembro_mb=XML_MAX_MIEMBRO_MB, max_anidado_mb=ZIP_MAX_ANIDADO_MB, omitir=None):
+        self.archivos = list(archivos)
+        self.omitir = omitir
+        self.max_miembro = int(max_miembro_mb * 1024 * 1024)
+        self.max_anidado = int(max_anidado_mb * 1024 * 1024)
+        self.errores = []
+        self.total_estimado = 0 # Crece al descubrir ZIP anidados
+        for f in self.archivos:
+            nombre = f.name.lower()
+            if nombre.endswith('.xml'): self.total_estimado += 1
+            elif nombre.endswith('.zip'):
+                try:
+                    with zipfile.ZipFile(f) as z: self.total_estimado += sum(1 for i in z.infolist() if self._es_xml(i.filename))
+                except Exception: pass # Se reporta al recorrerlo
+                finally: f.seek(0)
+
+    @staticmethod
+    def _es_xml(nombre):
+        return nombre.lower().endswith('.xml') and not nombre.startswith('__MACOSX')
+
+    def __iter__(self):
+        for nombre, contenido in self._recorrer():
+            if self.omitir is None or not self.omitir(nombre, contenido): yield nombre, contenido
+        if self.errores: METRICAS.contar("xml_errores_total", len(self.errores), motivo="ingesta")
+
+    def _recorrer(self):
+        for f in self.archivos:
+            nombre = f.name.lower()
+            if nombre.endswith('.xml'):
+                f.seek(0); contenido = f.read(self.max_miembro + 1)
+                if len(contenido) > self.max_miembro: self.errores.append((f.name, "XML demasiado grande"))
+                else: yield f.name, contenido
+            elif nombre.endswith('.zip'):
+                f.seek(0)
+                yield from self._recorrer_zip(f, f.name, 0)
+
+    def _recorrer_zip(self, fuente, ruta, profundidad):
+        try: z = zipfile.ZipFile(fuente)
+        except Exception as e:
+            self.errores.append((ruta, f"ZIP inválido: {e}")); return
+        with z:
+            for info in z.infolist():
+                nombre = f"{ruta}/{info.filename}"
+                if info.is_dir() or info.filename.startswith('__MACOSX'): continue
+                if self._es_xml(info.filename):
+                    if info.file_size > self.max_miembro:
+                        self.errores.append((nombre, "XML demasiado grande")); continue
+                    try:
+                        with z.open(info) as m: contenido = m.read(self.max_miembro + 1) # No confiar en el tamaño declarado
+                    except Exception as e:
+                        self.errores.append((nombre, f"No se pudo descomprimir: {e}")); continue
+                    if len(contenido) > self.max_miembro: self.errores.append((nombre, "XML demasiado grande"))
+                    else: yield nombre, contenido
+                elif info.filename.lower().endswith('.zip'):
+                    if profundidad + 1 > ZIP_MAX_PROFUNDIDAD or info.file_size > self.max_anidado:
+                        self.errores.append((nombre, "ZIP anidado omitido (profundidad o tamaño)")); continue
+                    # El ZIP interno necesita acceso aleatorio: se vuelca a un temporal que pasa a disco si es grande
+                    with tempfile.SpooledTemporaryFile(max_size=8 * 1024 * 1024) as tmp:
+                        try:
+                            with z.open(info) as m: shutil.copyfileobj(m, tmp)
+                        except Exception as e:
+                            self.errores.append((nombre, f"No se pudo descomprimir: {e}")); continue
+                        tmp.seek(0)
+                        try:
+                            with zipfile.ZipFile(tmp) as zi: self.total_estimado += sum(1 for i in zi.infolist() if self._es_xml(i.filename))
+                        except Exception: pass
+                        tmp.seek(0)
+                        yield from self._recorrer_zip(tmp, nombre, profundidad + 1)
+
+def procesar_archivos_entrada(lista_archivos):
+    return IngestaXML(lista_archivos)
+
+# --- PARSEO POR LOTES (MULTI-NÚCLEO) ---
+_memoria_trabajador = None
+
+def _iniciar_trabajador(memoria):
+    global _memoria_trabajador
+    _memoria_trabajador = memoria
+
+def _extraer_bloque(inicio, bloque, memoria=None):
+    """Extrae un bloque de (nombre, bytes). Devuelve (inicio, resultados, errores)"""
+    memoria = memoria if memoria is not None else _memoria_trabajador
+    resultados, errores = [], []
+    for nombre, contenido in bloque:
+        try: resultados.append(_extraer(io.BytesIO(contenido), memoria))
+        except Exception as e:
+            resultados.append(None); errores.append((nombre, f"{type(e).__name__}: {e}"))
+            METRICAS.fallo("xml_errores_total", type(e).__name__, f"{nombre}: {e}")
+    return inicio, resultados, errores
+
+def _contexto_pool():
+    """fork donde existe. spawn y forkserver vuelven a ejecutar __main__ en cada trabajador, y bajo Streamlit __main__ es
+    srilinea.py: la página entera, que sin sesión falla y rompe el pool. Windows sólo tiene spawn (procesar_lote.py sí
+    tiene su guarda de __main__)"""
+    return multiprocessing.get_context("fork" if "fork" in multiprocessing.get_all_start_methods() else "spawn")
+
+def _extraer_bloque_trabajador(inicio, bloque):
+    """En el pool: además devuelve las métricas del bloque para sumarlas en el proceso principal"""
+    return (*_extraer_bloque(inicio, bloque), METRICAS.volcar())
+
+@METRICAS.cronometrado("etapa_segundos", etapa="extraccion")
+def extraer_flujo(items, memoria, procesos=XML_PROCESOS, tam_bloque=XML_TAM_BLOQUE, max_vuelo_mb=XML_MAX_VUELO_MB, progreso=None, total=None):
+    """Extrae un iterable de (nombre, bytes) consumiéndolo por bloques, con tope de bytes pendientes de parsear.
+    `total` puede ser una función que devuelva la estimación vigente (p. ej. de IngestaXML, que crece al abrir ZIP
+    anidados): se empieza en serie y se pasa al pool en cuanto la estimación llega a XML_MIN_PARALELO.
+    Devuelve (resultados, errores): resultados en el orden de entrada (None si falló), errores como (nombre, mensaje)"""
+    max_vuelo = int(max_vuelo_mb * 1024 * 1024)
+    estimado = total if callable(total) else lambda: total
+    limite_bloque = max_vuelo
+    resultados, errores, hechos = {}, {}, 0
+    lectura = [0.0, 0] # Segundos esperando a la ingesta (leer y descomprimir) y bytes leídos
+
+    def leer():
+        if not METRICAS.activas: yield from items; return
+        it = iter(items)
+        while True:
+            t0 = time.perf_counter()
+            item = next(it, None)
+            lectura[0] += time.perf_counter() - t0
+            if item is None: return
+            lectura[1] += len(item[1])
+            yield item
+
+    def bloques():
+        bloque, tam, inicio = [], 0, 0
+        for item in leer():
+            bloque.append(item); tam += len(item[1])
+            if len(bloque) >= tam_bloque or tam >= limite_bloque:
+                yield inicio, bloque, tam
+                inicio += len(bloque); bloque, tam = [], 0
+        if bloque: yield inicio, bloque, tam
+
+    def recoger(inicio, res, errs, metricas=None):
+        nonlocal hechos
+        METRICAS.fusionar(metricas)
+        resultados[inicio] = res; errores[inicio] = errs
+        hechos += len(res)
+        if progreso: progreso(hechos, estimado())
+
+    with ExitStack() as pila:
+        pool, en_vuelo = None, {}
+        for inicio, bloque, tam in bloques():
+            if pool is None and procesos > 1 and (estimado() is None or estimado() >= XML_MIN_PARALELO):
+                pool = pila.enter_context(ProcessPoolExecutor(max_workers=procesos, mp_context=_contexto_pool(), initializer=_iniciar_trabajador, initargs=(memoria,)))
+                limite_bloque = max(1, max_vuelo // (2 * procesos))
+            if pool is None:
+                recoger(*_extraer_bloque(inicio, bloque, memoria)); continue
+            while en_vuelo and sum(en_vuelo.values()) + tam > max_vuelo:
+                listos, _ = wait(en_vuelo, return_when=FIRST_COMPLETED)
+                for fut in listos: en_vuelo.pop(fut); recoger(*fut.result())
+            en_vuelo[pool.submit(_extraer_bloque_trabajador, inicio, bloque)] = tam
+        for fut in as_completed(en_vuelo): recoger(*fut.result())
+    METRICAS.observar("etapa_segundos", lectura[0], etapa="ingesta")
+    METRICAS.contar("xml_bytes_total", lectura[1]); METRICAS.contar("xml_documentos_total", hechos)
+    orden = sorted(resultados)
+    return [r for i in orden for r in resultados[i]], [e for i in orden for e in errores[i]]
+
+def extraer_lote(archivos, memoria, procesos=XML_PROCESOS, tam_bloque=XML_TAM_BLOQUE, progreso=None):
+    """Como extraer_flujo, para una lista ya cargada de XMLs (file-like o bytes)"""
+    items = [(getattr(x, "name", None) or f"#{i+1}", x if isinstance(x, bytes) else x.getvalue()) for i, x in enumerate(archivos)]
+    return extraer_flujo(items, memoria, procesos, tam_bloque, progreso=progreso, total=len(items))
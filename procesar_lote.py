@@ -0,0 +1,203 @@
+"""Procesamiento por lotes sin Streamlit (p. ej. cierres de mes desde cron). Genera los mismos Excel que el portal.
+
+    python procesar_lote.py --compras compras/ -o C.xlsx
+    python procesar_lote.py --ventas ventas.zip -o V.xlsx
+    python procesar_lote.py --compras compras/ --ventas ventas/ -o INT.xlsx      # informe integral
+    python procesar_lote.py --claves recibidas.txt --tipo FC -o FC.xlsx --zip-xml FC_XML.zip [--zip-pdf FC_PDF.zip]
+    python procesar_lote.py --compras enero/ --ventas enero_v/ --guardar -o INT_ENERO.xlsx  # y queda en el histórico
+    python procesar_lote.py --historico 1790012345001 --desde 2025-01 --hasta 2025-12 -o ANUAL.xlsx
+    python procesar_lote.py --borrar 1790012345001 --desde 2025-03 --hasta 2025-03 [--libro COMPRAS]  # antes de recargar marzo
+
+Las rutas pueden ser XML, ZIP o directorios (se recorren completos). Códigos de salida:
+0 todo bien · 1 reporte generado pero con XML ilegibles o claves sin descargar · 2 error de uso · 3 ningún documento válido"""
+import argparse
+import json
+import os
+import re
+import sys
+import time
+import zipfile
+from motor_xml import XML_PROCESOS, extraer_flujo
+from clasificacion import CLASIF_RUTA, ClasificadorProveedores
+from almacen import ALMACEN_RUTA, TIPOS_LIBRO, AlmacenDocumentos
+from metricas import METRICAS
+
+SALIDA_OK, SALIDA_PARCIAL, SALIDA_USO, SALIDA_VACIO = 0, 1, 2, 3
+
+def log(msg):
+    print(f"[{time.strftime('%H:%M:%S')}] {msg}", file=sys.stderr, flush=True)
+
+def listar_archivos(rutas, extensiones):
+    """Expande directorios; devuelve las rutas con alguna de las extensiones, en orden estable"""
+    encontrados = []
+    for ruta in rutas:
+        if os.path.isdir(ruta):
+            for base, dirs, archivos in os.walk(ruta):
+                dirs.sort()
+                encontrados += [os.path.join(base, a) for a in sorted(archivos) if a.lower().endswith(extensiones)]
+        elif os.path.isfile(ruta): encontrados.append(ruta)
+        else: raise FileNotFoundError(ruta)
+    return encontrados
+
+def extraer_rutas(rutas, memoria, procesos):
+    from comprobantes import ConjuntoDocumentos
+    archivos = [open(r, "rb") for r in listar_archivos(rutas, (".xml", ".zip"))]
+    try:
+        docs = ConjuntoDocumentos() # El mismo comprobante suelto y dentro de un ZIP cuenta una sola vez
+        ingesta = docs.preparar(archivos)
+        t0 = ultimo = time.perf_counter()
+        def progreso(hechos, total):
+            nonlocal ultimo
+            if time.perf_counter() - ultimo >= 5:
+                ultimo = time.perf_counter(); log(f"  {hechos}/{max(total, hechos)} XMLs")
+        resultados, errores = extraer_flujo(ingesta, memoria, procesos=procesos, progreso=progreso, total=lambda: ingesta.total_estimado)
+        errores = ingesta.errores + errores
+        data = docs.agregar(resultados)
+        log(f"  {len(data)} documentos en {time.perf_counter() - t0:.1f}s, {len(errores)} con error, {len(docs.duplicados)} repetidos")
+        for nombre, msg in errores[:20]: log(f"  ! {nombre}: {msg}")
+        if len(errores) > 20: log(f"  ! ... y {len(errores) - 20} más")
+        return data, errores
+    finally:
+        for f in archivos: f.close()
+
+def leer_claves(rutas, tipo):
+    from descarga_sri import LecturaClaves
+    lectura = LecturaClaves(tipo)
+    for ruta in listar_archivos(rutas, (".txt",)):
+        with open(ruta, "r", encoding="latin-1") as f: lectura.leer(f, os.path.basename(ruta))
+    log(lectura.resumen())
+    for origen, n, texto, motivo in lectura.invalidas[:20]: log(f"  ! {origen}:{n} {texto}: {motivo}")
+    if len(lectura.invalidas) > 20: log(f"  ! ... y {len(lectura.invalidas) - 20} más")
+    return lectura.claves
+
+def lote_xml(a, memoria):
+    from integracion import conciliar_ventas
+    from reportes import generar_excel_multiexcel
+    compras = ventas = None
+    errores = 0
+    almacen = AlmacenDocumentos(a.almacen) if a.guardar else None
+    if a.compras:
+        log("Compras:")
+        data, err = extraer_rutas(a.compras, memoria, a.procesos); errores += len(err)
+        compras = [d for d in data if d["TIPO"] in TIPOS_LIBRO["COMPRAS"]]
+        if almacen: log("  %d guardados en el histórico, %d omitidos (sin RUC/fecha válidos)" % almacen.guardar(compras, 'COMPRAS'))
+    if a.ventas:
+        log("Ventas:")
+        data, err = extraer_rutas(a.ventas, memoria, a.procesos); errores += len(err)
+        if almacen: log("  %d guardados en el histórico, %d omitidos (de otro tipo o sin RUC/fecha válidos)" % almacen.guardar(data, 'VENTAS'))
+        ventas, ret_sueltas, nc_sueltas = conciliar_ventas(data)
+        log(f"  {(ventas['N° RET'] != '').sum()}/{len(ventas)} facturas con retención, {len(ret_sueltas)} retenciones y {len(nc_sueltas)} NC sin factura")
+        for _, r in ret_sueltas.head(20).iterrows(): log(f"  ! RET {r['N. FACTURA']} de {r['RUC']}: factura {r['SUSTENTO']} no encontrada")
+    if not compras and (ventas is None or ventas.empty):
+        log("No se encontraron XMLs válidos."); return SALIDA_VACIO
+    with open(a.salida, "wb") as f: f.write(generar_excel_multiexcel(compras or None, ventas, formulas_resumen=a.formulas))
+    log(f"Excel: {a.salida}")
+    return SALIDA_PARCIAL if errores else SALIDA_OK
+
+def lote_historico(a):
+    from integracion import conciliar_ventas
+    from reportes import generar_excel_multiexcel
+    almacen = AlmacenDocumentos(a.almacen)
+    compras = almacen.consultar(a.historico, "COMPRAS", a.desde, a.hasta)
+    ventas = almacen.consultar(a.historico, "VENTAS", a.desde, a.hasta)
+    log(f"Histórico {a.historico} {a.desde or 'inicio'} a {a.hasta or 'fin'}: {len(compras)} compras, {len(ventas)} ventas/retenciones")
+    if not compras and not ventas: return SALIDA_VACIO
+    with open(a.salida, "wb") as f: f.write(generar_excel_multiexcel(compras or None, conciliar_ventas(ventas)[0] if ventas else None, formulas_resumen=a.formulas))
+    log(f"Excel: {a.salida}")
+    return SALIDA_OK
+
+def lote_borrar(a):
+    n = AlmacenDocumentos(a.almacen).borrar(a.borrar, a.libro, a.desde, a.hasta)
+    log(f"Histórico {a.borrar} {a.libro or 'COMPRAS y VENTAS'} {a.desde or 'inicio'} a {a.hasta or 'fin'}: {n} documentos borrados")
+    return SALIDA_OK if n else SALIDA_VACIO
+
+def lote_claves(a, memoria):
+    from descarga_sri import CacheComprobantes, EtapaPDF, TIPOS_SRI, opciones_zip, resolver_claves
+    from reportes import generar_excel_multiexcel
+    claves = leer_claves(a.claves, a.tipo)
+    if not claves:
+        log(f"No hay claves de acceso válidas del tipo {a.tipo} en los TXT."); return SALIDA_VACIO
+    log(f"{len(claves)} claves ({a.tipo})")
+    cache = None if a.sin_cache else CacheComprobantes()
+    lst, fallidas = [], {}
+    zip_xml, zip_pdf = opciones_zip(".xml"), opciones_zip(".pdf")
+    zf_xml = zipfile.ZipFile(a.zip_xml, "w") if a.zip_xml else None
+    etapa_pdf = EtapaPDF(claves, max_hilos=a.hilos_pdf) if a.zip_pdf else None
+    zf_pdf = zipfile.ZipFile(a.zip_pdf, "w") if a.zip_pdf else None
+    try:
+        for i, (cl, estado, contenido, _, d) in enumerate(resolver_claves(claves, memoria, cache, max_hilos=a.hilos, rps=a.rps), 1):
+            if estado in ("OK", "CACHE"):
+                if zf_xml: zf_xml.writestr(f"{cl}.xml", contenido, **zip_xml)
+                if d and d["TIPO"] in TIPOS_SRI[a.tipo]: lst.append(d)
+            else: fallidas[cl] = estado
+            if etapa_pdf:
+                for cl_pdf, pdf in etapa_pdf.recoger():
+                    if pdf: zf_pdf.writestr(f"{cl_pdf}.pdf", pdf, **zip_pdf)
+            if i % 500 == 0: log(f"  {i}/{len(claves)}")
+        if etapa_pdf:
+            for cl_pdf, pdf in etapa_pdf.recoger(bloquear=True):
+                if pdf: zf_pdf.writestr(f"{cl_pdf}.pdf", pdf, **zip_pdf)
+            log(f"PDFs: {etapa_pdf.ok} descargados, {etapa_pdf.fallidos} fallidos")
+    finally:
+        if etapa_pdf: etapa_pdf.cerrar()
+        if zf_xml: zf_xml.close()
+        if zf_pdf: zf_pdf.close()
+    for cl, estado in list(fallidas.items())[:20]: log(f"  ! {cl}: {estado}")
+    log(f"{len(claves) - len(fallidas)} XML obtenidos, {len(fallidas)} fallidos, {len(lst)} del tipo {a.tipo}")
+    if not lst: return SALIDA_VACIO
+    with open(a.salida, "wb") as f: f.write(generar_excel_multiexcel(data_sri_lista=lst, sri_mode=a.tipo))
+    log(f"Excel: {a.salida}")
+    return SALIDA_PARCIAL if fallidas or (etapa_pdf and etapa_pdf.fallidos) else SALIDA_OK
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--compras", nargs="+", metavar="RUTA", help="XML/ZIP/directorios de compras y NC")
+    ap.add_argument("--ventas", nargs="+", metavar="RUTA", help="XML/ZIP/directorios de ventas y retenciones")
+    ap.add_argument("--claves", nargs="+", metavar="TXT", help="TXT con claves de acceso para descargar del SRI")
+    ap.add_argument("--tipo", choices=["FC", "NC", "RET"], default="FC", help="reporte de la descarga SRI")
+    ap.add_argument("--historico", metavar="RUC", help="informe desde el histórico de este contribuyente, sin XML")
+    ap.add_argument("--borrar", metavar="RUC", help="borra del histórico los documentos de este contribuyente entre --desde y --hasta")
+    ap.add_argument("--libro", choices=["COMPRAS", "VENTAS"], help="con --borrar, sólo ese libro")
+    ap.add_argument("--desde", metavar="AAAA-MM", help="primer mes del informe histórico o del borrado")
+    ap.add_argument("--hasta", metavar="AAAA-MM", help="último mes del informe histórico o del borrado")
+    ap.add_argument("--guardar", action="store_true", help="guarda lo procesado en el histórico")
+    ap.add_argument("-o", "--salida", help="Excel a generar")
+    ap.add_argument("--zip-xml", help="ZIP donde guardar los XML descargados")
+    ap.add_argument("--zip-pdf", help="ZIP donde guardar los PDF (RIDE); si falta no se descargan")
+    ap.add_argument("--formulas", action="store_true", help="REPORTE ANUAL/PROYECCION con fórmulas SUMIFS")
+    ap.add_argument("--procesos", type=int, default=XML_PROCESOS, help="procesos de parseo XML")
+    ap.add_argument("--hilos", type=int, help="descargas simultáneas al WS del SRI")
+    ap.add_argument("--hilos-pdf", type=int, help="descargas simultáneas de PDF")
+    ap.add_argument("--rps", type=float, help="tope de peticiones por segundo al WS")
+    ap.add_argument("--sin-cache", action="store_true", help="no usar la caché local de autorizaciones")
+    ap.add_argument("--clasificacion", default=CLASIF_RUTA, help="base SQLite de proveedores")
+    ap.add_argument("--almacen", default=ALMACEN_RUTA, help="base SQLite del histórico")
+    ap.add_argument("--metricas", metavar="RUTA", help="guarda tiempos por etapa y fallas (JSON, o texto Prometheus si termina en .prom)")
+    a = ap.parse_args(argv)
+    if [bool(a.claves), bool(a.compras or a.ventas), bool(a.historico), bool(a.borrar)].count(True) != 1: ap.error("indique --claves, --historico, --borrar, o bien --compras y/o --ventas")
+    if not a.borrar and not a.salida: ap.error("falta -o/--salida")
+    if a.libro and not a.borrar: ap.error("--libro sólo se usa con --borrar")
+    if a.borrar and not (a.desde or a.hasta): ap.error("indique --desde y/o --hasta: --borrar no vacía el histórico completo de un contribuyente")
+    for mes in (a.desde, a.hasta):
+        if mes and not re.fullmatch(r"\d{4}-(0[1-9]|1[0-2])", mes): ap.error(f"mes inválido: {mes} (AAAA-MM)")
+    if a.claves:
+        from descarga_sri import PDF_MAX_HILOS, SRI_MAX_HILOS, SRI_MAX_RPS
+        a.hilos, a.hilos_pdf, a.rps = a.hilos or SRI_MAX_HILOS, a.hilos_pdf or PDF_MAX_HILOS, a.rps or SRI_MAX_RPS
+    try:
+        if a.historico: return lote_historico(a)
+        if a.borrar: return lote_borrar(a)
+        memoria = ClasificadorProveedores(a.clasificacion).memoria
+        return lote_claves(a, memoria) if a.claves else lote_xml(a, memoria)
+    except FileNotFoundError as e:
+        log(f"No existe: {e}"); return SALIDA_USO
+    finally:
+        if a.metricas: guardar_metricas(a.metricas)
+
+def guardar_metricas(ruta):
+    with open(ruta, "w", encoding="utf-8") as f:
+        if ruta.lower().endswith(".prom"): f.write(METRICAS.a_prometheus())
+        else: json.dump(METRICAS.instantanea(), f, ensure_ascii=False, indent=2)
+    log(f"Métricas: {ruta}")
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,150 @@
+import io
+from datetime import datetime
+from itertools import groupby
+import pandas as pd
+import xlsxwriter
+from comprobantes import para_exportar
+from metricas import METRICAS
+
+# --- GENERADOR MULTI-EXCEL ---
+# Todas las hojas en constant_memory: cada fila se escribe completa y en orden. Una combinación de varias filas se
+# registra antes de escribir su primera fila y sin formato (no escribe celdas); el formato va luego en cada fila
+def _escribir_filas(ws, df, f_num, f_txt, fila0=1):
+    """Escribe el DataFrame fila a fila (orden que exige constant_memory): un write_row por tramo de columnas con el mismo formato"""
+    numericas = [df[c].dtype.kind in "fi" for c in df.columns]
+    formato = lambda par: f_num if par[0] or isinstance(par[1], (int, float)) else f_txt
+    for r, fila in enumerate(df.itertuples(index=False, name=None), fila0):
+        c = 0
+        for fmt, tramo in groupby(zip(numericas, fila), key=formato):
+            valores = [v for _, v in tramo]
+            ws.write_row(r, c, valores, fmt); c += len(valores)
+
+def _montos(df, cols):
+    """Suma por fila de columnas de valor; los textos cuentan como 0, igual que en SUMIFS"""
+    return df[cols].apply(pd.to_numeric, errors="coerce").fillna(0.0).sum(axis=1)
+
+def agregar_compras(df_c, meses, cats):
+    """Totales mes × MEMO PROFESIONAL y mes × DETALLE del gasto (BASE 0 + 12/15 + NO OBJ + EXENTO + OTRA BASE)"""
+    gasto = _montos(df_c, ["BASE. 0","BASE. 12 / 15","NO OBJ IVA","EXENTO DE IVA","OTRA BASE IVA"])
+    mes = df_c["MES"].astype(str).str.upper()
+    profesional = gasto[df_c["MEMO"].astype(str).str.upper() == "PROFESIONAL"].groupby(mes).sum().reindex(meses, fill_value=0.0)
+    por_cat = gasto.groupby([mes, df_c["DETALLE"].astype(str).str.upper()]).sum().unstack(fill_value=0.0).reindex(index=meses, columns=cats, fill_value=0.0)
+    return profesional, por_cat
+
+def agregar_ventas(df_v, meses):
+    return _montos(df_v, ["BASE. 0","BASE. 12 / 15"]).groupby(df_v["MES"].astype(str).str.upper()).sum().reindex(meses, fill_value=0.0)
+
+@METRICAS.cronometrado("etapa_segundos", etapa="excel")
+def generar_excel_multiexcel(data_compras=None, data_ventas_ret=None, data_sri_lista=None, sri_mode=None, formulas_resumen=False):
+    """Los datos pueden ser listas de registros o tablas (comprobantes.tabla); las columnas con nombres del formato
+    anterior se arman aquí. formulas_resumen=True deja en REPORTE ANUAL/PROYECCION fórmulas SUMIFS acotadas a los
+    datos (auditables) en vez de valores"""
+    output = io.BytesIO()
+    with xlsxwriter.Workbook(output, {'constant_memory': True}) as wb:
+        f_azul = wb.add_format({'bold':True,'align':'center','border':1,'bg_color':'#002060','font_color':'white'})
+        f_amar = wb.add_format({'bold':True,'align':'center','border':1,'bg_color':'#FFD966'})
+        f_verd = wb.add_format({'bold':True,'align':'center','border':1,'bg_color':'#92D050'})
+        f_gris = wb.add_format({'bold':True,'align':'center','border':1,'bg_color':'#F2F2F2'})
+        f_num = wb.add_format({'num_format':'_-$ * #,##0.00_-','border':1})
+        f_tot = wb.add_format({'bold':True,'num_format':'_-$ * #,##0.00_-','border':1,'bg_color':'#EFEFEF'})
+        f_txt = wb.add_format({'border':1})
+
+        def celda(ws, r, c, formula, valor, fmt):
+            if formulas_resumen: ws.write_formula(r, c, formula, fmt, valor)
+            else: ws.write_number(r, c, valor, fmt)
+        
+        if sri_mode:
+            if sri_mode == "NC":
+                cols = ["NOMBRE","RUC","N AUTORIZACION","FECHA","TIPO DE DOCUMENTO","N. FACTURA","MES","RUC CLIENTE","CLIENTE","PROPINAS","BASE. 0","NO OBJ IVA","BASE. 12 / 15","IVA.","TOTAL"]
+                header_fmt = f_amar; sheet_name = "NOTAS DE CREDITO"
+            elif sri_mode == "RET":
+                cols = ["ruc_recep", "nomrecep", "fechaemi", "razonsocial", "ruc_emisor", "numfact", "numreten", "baserenta", "rt_renta", "baseiva", "rt_iva", "numautori", "fecautori"]
+                header_fmt = f_verd; sheet_name = "RETENCIONES"
+            else: 
+                cols = ["MES","FECHA","N. FACTURA","TIPO DE DOCUMENTO","RUC","CONTRIBUYENTE","NOMBRE","DETALLE","MEMO","OTRA BASE IVA","OTRO IVA","MONTO ICE","PROPINAS","EXENTO DE IVA","NO OBJ IVA","BASE. 0","BASE. 12 / 15","IVA.","TOTAL","SUBDETALLE"]
+                header_fmt = f_azul; sheet_name = "FACTURAS"
+
+            df = para_exportar(data_sri_lista, cols)
+            
+            ws = wb.add_worksheet(sheet_name)
+            for i, c in enumerate(cols): ws.write(0, i, c, header_fmt)
+            _escribir_filas(ws, df, f_num, f_txt)
+            ws.set_column(0, len(cols)-1, 15)
+            
+        else:
+            profesional = None
+            meses = ["ENERO", "FEBRERO", "MARZO", "ABRIL", "MAYO", "JUNIO", "JULIO", "AGOSTO", "SEPTIEMBRE", "OCTUBRE", "NOVIEMBRE", "DICIEMBRE"]
+
+            if data_compras is not None and len(data_compras):
+                orden_c = ["MES","FECHA","N. FACTURA","TIPO DE DOCUMENTO","RUC","CONTRIBUYENTE","NOMBRE","DETALLE","MEMO","OTRA BASE IVA","OTRO IVA","MONTO ICE","PROPINAS","EXENTO DE IVA","NO OBJ IVA","BASE. 0","BASE. 12 / 15","IVA.","TOTAL","SUBDETALLE"]
+                df_c = para_exportar(data_compras, orden_c)
+                
+                ws_c = wb.add_worksheet('COMPRAS')
+                for i, c in enumerate(orden_c):
+                    fmt = f_amar if i in range(9, 15) else f_azul
+                    ws_c.write(0, i, c, fmt)
+                _escribir_filas(ws_c, df_c, f_num, f_txt)
+                
+                ft = len(df_c) + 1; ws_c.write(ft, 0, "TOTAL", f_tot)
+                for cidx in range(9, 19): 
+                    l = xlsxwriter.utility.xl_col_to_name(cidx); ws_c.write_formula(ft, cidx, f"=SUM({l}2:{l}{ft})", f_tot)
+
+                ws_ra = wb.add_worksheet('REPORTE ANUAL')
+                ws_ra.set_column('A:K', 14)
+                cats=["VIVIENDA","SALUD","EDUCACION","ALIMENTACION","VESTIMENTA","TURISMO","NO DEDUCIBLE","SERVICIOS BASICOS"]
+                icos=["🏠","❤️","🎓","🛒","🧢","✈️","🚫","💡"]
+                ws_ra.merge_range('B1:B2', None, None); ws_ra.merge_range('K1:K2', None, None)
+                ws_ra.write_row(0, 1, ["Negocios y\nServicios", *icos, "Total Mes"], f_azul)
+                ws_ra.write_row(1, 1, [None, *[ct.title() for ct in cats], None], f_azul)
+                ws_ra.write('B3',"PROFESIONALES",f_gris); ws_ra.merge_range('C3:J3',"GASTOS PERSONALES",f_gris)
+                
+                profesional, por_cat = agregar_compras(df_c, meses, cats)
+                cols_gasto = ["P","Q","O","N","J"]
+                rango_c = lambda l: f"'COMPRAS'!${l}$2:${l}${ft}"
+                totales = [0.0] * 10
+                for r, mes in enumerate(meses):
+                    fila = r+4; ws_ra.write(r+3,0,mes.title(),f_num)
+                    valores = [profesional[mes]] + list(por_cat.loc[mes])
+                    f_pr = "+".join([f"SUMIFS({rango_c(l)},{rango_c('A')},\"{mes}\",{rango_c('I')},\"PROFESIONAL\")" for l in cols_gasto])
+                    celda(ws_ra, r+3, 1, "="+f_pr, valores[0], f_num)
+                    for cidx, cat in enumerate(cats):
+                        f_pe = "+".join([f"SUMIFS({rango_c(l)},{rango_c('A')},\"{mes}\",{rango_c('H')},\"{cat}\")" for l in cols_gasto])
+                        celda(ws_ra, r+3, cidx+2, "="+f_pe, valores[cidx+1], f_num)
+                    valores.append(sum(valores))
+                    celda(ws_ra, r+3, 10, f"=SUM(B{fila}:J{fila})", valores[-1], f_num)
+                    totales = [t + v for t, v in zip(totales, valores)]
+                ws_ra.write(15,0,"TOTAL",f_tot)
+                for c in range(1,11): l=xlsxwriter.utility.xl_col_to_name(c); celda(ws_ra, 15, c, f"=SUM({l}4:{l}15)", totales[c-1], f_tot)
+
+            if data_ventas_ret is not None and len(data_ventas_ret): # Lista de dicts o el DataFrame de conciliar_ventas
+                orden_v = ["MES","FECHA","N. FACTURA","RUC","CLIENTE","DETALLE","MEMO","MONTO REEMBOLS","BASE. 0","BASE. 12 / 15","IVA","TOTAL","FECHA RET","N° RET","N° AUTORIZACIÓN","RET RENTA","RET IVA","ISD","TOTAL RET","N° NC","VALOR NC"]
+                df_v = para_exportar(data_ventas_ret, orden_v)
+                
+                ws_v = wb.add_worksheet('VENTAS')
+                for i, c in enumerate(orden_v): ws_v.write(0, i, c, f_amar if i >= 19 else f_verd if i >= 12 else f_azul)
+                _escribir_filas(ws_v, df_v, f_num, f_txt)
+                
+                ft_v = len(df_v) + 1; ws_v.write(ft_v, 0, "TOTAL", f_tot)
+                for cidx in [*range(7, 19), 20]: l = xlsxwriter.utility.xl_col_to_name(cidx); ws_v.write_formula(ft_v, cidx, f"=SUM({l}2:{l}{ft_v})", f_tot)
+
+                ws_p = wb.add_worksheet('PROYECCION')
+                ws_p.set_column('A:A', 12); ws_p.set_column('B:M', 15)
+                ws_p.merge_range('A1:D1', f"PERIODO: {datetime.now().year}", f_azul)
+                ws_p.write_row(1, 1, [*meses, "TOTAL"], f_azul)
+                
+                ventas = agregar_ventas(df_v, meses)
+                rango_v = lambda l: f"VENTAS!${l}$2:${l}${ft_v}"
+                ultima = xlsxwriter.utility.xl_col_to_name(len(meses))
+                v_ventas = [ventas[mes] for mes in meses]
+                v_compras = [profesional[mes] if profesional is not None else 0.0 for mes in meses]
+                filas = [("VENTAS", v_ventas, lambda mes, l: f"=SUMIFS({rango_v('I')},{rango_v('A')},\"{mes}\") + SUMIFS({rango_v('J')},{rango_v('A')},\"{mes}\")", f_num),
+                         ("COMPRAS", v_compras, lambda mes, l: "=" + " + ".join(f"SUMIFS({rango_c(lc)},{rango_c('A')},{l}$2,{rango_c('I')},\"PROFESIONAL\")" for lc in cols_gasto), f_num),
+                         ("TOTAL", [v - c for v, c in zip(v_ventas, v_compras)], lambda mes, l: f"={l}3-{l}4", f_tot)]
+                for r, (titulo, valores, formula, fmt) in enumerate(filas, 2):
+                    ws_p.write(r, 0, titulo, f_azul)
+                    for c, (mes, v) in enumerate(zip(meses, valores), 1):
+                        if titulo == "COMPRAS" and profesional is None: ws_p.write(r, c, 0, f_num)
+                        else: celda(ws_p, r, c, formula(mes, xlsxwriter.utility.xl_col_to_name(c)), v, fmt)
+                    celda(ws_p, r, len(meses)+1, f"=SUM(B{r+1}:{ultima}{r+1})", sum(valores), f_tot)
+
+    return output.getvalue()
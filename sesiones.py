@@ -0,0 +1,192 @@
+"""Datos pesados de las sesiones (tablas de compras, ventas y conciliación) fuera de st.session_state, con un presupuesto
+de memoria común a todo el servidor. Cuando se pasa del presupuesto, los datos de las sesiones usadas hace más tiempo
+(LRU) bajan a disco (pickle en una subcarpeta de SESIONES_DIR por proceso) y vuelven a memoria solos la próxima vez que
+se piden. Los pickle se escriben y leen fuera del lock: tocar() corre en cada rerun de cada sesión y no puede esperar
+a que otra sesión termine de bajar o subir sus datos.
+
+Streamlit no avisa cuando una pestaña se abandona: las sesiones sin actividad por SESIONES_HORAS se borran, también de
+disco. Los resultados de las descargas SRI no pasan por aquí, ya viven en disco (trabajos_sri.py)."""
+import atexit
+import itertools
+import os
+import pickle
+import shutil
+import sys
+import threading
+import time
+from collections import OrderedDict
+from metricas import METRICAS
+
+SESIONES_MAX_MB = float(os.environ.get("SESIONES_MAX_MB", "1024"))
+SESIONES_DIR = os.environ.get("SESIONES_DIR", "sesiones")
+SESIONES_HORAS = float(os.environ.get("SESIONES_HORAS", "12"))
+
+def tamano_datos(obj):
+    """Bytes que ocupa en memoria: DataFrames con sus textos y categorías, dicts por sus valores, sets de huellas por
+    sus elementos; lo demás, por su pickle"""
+    if isinstance(obj, dict): return sum(map(tamano_datos, obj.values()))
+    if isinstance(obj, (set, frozenset)): return sys.getsizeof(obj) + sum(map(sys.getsizeof, obj))
+    try: return int(obj.memory_usage(deep=True).sum())
+    except AttributeError: return len(pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL))
+
+def _borrar_archivos(rutas):
+    for ruta in rutas:
+        try: os.remove(ruta)
+        except FileNotFoundError: pass
+
+class _Sesion:
+    __slots__ = ("usuario", "ultimo", "datos", "en_disco", "saliendo", "llegando")
+    def __init__(self, usuario):
+        self.usuario, self.ultimo = usuario, time.time()
+        self.datos, self.en_disco = {}, {} # {nombre: (objeto, bytes)} · {nombre: (bytes en memoria, bytes del archivo, ruta)}
+        self.saliendo, self.llegando = {}, {} # En tránsito: bajando {nombre: (objeto, bytes, ruta)} · subiendo {nombre: Event}
+
+class DepositoSesiones:
+    """Uso: d.guardar(sesion, "ventas", df); d.obtener(sesion, "ventas") lo devuelve, desde disco si hizo falta bajarlo.
+    Las sesiones están en orden LRU; guardar, obtener y tocar mueven la sesión al final (la más reciente)"""
+    def __init__(self, max_mb=SESIONES_MAX_MB, directorio=SESIONES_DIR, horas=SESIONES_HORAS):
+        self.max_bytes, self.vida = int(max_mb * 1024 * 1024), horas * 3600
+        # Una subcarpeta por proceso: varios servidores pueden compartir SESIONES_DIR sin borrarse los archivos
+        self.directorio = os.path.join(directorio, f"proceso_{os.getpid()}")
+        self.lock = threading.Lock()
+        self.sesiones = OrderedDict() # id -> _Sesion, de la usada hace más tiempo a la más reciente
+        self.en_memoria, self.saliendo = 0, 0 # Bytes; `saliendo` es la parte de en_memoria que ya se está escribiendo
+        self._numero = itertools.count() # Cada archivo con nombre propio: uno que sobra nunca pisa a otro vigente
+        shutil.rmtree(self.directorio, ignore_errors=True) # Lo de un proceso anterior con el mismo pid
+        os.makedirs(self.directorio, exist_ok=True)
+        atexit.register(shutil.rmtree, self.directorio, True)
+
+    def _ruta(self, sesion, nombre): return os.path.join(self.directorio, f"{sesion}_{nombre}_{next(self._numero)}.pkl")
+
+    def _sesion(self, sesion, usuario=None):
+        s = self.sesiones.get(sesion)
+        if s is None: s = self.sesiones[sesion] = _Sesion(usuario)
+        s.ultimo = time.time()
+        if usuario: s.usuario = usuario
+        self.sesiones.move_to_end(sesion)
+        return s
+
+    def tocar(self, sesion, usuario=None):
+        """Marca la sesión como activa y borra las vencidas. Se llama en cada rerun; no trae nada de disco"""
+        rutas = []
+        with self.lock:
+            self._sesion(sesion, usuario)
+            limite = time.time() - self.vida
+            for id_, s in list(self.sesiones.items()):
+                if s.ultimo >= limite: break
+                rutas += self._soltar(s); del self.sesiones[id_]
+        _borrar_archivos(rutas)
+
+    def guardar(self, sesion, nombre, obj):
+        tam = tamano_datos(obj)
+        with self.lock:
+            s = self._sesion(sesion)
+            rutas = self._soltar(s, nombre)
+            s.datos[nombre] = (obj, tam); self.en_memoria += tam
+            victimas = self._ajustar(sesion)
+        _borrar_archivos(rutas)
+        self._derramar(victimas)
+
+    def obtener(self, sesion, nombre, defecto=None):
+        while True:
+            with self.lock:
+                s = self._sesion(sesion)
+                if nombre in s.datos: return s.datos[nombre][0]
+                if nombre in s.saliendo: # Se estaba bajando: vuelve sin pasar por disco y el archivo queda sobrando
+                    obj, tam, _ = s.saliendo.pop(nombre); self.saliendo -= tam
+                    s.datos[nombre] = (obj, tam)
+                    return obj
+                evento = s.llegando.get(nombre)
+                if evento is None:
+                    if nombre not in s.en_disco: return defecto
+                    entrada = s.en_disco.pop(nombre)
+                    evento = s.llegando[nombre] = threading.Event()
+                    break
+            evento.wait() # Otro rerun de la misma sesión ya lo está subiendo
+        tam, _, ruta = entrada
+        try:
+            with METRICAS.medir("sesiones_recarga_segundos"), open(ruta, "rb") as f: obj = pickle.load(f)
+        except BaseException:
+            with self.lock:
+                if s.llegando.get(nombre) is evento: del s.llegando[nombre]; s.en_disco[nombre] = entrada
+            evento.set()
+            raise
+        with self.lock:
+            vigente = s.llegando.get(nombre) is evento # Si no, se borró o se reemplazó mientras se leía
+            if vigente:
+                del s.llegando[nombre]
+                s.datos[nombre] = (obj, tam); self.en_memoria += tam
+            victimas = self._ajustar(sesion) if vigente else []
+        evento.set()
+        _borrar_archivos([ruta])
+        METRICAS.contar("sesiones_recargas_total")
+        self._derramar(victimas)
+        return obj if vigente else self.obtener(sesion, nombre, defecto)
+
+    def borrar(self, sesion):
+        """Descarta todos los datos de la sesión (nuevo informe o salida)"""
+        with self.lock:
+            s = self.sesiones.pop(sesion, None)
+            rutas = self._soltar(s) if s else []
+        _borrar_archivos(rutas)
+
+    def _soltar(self, s, nombre=None):
+        """Libera un dato de la sesión, o todos si nombre es None. Devuelve los archivos a borrar fuera del lock; los que
+        están en tránsito los borra quien los escribe o lee, al ver que ya no hacen falta"""
+        for n in [nombre] if nombre else {*s.datos, *s.saliendo, *s.llegando}:
+            if n in s.datos: self.en_memoria -= s.datos.pop(n)[1]
+            if n in s.saliendo:
+                tam = s.saliendo.pop(n)[1]; self.en_memoria -= tam; self.saliendo -= tam
+            if n in s.llegando: s.llegando.pop(n).set()
+        if nombre: return [s.en_disco.pop(nombre)[2]] if nombre in s.en_disco else []
+        rutas = [ruta for _, _, ruta in s.en_disco.values()]
+        s.en_disco.clear()
+        return rutas
+
+    def _ajustar(self, actual):
+        """Elige qué bajar a disco, de las sesiones menos recientes, hasta volver al presupuesto; la sesión `actual`
+        nunca, aunque sola se pase (la está usando alguien en este momento). Lo elegido queda en tránsito y se
+        escribe con _derramar(), ya fuera del lock"""
+        victimas = []
+        for id_, s in self.sesiones.items():
+            if self.en_memoria - self.saliendo <= self.max_bytes: break
+            if id_ == actual: continue
+            for nombre, (obj, tam) in list(s.datos.items()):
+                ruta = self._ruta(id_, nombre)
+                del s.datos[nombre]; s.saliendo[nombre] = (obj, tam, ruta); self.saliendo += tam
+                victimas.append((s, nombre, obj, tam, ruta))
+        return victimas
+
+    def _derramar(self, victimas):
+        for s, nombre, obj, tam, ruta in victimas:
+            try:
+                with METRICAS.medir("sesiones_derrame_segundos"), open(ruta + ".tmp", "wb") as f: pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(ruta + ".tmp", ruta)
+                escrito = os.path.getsize(ruta)
+            except OSError as e: # Disco lleno o sin permisos: se queda en memoria
+                METRICAS.fallo("sesiones_fallos_total", type(e).__name__, e); escrito = None
+            with self.lock:
+                vigente = nombre in s.saliendo and s.saliendo[nombre][2] == ruta
+                if vigente:
+                    del s.saliendo[nombre]; self.saliendo -= tam
+                    if escrito is None: s.datos[nombre] = (obj, tam)
+                    else: s.en_disco[nombre] = (tam, escrito, ruta); self.en_memoria -= tam
+            if not vigente or escrito is None: _borrar_archivos([ruta, ruta + ".tmp"]); continue
+            METRICAS.contar("sesiones_derrames_total"); METRICAS.contar("sesiones_derrame_bytes_total", tam)
+
+    def uso(self, sesion):
+        """(bytes en memoria, bytes en disco) de la sesión"""
+        with self.lock:
+            s = self.sesiones.get(sesion)
+            if s is None: return 0, 0
+            return self._memoria(s), sum(a for _, a, _ in s.en_disco.values())
+
+    @staticmethod
+    def _memoria(s): return sum(t for _, t in s.datos.values()) + sum(t for _, t, _ in s.saliendo.values())
+
+    def resumen(self):
+        """Una fila por sesión, de la más reciente a la menos reciente, para el panel de diagnóstico"""
+        with self.lock:
+            return [{"sesion": id_, "usuario": s.usuario, "ultimo": s.ultimo, "memoria": self._memoria(s),
+                     "disco": sum(a for _, a, _ in s.en_disco.values()), "datos": sorted({*s.datos, *s.saliendo, *s.en_disco, *s.llegando})}
+                    for id_, s in reversed(self.sesiones.items())]
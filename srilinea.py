@@ -1,561 +1,355 @@
 import streamlit as st
-import xml.etree.ElementTree as ET
 import pandas as pd
-import re
-import json
 import io
+import json
 import os
-import requests
-import zipfile
-import urllib3
+import uuid
 from datetime import datetime
-import xlsxwriter
-import time
+from motor_xml import extraer_flujo
+from comprobantes import ConjuntoDocumentos
+from clasificacion import ClasificadorProveedores
+from usuarios import DirectorioUsuarios
+from bitacora import Bitacora
+from integracion import conciliar_ventas
+from reportes import generar_excel_multiexcel
+from descarga_sri import CacheComprobantes, LecturaClaves
+from trabajos_sri import GestorTrabajos
+from almacen import TIPOS_LIBRO, AlmacenDocumentos
+from metricas import METRICAS
+from sesiones import DepositoSesiones
 
 # --- 1. CONFIGURACIÓN Y SEGURIDAD ---
 st.set_page_config(page_title="RAPIDITO AI - Portal Contable", layout="wide", page_icon="📊")
-urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
-# URLs y Headers
-URL_WS = "https://cel.sri.gob.ec/comprobantes-electronicos-ws/AutorizacionComprobantesOffline?wsdl"
-HEADERS_WS = {"Content-Type": "text/xml;charset=UTF-8","User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/121.0.0.0 Safari/537.36"}
 URL_SHEET = "https://docs.google.com/spreadsheets/d/e/2PACX-1vRrwp5uUSVg8g7SfFlNf0ETGNvpFYlsJ-161Sf6yHS7rSG_vc7JVEnTWGlIsixLRiM_tkosgXNQ0GZV/pub?output=csv"
+USUARIOS_FUENTE = os.environ.get("USUARIOS_FUENTE", URL_SHEET) # Ruta a un CSV local para pruebas o sin conexión
 
 # --- LOGGING Y SUGERENCIAS ---
+@st.cache_resource
+def obtener_bitacora():
+    return Bitacora()
+
 def registrar_actividad(usuario, accion, cantidad=None, sugerencia=None):
-    URL_PUENTE = "https://script.google.com/macros/s/AKfycbyk0CWehcUec47HTGMjqsCs0sTKa_9J3ZU_Su7aRxfwmNa76-dremthTuTPf-FswZY/exec"
-    detalle_accion = f"{accion} ({cantidad} XMLs)" if cantidad is not None else accion
-    payload = {"usuario": str(usuario), "accion": str(detalle_accion)}
-    if sugerencia: payload["sugerencia"] = str(sugerencia)
-    try: 
-        requests.post(URL_PUENTE, json=payload, timeout=8)
-        return True
-    except: return False
-
-def cargar_usuarios():
-    try:
-        df = pd.read_csv(URL_SHEET)
-        df.columns = [c.lower().strip() for c in df.columns]
-        return {str(row['usuario']).strip(): str(row['clave']).strip() for _, row in df.iterrows() if str(row['estado']).lower().strip() == 'activo'}
-    except: return {}
+    """Encola el evento y vuelve de inmediato; el envío al puente lo hace el hilo de la bitácora"""
+    return obtener_bitacora().registrar(usuario, accion, cantidad, sugerencia)
+
+@st.cache_resource
+def obtener_directorio_usuarios():
+    return DirectorioUsuarios(USUARIOS_FUENTE)
+
+@st.cache_resource
+def obtener_deposito_sesiones():
+    """Las tablas de todas las sesiones, con un presupuesto de memoria común (ver sesiones.py)"""
+    return DepositoSesiones()
+
+def reiniciar_datos_sesion():
+    """Descarta las tablas de la sesión, en memoria y en disco, y empieza conjuntos vacíos"""
+    deposito, sesion = obtener_deposito_sesiones(), st.session_state.id_sesion
+    deposito.borrar(sesion)
+    st.session_state.docs_compras = ConjuntoDocumentos(deposito, (sesion, "compras"))
+    st.session_state.docs_ventas = ConjuntoDocumentos(deposito, (sesion, "ventas"))
 
 # --- 2. SISTEMA DE LOGIN Y ESTADO ---
 if "autenticado" not in st.session_state: st.session_state.autenticado = False
 if "id_proceso" not in st.session_state: st.session_state.id_proceso = 0
-if "data_compras_cache" not in st.session_state: st.session_state.data_compras_cache = []
-if "data_ventas_cache" not in st.session_state: st.session_state.data_ventas_cache = []
+if "id_sesion" not in st.session_state: st.session_state.id_sesion = uuid.uuid4().hex
+if "docs_compras" not in st.session_state: reiniciar_datos_sesion()
 
 if not st.session_state.autenticado:
     st.sidebar.title("🔐 Acceso Clientes")
     user = st.sidebar.text_input("Usuario")
     password = st.sidebar.text_input("Contraseña", type="password")
     if st.sidebar.button("Iniciar Sesión"):
-        db = cargar_usuarios()
-        if user in db and db[user] == password:
+        if obtener_directorio_usuarios().verificar(user, password):
             st.session_state.autenticado = True
             st.session_state.usuario_actual = user
             registrar_actividad(user, "ENTRÓ AL PORTAL")
             st.rerun()
-        else: st.sidebar.error("Usuario o contraseña incorrectos.")
+        else: st.sidebar.error("Usuario o contraseña incorrectos. Si te acaban de dar de alta, intenta de nuevo en unos segundos.")
     st.stop()
 
 # --- 3. MEMORIA DE APRENDIZAJE ---
-if 'memoria' not in st.session_state:
-    archivo_memoria = "conocimiento_contable.json"
-    if os.path.exists(archivo_memoria):
-        with open(archivo_memoria, "r", encoding="utf-8") as f: st.session_state.memoria = json.load(f)
-    else: st.session_state.memoria = {"empresas": {}}
-
-def guardar_memoria():
-    with open("conocimiento_contable.json", "w", encoding="utf-8") as f: json.dump(st.session_state.memoria, f, indent=4, ensure_ascii=False)
-
-# --- HELPER: DESCOMPRIMIR ZIP Y XMLs ---
-def procesar_archivos_entrada(lista_archivos):
-    xmls_procesables = []
-    for file in lista_archivos:
-        if file.name.lower().endswith('.xml'):
-            xmls_procesables.append(io.BytesIO(file.getvalue()))
-        elif file.name.lower().endswith('.zip'):
-            try:
-                with zipfile.ZipFile(file) as z:
-                    for filename in z.namelist():
-                        if filename.lower().endswith('.xml') and not filename.startswith('__MACOSX'):
-                            xmls_procesables.append(io.BytesIO(z.read(filename)))
-            except: pass
-    return xmls_procesables
-
-# --- 4. MOTOR DE EXTRACCIÓN XML (VERSION BLINDADA V2) ---
-def extraer_datos_robusto(xml_file):
-    try:
-        if isinstance(xml_file, (io.BytesIO, io.StringIO)): xml_file.seek(0)
-        tree = ET.parse(xml_file)
-        root = tree.getroot()
-        xml_data = None
-        
-        # Desempaquetar SOAP
-        for elem in root.iter():
-            if 'comprobante' in elem.tag.lower() and elem.text and ("<" in elem.text or "&lt;" in elem.text):
-                try:
-                    clean_text = re.sub(r'<\?xml.*?\?>', '', elem.text).strip()
-                    xml_data = ET.fromstring(clean_text)
-                    break
-                except: continue
-        
-        if xml_data is None: xml_data = root
-
-        root_tag = xml_data.tag.lower()
-        if 'notacredito' in root_tag: tipo_doc = "NC"
-        elif 'comprobanteretencion' in root_tag: tipo_doc = "RET"
-        elif 'liquidacioncompra' in root_tag: tipo_doc = "LC"
-        else: tipo_doc = "FC" 
-
-        def buscar(tags):
-            for t in tags:
-                f = xml_data.find(f".//{t}")
-                if f is not None and f.text: return f.text.strip()
-            return ""
-            
-        def buscar_float(tags):
-            val_str = buscar(tags)
-            try: return float(val_str) if val_str else 0.0
-            except: return 0.0
-
-        razon_social = buscar(["razonSocial"]).upper()
-        ruc_emisor = buscar(["ruc"])
-        
-        estab = buscar(["estab"]) or "000"
-        pto = buscar(["ptoEmi"]) or "000"
-        sec = buscar(["secuencial"]) or "000000000"
-        num_fact_completo = f"{estab}-{pto}-{sec}"
-        
-        fecha_emision = buscar(["fechaEmision"])
-        num_autori = buscar(["numeroAutorizacion"]) or buscar(["claveAcceso"])
-        
-        mes_nombre = "DESCONOCIDO"
-        if "/" in fecha_emision:
-            try:
-                meses_dict = {"01":"ENERO","02":"FEBRERO","03":"MARZO","04":"ABRIL","05":"MAYO","06":"JUNIO","07":"JULIO","08":"AGOSTO","09":"SEPTIEMBRE","10":"OCTUBRE","11":"NOVIEMBRE","12":"DICIEMBRE"}
-                mes_nombre = meses_dict.get(fecha_emision.split('/')[1], "DESCONOCIDO")
-            except: pass
-
-        ruc_cliente = buscar(["identificacionComprador", "identificacionSujetoRetenido"])
-        nombre_cliente = buscar(["razonSocialComprador", "razonSocialSujetoRetenido"]).upper()
-
-        base_data = {
-            "TIPO": tipo_doc, "TIPO DE DOCUMENTO": tipo_doc,
-            "MES": mes_nombre, "FECHA": fecha_emision, "N. FACTURA": num_fact_completo, 
-            "RUC": ruc_emisor, "NOMBRE": razon_social, "N AUTORIZACION": num_autori,
-            "CONTRIBUYENTE": ruc_cliente, "RUC CLIENTE": ruc_cliente, "CLIENTE": nombre_cliente 
-        }
-
-        if tipo_doc == "RET":
-            rt_renta, rt_iva = 0.0, 0.0
-            base_renta, base_iva = 0.0, 0.0
-            sustento_formateado = ""
-            
-            doc_sus_node = xml_data.find(".//numDocSustento")
-            doc_sus_raw = doc_sus_node.text.strip() if (doc_sus_node is not None and doc_sus_node.text) else ""
-            
-            if doc_sus_raw:
-                parts = doc_sus_raw.replace('-','').strip()
-                if len(parts) >= 15: 
-                    sustento_formateado = f"{parts[0:3]}-{parts[3:6]}-{parts[6:]}"
-                elif len(doc_sus_raw.split('-')) == 3:
-                    sustento_formateado = doc_sus_raw
-
-            lista_retenciones = xml_data.findall(".//impuesto") + xml_data.findall(".//retencion")
-
-            for item in lista_retenciones:
-                cod_node = item.find("codigo")
-                cod = cod_node.text.strip() if (cod_node is not None and cod_node.text) else ""
-                
-                try:
-                    val_node = item.find("valorRetenido")
-                    val_txt = val_node.text.strip() if (val_node is not None and val_node.text) else "0"
-                    val = float(val_txt)
-                except: val = 0.0
-
-                try:
-                    base_node = item.find("baseImponible")
-                    base_txt = base_node.text.strip() if (base_node is not None and base_node.text) else "0"
-                    base = float(base_txt)
-                except: base = 0.0
-                
-                if cod == "1": # Renta
-                    rt_renta += val
-                    base_renta += base
-                elif cod == "2": # IVA
-                    rt_iva += val
-                    base_iva += base
-
-            base_data.update({
-                "ruc_recep": ruc_cliente,
-                "nomrecep": nombre_cliente,
-                "fechaemi": fecha_emision,
-                "razonsocial": razon_social,
-                "ruc_emisor": ruc_emisor,
-                "numfact": sustento_formateado, 
-                "numreten": num_fact_completo,
-                "baserenta": base_renta,
-                "rt_renta": rt_renta,
-                "baseiva": base_iva,
-                "rt_iva": rt_iva,
-                "numautori": num_autori,
-                "fecautori": buscar(["fechaAutorizacion"]) or fecha_emision,
-                "SUSTENTO": sustento_formateado,
-                "TOTAL RET": rt_renta + rt_iva
-            })
-            return base_data
-
-        else: 
-            m = -1 if tipo_doc == "NC" else 1
-            total = buscar_float(["importeTotal", "total", "valorModificado"]) * m
-            propina = buscar_float(["propina"]) * m
-            
-            base_0, base_12_15, iva_12_15 = 0.0, 0.0, 0.0
-            no_obj_iva, exento_iva = 0.0, 0.0
-            otra_base, otro_monto_iva, ice_val = 0.0, 0.0, 0.0
-            
-            for imp in xml_data.findall(".//totalImpuesto"):
-                try:
-                    cod = imp.find("codigo").text
-                    cod_por = imp.find("codigoPorcentaje").text
-                    base = float(imp.find("baseImponible").text or 0) * m
-                    valor = float(imp.find("valor").text or 0) * m
-                    
-                    if cod == "2": # IVA
-                        if cod_por == "0": base_0 += base
-                        elif cod_por in ["2", "3", "4", "8", "10"]:
-                            base_12_15 += base; iva_12_15 += valor
-                        elif cod_por == "6": no_obj_iva += base
-                        elif cod_por == "7": exento_iva += base
-                        else:
-                            otra_base += base; otro_monto_iva += valor
-                    elif cod == "3": ice_val += valor
-                    else:
-                         otra_base += base; otro_monto_iva += valor
-                except: continue 
-
-            if tipo_doc == "NC":
-                detalle_final, memo_final = "", ""
-            else:
-                info = st.session_state.memoria["empresas"].get(razon_social, {"DETALLE": "OTROS", "MEMO": "PROFESIONAL"})
-                detalle_final = info["DETALLE"]
-                memo_final = info["MEMO"]
-            
-            items = [d.find("descripcion").text for d in xml_data.findall(".//detalle") if d.find("descripcion") is not None]
-            subdetalle = " | ".join(items[:5]) if items else ""
-
-            base_data.update({
-                "DETALLE": detalle_final, "MEMO": memo_final, "SUBDETALLE": subdetalle,
-                "OTRA BASE IVA": otra_base, "OTRO IVA": otro_monto_iva, 
-                "MONTO ICE": ice_val, "PROPINAS": propina,
-                "EXENTO DE IVA": exento_iva, "NO OBJ IVA": no_obj_iva, 
-                "BASE. 0": base_0, "BASE. 12 / 15": base_12_15,
-                "IVA.": iva_12_15, "TOTAL": total
-            })
-            return base_data
-    except Exception as e:
-        print(f"Error procesando XML: {e}")
-        return None
-
-# --- 5. LÓGICA DE INTEGRACIÓN ---
-def procesar_ventas_con_retenciones(lista_datos_crudos):
-    ventas = []
-    retenciones_map = {}
-    
-    for dato in lista_datos_crudos:
-        if dato["TIPO"] == "FC": 
-            ventas.append(dato)
-        elif dato["TIPO"] == "RET" and dato.get("SUSTENTO"): 
-            retenciones_map[dato["SUSTENTO"]] = dato
-
-    ventas_integradas = []
-    for venta in ventas:
-        num_fact = venta["N. FACTURA"]
-        ret_asociada = retenciones_map.get(num_fact, {})
-        
-        fila = {
-            "MES": venta.get("MES"), "FECHA": venta.get("FECHA"), "N. FACTURA": num_fact,
-            "RUC": venta.get("RUC CLIENTE"), "CLIENTE": venta.get("CLIENTE"),
-            "DETALLE": "SERVICIOS", "MEMO": "PROFESIONAL", "MONTO REEMBOLS": 0.0,
-            "BASE. 0": venta.get("BASE. 0", 0), "BASE. 12 / 15": venta.get("BASE. 12 / 15", 0),
-            "IVA": venta.get("IVA.", 0), "TOTAL": venta.get("TOTAL", 0),
-            "FECHA RET": ret_asociada.get("fechaemi", ""), 
-            "N° RET": ret_asociada.get("numreten", ""),
-            "N° AUTORIZACIÓN": ret_asociada.get("numautori", ""),
-            "RET RENTA": ret_asociada.get("rt_renta", 0), 
-            "RET IVA": ret_asociada.get("rt_iva", 0),
-            "ISD": 0.0, 
-            "TOTAL RET": ret_asociada.get("TOTAL RET", 0)
-        }
-        ventas_integradas.append(fila)
-    return ventas_integradas
-
-# --- 6. GENERADOR MULTI-EXCEL ---
-def generar_excel_multiexcel(data_compras=None, data_ventas_ret=None, data_sri_lista=None, sri_mode=None):
-    output = io.BytesIO()
-    with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-        wb = writer.book
-        f_azul = wb.add_format({'bold':True,'align':'center','border':1,'bg_color':'#002060','font_color':'white'})
-        f_amar = wb.add_format({'bold':True,'align':'center','border':1,'bg_color':'#FFD966'})
-        f_verd = wb.add_format({'bold':True,'align':'center','border':1,'bg_color':'#92D050'})
-        f_gris = wb.add_format({'bold':True,'align':'center','border':1,'bg_color':'#F2F2F2'})
-        f_num = wb.add_format({'num_format':'_-$ * #,##0.00_-','border':1})
-        f_tot = wb.add_format({'bold':True,'num_format':'_-$ * #,##0.00_-','border':1,'bg_color':'#EFEFEF'})
-        
-        if sri_mode:
-            df = pd.DataFrame(data_sri_lista)
-            if sri_mode == "NC":
-                cols = ["NOMBRE","RUC","N AUTORIZACION","FECHA","TIPO DE DOCUMENTO","N. FACTURA","MES","RUC CLIENTE","CLIENTE","PROPINAS","BASE. 0","NO OBJ IVA","BASE. 12 / 15","IVA.","TOTAL"]
-                header_fmt = f_amar; sheet_name = "NOTAS DE CREDITO"
-            elif sri_mode == "RET":
-                cols = ["ruc_recep", "nomrecep", "fechaemi", "razonsocial", "ruc_emisor", "numfact", "numreten", "baserenta", "rt_renta", "baseiva", "rt_iva", "numautori", "fecautori"]
-                header_fmt = f_verd; sheet_name = "RETENCIONES"
-            else: 
-                cols = ["MES","FECHA","N. FACTURA","TIPO DE DOCUMENTO","RUC","CONTRIBUYENTE","NOMBRE","DETALLE","MEMO","OTRA BASE IVA","OTRO IVA","MONTO ICE","PROPINAS","EXENTO DE IVA","NO OBJ IVA","BASE. 0","BASE. 12 / 15","IVA.","TOTAL","SUBDETALLE"]
-                header_fmt = f_azul; sheet_name = "FACTURAS"
-
-            for c in cols: 
-                if c not in df.columns: df[c] = ""
-            df = df[cols]
-            
-            ws = wb.add_worksheet(sheet_name)
-            for i, c in enumerate(cols): ws.write(0, i, c, header_fmt)
-            for r, row in enumerate(df.values, 1):
-                for c, val in enumerate(row): ws.write(r, c, val, f_num if isinstance(val, (int,float)) else wb.add_format({'border':1}))
-            ws.set_column(0, len(cols)-1, 15)
-            
-        else:
-            meses = ["ENERO", "FEBRERO", "MARZO", "ABRIL", "MAYO", "JUNIO", "JULIO", "AGOSTO", "SEPTIEMBRE", "OCTUBRE", "NOVIEMBRE", "DICIEMBRE"]
-
-            if data_compras:
-                df_c = pd.DataFrame(data_compras)
-                orden_c = ["MES","FECHA","N. FACTURA","TIPO DE DOCUMENTO","RUC","CONTRIBUYENTE","NOMBRE","DETALLE","MEMO","OTRA BASE IVA","OTRO IVA","MONTO ICE","PROPINAS","EXENTO DE IVA","NO OBJ IVA","BASE. 0","BASE. 12 / 15","IVA.","TOTAL","SUBDETALLE"]
-                for c in orden_c: 
-                    if c not in df_c.columns: df_c[c] = ""
-                df_c = df_c[orden_c]
-                
-                ws_c = wb.add_worksheet('COMPRAS')
-                for i, c in enumerate(orden_c):
-                    fmt = f_amar if i in range(9, 15) else f_azul
-                    ws_c.write(0, i, c, fmt)
-                for r, row in enumerate(df_c.values, 1):
-                    for c, val in enumerate(row): ws_c.write(r, c, val, f_num if isinstance(val, (int,float)) else wb.add_format({'border':1}))
-                
-                ft = len(df_c) + 1; ws_c.write(ft, 0, "TOTAL", f_tot)
-                for cidx in range(9, 19): 
-                    l = xlsxwriter.utility.xl_col_to_name(cidx); ws_c.write_formula(ft, cidx, f"=SUM({l}2:{l}{ft})", f_tot)
-
-                ws_ra = wb.add_worksheet('REPORTE ANUAL')
-                ws_ra.set_column('A:K', 14); ws_ra.merge_range('B1:B2', "Negocios y\nServicios", f_azul)
-                cats=["VIVIENDA","SALUD","EDUCACION","ALIMENTACION","VESTIMENTA","TURISMO","NO DEDUCIBLE","SERVICIOS BASICOS"]
-                icos=["🏠","❤️","🎓","🛒","🧢","✈️","🚫","💡"]
-                for i,(ct,ic) in enumerate(zip(cats,icos)): ws_ra.write(0,i+2,ic,f_azul); ws_ra.write(1,i+2,ct.title(),f_azul)
-                ws_ra.merge_range('K1:K2',"Total Mes",f_azul); ws_ra.write('B3',"PROFESIONALES",f_gris); ws_ra.merge_range('C3:J3',"GASTOS PERSONALES",f_gris)
-                
-                cols_gasto = ["P","Q","O","N","J"] 
-                for r, mes in enumerate(meses):
-                    fila = r+4; ws_ra.write(r+3,0,mes.title(),f_num)
-                    f_pr = "+".join([f"SUMIFS('COMPRAS'!${l}:${l},'COMPRAS'!$A:$A,\"{mes}\",'COMPRAS'!$I:$I,\"PROFESIONAL\")" for l in ["P","Q","O","N","J"]])
-                    ws_ra.write_formula(r+3,1,"="+f_pr,f_num)
-                    for cidx, cat in enumerate(cats):
-                        f_pe = "+".join([f"SUMIFS('COMPRAS'!${l}:${l},'COMPRAS'!$A:$A,\"{mes}\",'COMPRAS'!$H:$H,\"{cat}\")" for l in cols_gasto])
-                        ws_ra.write_formula(r+3,cidx+2,"="+f_pe,f_num)
-                    ws_ra.write_formula(r+3,10,f"=SUM(B{fila}:J{fila})",f_num)
-                ws_ra.write(15,0,"TOTAL",f_tot)
-                for c in range(1,11): l=xlsxwriter.utility.xl_col_to_name(c); ws_ra.write_formula(15,c,f"=SUM({l}4:{l}15)",f_tot)
-
-            if data_ventas_ret:
-                df_v = pd.DataFrame(data_ventas_ret)
-                orden_v = ["MES","FECHA","N. FACTURA","RUC","CLIENTE","DETALLE","MEMO","MONTO REEMBOLS","BASE. 0","BASE. 12 / 15","IVA","TOTAL","FECHA RET","N° RET","N° AUTORIZACIÓN","RET RENTA","RET IVA","ISD","TOTAL RET"]
-                for c in orden_v: 
-                    if c not in df_v.columns: df_v[c] = ""
-                df_v = df_v[orden_v]
-                
-                ws_v = wb.add_worksheet('VENTAS')
-                for i, c in enumerate(orden_v): ws_v.write(0, i, c, f_verd if i >= 12 else f_azul)
-                for r, row in enumerate(df_v.values, 1):
-                    for c, val in enumerate(row): ws_v.write(r, c, val, f_num if isinstance(val, (int,float)) else wb.add_format({'border':1}))
-                
-                ft_v = len(df_v) + 1; ws_v.write(ft_v, 0, "TOTAL", f_tot)
-                for cidx in range(7, 19): l = xlsxwriter.utility.xl_col_to_name(cidx); ws_v.write_formula(ft_v, cidx, f"=SUM({l}2:{l}{ft_v})", f_tot)
-
-                ws_p = wb.add_worksheet('PROYECCION')
-                ws_p.set_column('A:A', 12); ws_p.set_column('B:M', 15)
-                ws_p.merge_range('A1:D1', f"PERIODO: {datetime.now().year}", f_azul)
-                for i, h in enumerate(["VENTAS", "COMPRAS", "TOTAL"]): ws_p.write(i+2, 0, h, f_azul)
-                
-                for c, mes in enumerate(meses):
-                    col = c + 1; l = xlsxwriter.utility.xl_col_to_name(col)
-                    ws_p.write(1, col, mes, f_azul)
-                    ws_p.write_formula(2, col, f"=SUMIFS(VENTAS!$I:$I,VENTAS!$A:$A,\"{mes}\") + SUMIFS(VENTAS!$J:$J,VENTAS!$A:$A,\"{mes}\")", f_num)
-                    if data_compras: ws_p.write_formula(3, col, 
-                            f"=SUMIFS('COMPRAS'!$P:$P,'COMPRAS'!$A:$A,{l}$2,'COMPRAS'!$I:$I,\"PROFESIONAL\") + "
-                            f"SUMIFS('COMPRAS'!$Q:$Q,'COMPRAS'!$A:$A,{l}$2,'COMPRAS'!$I:$I,\"PROFESIONAL\") + "
-                            f"SUMIFS('COMPRAS'!$O:$O,'COMPRAS'!$A:$A,{l}$2,'COMPRAS'!$I:$I,\"PROFESIONAL\") + "
-                            f"SUMIFS('COMPRAS'!$N:$N,'COMPRAS'!$A:$A,{l}$2,'COMPRAS'!$I:$I,\"PROFESIONAL\") + "
-                            f"SUMIFS('COMPRAS'!$J:$J,'COMPRAS'!$A:$A,{l}$2,'COMPRAS'!$I:$I,\"PROFESIONAL\")", 
-                            f_num)
-                    else: ws_p.write(3, col, 0, f_num)
-                    ws_p.write_formula(4, col, f"={l}3-{l}4", f_tot)
-                
-                lt = xlsxwriter.utility.xl_col_to_name(len(meses)+1)
-                ws_p.write(1, len(meses)+1, "TOTAL", f_azul)
-                for r in range(2,5): ws_p.write_formula(r, len(meses)+1, f"=SUM(B{r+1}:{xlsxwriter.utility.xl_col_to_name(len(meses))}{r+1})", f_tot)
-
-    return output.getvalue()
-
-# --- 7. NUEVO MOTOR DE DESCARGA PDF ---
-def descargar_pdf_publico(clave_acceso):
-    """Descarga el RIDE (PDF) usando la URL pública del SRI simulando navegador"""
-    url_pdf = f"https://srienlinea.sri.gob.ec/facturacion-internet/consultas/publico/pdf-comprobante.jsp?claveAcceso={clave_acceso}"
-    headers_browser = {
-        "User-Agent": "Mozilla/4.0 (compatible; MSIE 7.0; Windows NT 6.2; WOW64; Trident/7.0; .NET4.0C; .NET4.0E; Zoom 3.6.0)",
-        "Accept": "application/pdf,application/xhtml+xml,application/xml",
-        "Referer": "https://srienlinea.sri.gob.ec/comprobantes-electronicos-internet/publico/validezComprobantes.jsf"
-    }
-    try:
-        r = requests.get(url_pdf, headers=headers_browser, verify=False, timeout=15)
-        if r.status_code == 200 and "application/pdf" in r.headers.get("Content-Type", ""):
-            return r.content
-        return None
-    except: return None
-
-# --- 8. INTERFAZ ---
+@st.cache_resource
+def obtener_clasificador():
+    return ClasificadorProveedores()
+
+clasificador = obtener_clasificador()
+clasificador.sincronizar()
+
+# --- 4. INGESTA Y MOTOR DE EXTRACCIÓN XML: ver motor_xml.py ---
+
+# --- 5-8. INTEGRACIÓN, EXCEL Y DESCARGA SRI: ver integracion.py, reportes.py y descarga_sri.py ---
+@st.cache_resource
+def obtener_cache_sri():
+    return CacheComprobantes()
+
+@st.cache_resource
+def obtener_almacen():
+    return AlmacenDocumentos()
+
+@st.cache_resource
+def obtener_gestor_trabajos():
+    """Un único grupo de hilos de descarga para todas las sesiones"""
+    return GestorTrabajos(clasificador, obtener_cache_sri(), almacen=obtener_almacen())
+
+# --- 9. INTERFAZ ---
 st.title(f"🚀 RAPIDITO - {st.session_state.usuario_actual}")
+es_admin = st.session_state.usuario_actual == "GABRIEL"
+obtener_deposito_sesiones().tocar(st.session_state.id_sesion, st.session_state.usuario_actual)
 
 with st.sidebar:
     st.header("Menú Principal")
     if st.button("🧹 NUEVO INFORME", type="primary"):
-        st.session_state.id_proceso += 1; st.session_state.data_compras_cache = []; st.session_state.data_ventas_cache = []
+        st.session_state.id_proceso += 1; reiniciar_datos_sesion()
         st.rerun()
+    en_memoria, en_disco = obtener_deposito_sesiones().uso(st.session_state.id_sesion)
+    st.caption(f"💾 Datos de la sesión: {en_memoria / 1e6:.1f} MB en memoria" + (f" · {en_disco / 1e6:.1f} MB en disco" if en_disco else ""))
+    formulas_resumen = st.checkbox("Fórmulas auditables en resúmenes", help="REPORTE ANUAL y PROYECCION con fórmulas SUMIFS en vez de valores (el Excel abre más lento)")
+    guardar_historico = st.checkbox("Guardar en el histórico", value=True, help="Los documentos procesados quedan guardados por contribuyente y mes para informes de varios periodos sin volver a subirlos")
     st.markdown("---")
-    if st.session_state.usuario_actual == "GABRIEL":
+    if es_admin:
         st.header("Master Config")
         up_xls = st.file_uploader("Cargar Excel Maestro", type=["xlsx"], key=f"mst_{st.session_state.id_proceso}")
         if up_xls:
-            df = pd.read_excel(up_xls); df.columns = [c.upper().strip() for c in df.columns]
-            for _, r in df.iterrows():
-                nm = str(r.get("NOMBRE","")).upper().strip()
-                if nm: st.session_state.memoria["empresas"][nm] = {"DETALLE":str(r.get("DETALLE","OTROS")).upper(),"MEMO":str(r.get("MEMO","PROFESIONAL")).upper()}
-            guardar_memoria(); st.success("Memoria actualizada."); registrar_actividad(st.session_state.usuario_actual, "ACTUALIZÓ MEMORIA")
+            n = clasificador.cargar_excel_maestro(pd.read_excel(up_xls))
+            st.success(f"Memoria actualizada ({n} proveedores)."); registrar_actividad(st.session_state.usuario_actual, "ACTUALIZÓ MEMORIA")
 
     st.markdown("---")
     st.header("📬 Buzón de Sugerencias")
     sug_text = st.text_area("¿Qué podemos mejorar?", key="txt_sugerencia")
     if st.button("Enviar Sugerencia"):
         if sug_text:
-            with st.spinner("Enviando..."):
-                exito = registrar_actividad(st.session_state.usuario_actual, accion="ENVIÓ SUGERENCIA", sugerencia=sug_text)
-                time.sleep(1) 
+            exito = registrar_actividad(st.session_state.usuario_actual, accion="ENVIÓ SUGERENCIA", sugerencia=sug_text)
             if exito: st.success("¡Gracias! Tu opinión ha sido registrada.")
-            else: st.error("No se pudo enviar. Revisa tu conexión.")
+            else: st.error("No se pudo registrar la sugerencia. Inténtalo de nuevo.")
         else: st.warning("Escribe algo antes de enviar.")
 
     st.markdown("---")
     if st.button("Cerrar Sesión"):
-        registrar_actividad(st.session_state.usuario_actual, "SALIÓ"); st.session_state.autenticado = False; st.rerun()
-
-tab_xml, tab_sri = st.tabs(["📂 Subir XMLs (Manual/ZIP)", "📡 Descarga SRI (TXT)"])
+        registrar_actividad(st.session_state.usuario_actual, "SALIÓ"); st.session_state.autenticado = False; reiniciar_datos_sesion(); st.rerun()
+
+def al_pulsar(ruta):
+    """Datos diferidos para download_button: el archivo se lee recién al pulsar, en otro hilo, y no en cada rerun"""
+    def leer():
+        with open(ruta, "rb") as f: return f.read()
+    return leer
+
+def tamano(ruta):
+    return f"{os.path.getsize(ruta) / 1e6:.1f} MB"
+
+def extraer_con_progreso(ingesta):
+    """Parseo por lotes con barra de progreso; los XML que fallan u omitidos se listan en vez de descartarse en silencio"""
+    bar = st.progress(0.0, text=f"Leyendo 0/{ingesta.total_estimado} XMLs")
+    def progreso(hechos, total):
+        total = max(total, hechos, 1)
+        bar.progress(hechos / total, text=f"Leyendo {hechos}/{total} XMLs")
+    data, errores = extraer_flujo(ingesta, clasificador.memoria, progreso=progreso, total=lambda: ingesta.total_estimado)
+    errores = ingesta.errores + errores
+    bar.empty()
+    if errores:
+        with st.expander(f"⚠️ {len(errores)} XMLs no se pudieron leer"):
+            st.dataframe(pd.DataFrame(errores, columns=["ARCHIVO", "ERROR"]), width="stretch")
+    return data, errores
+
+def incorporar(docs, archivos, libro):
+    """Parsea sólo lo que la sesión aún no tiene y lo acumula; los repetidos se listan en vez de contarse dos veces.
+    Si la memoria de proveedores cambió, lo ya acumulado se reclasifica antes (sus archivos no se vuelven a parsear)"""
+    reclasificados = docs.reclasificar(clasificador.memoria, clasificador.revision)
+    resultados, errores = extraer_con_progreso(docs.preparar(archivos))
+    nuevos = docs.agregar(resultados)
+    texto = f"{len(nuevos)} documentos nuevos · {len(docs.registros)} acumulados en la sesión"
+    if reclasificados: texto += f" · {reclasificados} reclasificados con la memoria actual"
+    if guardar_historico and nuevos:
+        guardados, omitidos = obtener_almacen().guardar(nuevos, libro, st.session_state.usuario_actual)
+        texto += f" · {guardados} guardados en el histórico"
+        if omitidos: texto += f" ({omitidos} no: de otro tipo o sin RUC/fecha válidos)"
+    st.caption(texto)
+    if docs.duplicados:
+        with st.expander(f"♻️ {len(docs.duplicados)} repetidos no se volvieron a contar"):
+            st.dataframe(pd.DataFrame(docs.duplicados, columns=["ARCHIVO", "MOTIVO"]), width="stretch")
+    return docs.registros
+
+def compras_de(docs):
+    """FC y NC de la tabla de compras de la sesión (un filtro sobre la tabla, sin otra copia guardada en la sesión)"""
+    t = docs.registros
+    return t[t["TIPO"].isin(TIPOS_LIBRO["COMPRAS"])]
+
+tab_xml, tab_sri, tab_hist, *tab_diag = st.tabs(["📂 Subir XMLs (Manual/ZIP)", "📡 Descarga SRI (TXT)", "🗄️ Histórico"] + (["🩺 Diagnóstico"] if es_admin else []))
 
 with tab_xml:
     st1, st2, st3 = st.tabs(["🛒 Compras y NC", "💰 Ventas y Retenciones", "📑 Informe Integral"])
     with st1:
         up_c = st.file_uploader("Subir Compras/NC (XML o ZIP)", type=["xml", "zip"], accept_multiple_files=True, key=f"c_{st.session_state.id_proceso}")
         if up_c and st.button("Procesar Compras"):
-            xmls_reales = procesar_archivos_entrada(up_c)
-            data = [extraer_datos_robusto(x) for x in xmls_reales]; data = [d for d in data if d and d["TIPO"] in ["FC","NC"]]
-            if data:
-                st.session_state.data_compras_cache = data
+            incorporar(st.session_state.docs_compras, up_c, "COMPRAS")
+            data = compras_de(st.session_state.docs_compras)
+            if len(data):
                 registrar_actividad(st.session_state.usuario_actual, "GENERÓ REPORTE COMPRAS", len(data))
-                st.download_button("📥 Reporte Compras", generar_excel_multiexcel(data_compras=data), f"C_{datetime.now().strftime('%H%M')}.xlsx")
+                st.download_button("📥 Reporte Compras", generar_excel_multiexcel(data_compras=data, formulas_resumen=formulas_resumen), f"C_{datetime.now().strftime('%H%M')}.xlsx")
             else: st.warning("No se encontraron XMLs válidos en los archivos subidos.")
             
     with st2:
         up_v = st.file_uploader("Subir Ventas/Ret (XML o ZIP)", type=["xml", "zip"], accept_multiple_files=True, key=f"v_{st.session_state.id_proceso}")
         if up_v and st.button("Procesar Ventas"):
-            xmls_reales = procesar_archivos_entrada(up_v)
-            data = [extraer_datos_robusto(x) for x in xmls_reales]; data = [d for d in data if d]
-            if data:
-                res = procesar_ventas_con_retenciones(data)
-                st.session_state.data_ventas_cache = res
+            data = incorporar(st.session_state.docs_ventas, up_v, "VENTAS")
+            if len(data):
+                res, ret_sueltas, nc_sueltas = conciliar_ventas(data)
+                obtener_deposito_sesiones().guardar(st.session_state.id_sesion, "conciliacion", res)
+                st.caption(f"{(res['N° RET'] != '').sum()} de {len(res)} facturas con retención · {(res['N° NC'] != '').sum()} con nota de crédito")
+                for sueltas, titulo in ((ret_sueltas, "retenciones sin factura"), (nc_sueltas, "notas de crédito sin factura")):
+                    if len(sueltas):
+                        with st.expander(f"⚠️ {len(sueltas)} {titulo}"):
+                            st.dataframe(sueltas.reindex(columns=["FECHA", "N. FACTURA", "RUC", "NOMBRE", "SUSTENTO", "DOC MODIFICADO", "TOTAL RET", "TOTAL"]).dropna(axis=1, how="all"), width="stretch")
                 registrar_actividad(st.session_state.usuario_actual, "GENERÓ REPORTE VENTAS", len(res))
-                st.download_button("📥 Reporte Ventas", generar_excel_multiexcel(data_ventas_ret=res), f"V_{datetime.now().strftime('%H%M')}.xlsx")
+                st.download_button("📥 Reporte Ventas", generar_excel_multiexcel(data_ventas_ret=res, formulas_resumen=formulas_resumen), f"V_{datetime.now().strftime('%H%M')}.xlsx")
             else: st.warning("No se encontraron XMLs válidos.")
             
     with st3:
         if st.button("Generar Informe Integral"):
-            if st.session_state.data_compras_cache and st.session_state.data_ventas_cache:
+            compras = compras_de(st.session_state.docs_compras)
+            ventas = obtener_deposito_sesiones().obtener(st.session_state.id_sesion, "conciliacion") # Desde disco si la sesión estuvo inactiva
+            if len(compras) and ventas is not None and len(ventas):
                 registrar_actividad(st.session_state.usuario_actual, "GENERÓ INFORME INTEGRAL")
-                st.download_button("📥 INFORME INTEGRAL", generar_excel_multiexcel(st.session_state.data_compras_cache, st.session_state.data_ventas_cache), f"INT_{datetime.now().strftime('%H%M')}.xlsx")
+                st.download_button("📥 INFORME INTEGRAL", generar_excel_multiexcel(compras, ventas, formulas_resumen=formulas_resumen), f"INT_{datetime.now().strftime('%H%M')}.xlsx")
             else: st.warning("Procese Compras y Ventas primero.")
 
-# BLOQUE SRI ACTUALIZADO CON PDFs
+# BLOQUE SRI: la descarga corre como trabajo en segundo plano (trabajos_sri.py); la pestaña sólo lo muestra
 with tab_sri:
+    @st.fragment(run_every=2)
+    def avance_trabajo(id_trabajo):
+        gestor = obtener_gestor_trabajos()
+        t = gestor.trabajos[id_trabajo]
+        if not t.activo: st.rerun() # Terminó: se redibuja la página completa con las descargas
+        hechos = t.hechos("xml") + (t.hechos("pdf") if t.meta["pdf"] else 0)
+        st.progress(hechos / (t.total * len(t.etapas)) if t.total else 1.0)
+        texto = f"XML {t.hechos('xml')}/{t.total}"
+        if t.meta["pdf"]: texto += f" · PDF {t.hechos('pdf')}/{t.total}"
+        st.text(texto + " · puede cerrar o recargar la página, la descarga sigue")
+        if st.button("⏹ Cancelar", key=f"cancelar_{id_trabajo}"): gestor.cancelar(id_trabajo)
+
+    def resultado_trabajo(t, titulo):
+        st.text(f"{t.situacion} · " + " · ".join(f"{k}: {v}" for k, v in t.resumen("xml").most_common()) + f" · con reintentos: {t.reintentados['xml']}")
+        fallidas = t.fallidas("xml")
+        if fallidas:
+            with st.expander(f"⚠️ {len(fallidas)} claves sin XML"):
+                st.dataframe(pd.DataFrame({"CLAVE": list(fallidas), "ESTADO": list(fallidas.values())}), width="stretch")
+        if t.meta["pdf"]: st.caption(f"📄 PDFs: {t.resumen('pdf')['OK']} descargados · {t.reintentados['pdf']} con reintentos · {len(t.fallidas('pdf'))} fallidos")
+        if t.meta.get("error"): st.error(f"No se pudo armar el resultado: {t.meta['error']}")
+        if t.meta.get("historico_omitidos"): st.warning(f"{t.meta['historico_omitidos']} documentos no se guardaron en el histórico (de otro tipo o sin RUC/fecha válidos)")
+        if t.situacion != "TERMINADO" and st.button("🔁 Reanudar (sólo lo que falta)", key=f"reanudar_{t.id}"):
+            obtener_gestor_trabajos().reanudar(t.id); st.rerun()
+
+        if t.meta.get("documentos"):
+            st.success(f"✅ Proceso Finalizado.")
+            col1, col2, col3 = st.columns(3)
+            with col1:
+                st.download_button(f"📦 XMLs {titulo} ({tamano(t.ruta_archivo('XML.zip'))})", al_pulsar(t.ruta_archivo("XML.zip")), f"{titulo}_XML.zip", "application/zip")
+            with col2:
+                st.download_button(f"📊 Excel {titulo}", al_pulsar(t.ruta_archivo("reporte.xlsx")), f"{titulo}.xlsx")
+            with col3:
+                if t.meta["pdf"] and t.resumen("pdf")["OK"]:
+                    st.download_button(f"📄 PDFs {titulo} ({tamano(t.ruta_archivo('PDF.zip'))})", al_pulsar(t.ruta_archivo("PDF.zip")), f"{titulo}_PDF.zip", "application/zip")
+                elif t.meta["pdf"]: st.warning("No se bajaron PDFs")
+        elif "fin" in t.meta: st.warning("No se encontraron documentos válidos.")
+
     def bloque_sri(titulo, tipo_filtro, key):
         st.subheader(titulo)
+        gestor = obtener_gestor_trabajos()
         c1, c2 = st.columns([3, 1])
         with c1: up = st.file_uploader(f"TXT {titulo}", type=["txt"], key=key)
         with c2: 
             st.write("")
             st.write("")
-            descargar_pdfs = st.checkbox("Incluir PDFs", key=f"chk_{key}", help="Más lento")
+            descargar_pdfs = st.checkbox("Incluir PDFs", key=f"chk_{key}", help="Se descargan en paralelo a los XML")
 
         if up and st.button(f"Descargar {titulo}", key=f"b_{key}"):
-            try: content = up.read().decode("latin-1")
-            except: content = up.read().decode("utf-8", errors="ignore")
-            claves = list(dict.fromkeys(re.findall(r'\d{49}', content)))
-            
-            if claves:
-                registrar_actividad(st.session_state.usuario_actual, f"INICIÓ DESCARGA SRI {titulo}", len(claves))
-                bar = st.progress(0); status = st.empty(); lst = []
-                
-                zip_buffer_xml = io.BytesIO()
-                zip_buffer_pdf = io.BytesIO()
-                count_xml, count_pdf = 0, 0
-                
-                with zipfile.ZipFile(zip_buffer_xml, "a", zipfile.ZIP_DEFLATED) as zf_xml:
-                    zf_pdf = zipfile.ZipFile(zip_buffer_pdf, "a", zipfile.ZIP_DEFLATED) if descargar_pdfs else None
-                    
-                    for i, cl in enumerate(claves):
-                        status.text(f"Procesando {i+1}/{len(claves)}: {cl[-8:]}")
-                        # 1. XML
-                        try:
-                            soap_body = f'<soapenv:Envelope xmlns:soapenv="http://schemas.xmlsoap.org/soap/envelope/" xmlns:ec="http://ec.gob.sri.ws.autorizacion"><soapenv:Body><ec:autorizacionComprobante><claveAccesoComprobante>{cl}</claveAccesoComprobante></ec:autorizacionComprobante></soapenv:Body></soapenv:Envelope>'
-                            r = requests.post(URL_WS, data=soap_body, headers=HEADERS_WS, verify=False, timeout=5)
-                            if r.status_code==200 and "<autorizaciones>" in r.text: 
-                                zf_xml.writestr(f"{cl}.xml", r.text)
-                                count_xml += 1
-                                d = extraer_datos_robusto(io.BytesIO(r.content))
-                                if d:
-                                    if tipo_filtro == "RET" and d["TIPO"] == "RET": lst.append(d)
-                                    elif tipo_filtro == "NC" and d["TIPO"] == "NC": lst.append(d)
-                                    elif tipo_filtro == "FC" and d["TIPO"] in ["FC","LC"]: lst.append(d)
-                        except: pass
-
-                        # 2. PDF
-                        if descargar_pdfs:
-                            pdf = descargar_pdf_publico(cl)
-                            if pdf:
-                                zf_pdf.writestr(f"{cl}.pdf", pdf)
-                                count_pdf += 1
-                            time.sleep(0.5) # Pausa seguridad
-                        bar.progress((i+1)/len(claves))
-                    
-                    if zf_pdf: zf_pdf.close()
-
-                if lst: 
-                    st.success(f"✅ Proceso Finalizado.")
-                    col1, col2, col3 = st.columns(3)
-                    with col1: st.download_button(f"📦 XMLs {titulo}", zip_buffer_xml.getvalue(), f"{titulo}_XML.zip")
-                    with col2: st.download_button(f"📊 Excel {titulo}", generar_excel_multiexcel(data_sri_lista=lst, sri_mode=tipo_filtro), f"{titulo}.xlsx")
-                    with col3:
-                        if descargar_pdfs and count_pdf > 0: st.download_button(f"📄 PDFs {titulo}", zip_buffer_pdf.getvalue(), f"{titulo}_PDF.zip")
-                        elif descargar_pdfs: st.warning("No se bajaron PDFs")
-                else: st.warning("No se encontraron documentos válidos.")
+            txt = io.TextIOWrapper(up, encoding="latin-1")
+            lectura = LecturaClaves(tipo_filtro).leer(txt, up.name)
+            txt.detach() # Que al liberarse no cierre el archivo subido
+            if lectura.invalidas:
+                with st.expander(f"⚠️ {len(lectura.invalidas)} claves inválidas (no se consultan)"):
+                    st.dataframe(pd.DataFrame(lectura.invalidas, columns=["ARCHIVO", "LÍNEA", "CLAVE", "MOTIVO"]), width="stretch")
+            if lectura.claves:
+                registrar_actividad(st.session_state.usuario_actual, f"INICIÓ DESCARGA SRI {titulo}", len(lectura.claves))
+                gestor.crear(st.session_state.usuario_actual, titulo, tipo_filtro, lectura.claves, descargar_pdfs, lectura=lectura.resumen(), historico=guardar_historico)
+            else: st.warning(f"El TXT no tiene claves válidas de {titulo.lower()}: {lectura.resumen()}")
+
+        t = gestor.ultimo(st.session_state.usuario_actual, tipo_filtro) # Tras un rerun o una recarga se retoma el último trabajo
+        if t is None: return
+        st.caption(f"Trabajo {t.id} · {t.meta.get('lectura') or f'{t.total} claves'}")
+        if t.activo: avance_trabajo(t.id)
+        else: resultado_trabajo(t, titulo)
 
     s1, s2, s3 = st.tabs(["Facturas", "Notas Crédito", "Retenciones"])
     with s1: bloque_sri("Facturas Recibidas", "FC", "sri_fc")
     with s2: bloque_sri("Notas de Crédito", "NC", "sri_nc")
     with s3: bloque_sri("Retenciones", "RET", "sri_ret")
+
+# --- 10. HISTÓRICO POR CONTRIBUYENTE: ver almacen.py ---
+with tab_hist:
+    almacen = obtener_almacen()
+    contribuyentes = almacen.contribuyentes(None if es_admin else st.session_state.usuario_actual)
+    if not contribuyentes: st.info("Todavía no hay documentos guardados. Se guardan al procesar compras, ventas o descargas del SRI con la opción «Guardar en el histórico».")
+    else:
+        ruc, nombre = st.selectbox("Contribuyente", contribuyentes, format_func=lambda c: f"{c[1]} ({c[0]})")
+        resumen = pd.DataFrame(almacen.periodos(ruc), columns=["PERIODO", "LIBRO", "DOCUMENTOS"])
+        st.dataframe(resumen.pivot(index="PERIODO", columns="LIBRO", values="DOCUMENTOS").fillna(0).astype(int), width="stretch")
+        periodos = list(dict.fromkeys(resumen["PERIODO"]))
+        desde, hasta = st.select_slider("Periodo", options=periodos, value=(periodos[max(0, len(periodos) - 12)], periodos[-1])) if len(periodos) > 1 else (periodos[0], periodos[0])
+        if (int(hasta[:4]) - int(desde[:4])) * 12 + int(hasta[5:]) - int(desde[5:]) >= 12:
+            st.warning("El REPORTE ANUAL agrupa por nombre de mes: con más de 12 meses se suman meses de años distintos.")
+        if st.button("Generar informe del periodo"):
+            compras = almacen.consultar(ruc, "COMPRAS", desde, hasta)
+            ventas = almacen.consultar(ruc, "VENTAS", desde, hasta)
+            ventas = conciliar_ventas(ventas)[0] if ventas else None
+            registrar_actividad(st.session_state.usuario_actual, f"GENERÓ INFORME HISTÓRICO {desde} A {hasta}", len(compras) + (len(ventas) if ventas is not None else 0))
+            st.download_button("📥 Informe del periodo", generar_excel_multiexcel(compras or None, ventas, formulas_resumen=formulas_resumen), f"{ruc}_{desde}_{hasta}.xlsx")
+        with st.expander("🗑️ Borrar del histórico"):
+            st.caption("Para corregir un mes: se borra aquí el periodo elegido arriba y se vuelven a procesar sus XML con «Guardar en el histórico».")
+            libro_borrar = st.radio("Libro", ["COMPRAS y VENTAS", "COMPRAS", "VENTAS"], horizontal=True)
+            confirmar = st.checkbox(f"Borrar {libro_borrar} de {nombre}, {desde} a {hasta}")
+            if st.button("Borrar", disabled=not confirmar):
+                n = almacen.borrar(ruc, None if libro_borrar == "COMPRAS y VENTAS" else libro_borrar, desde, hasta)
+                registrar_actividad(st.session_state.usuario_actual, f"BORRÓ HISTÓRICO {ruc} {libro_borrar} {desde} A {hasta}", n)
+                st.toast(f"{n} documentos borrados del histórico"); st.rerun()
+
+# --- 11. DIAGNÓSTICO (SÓLO ADMIN): ver metricas.py ---
+if tab_diag:
+    with tab_diag[0]:
+        snap = METRICAS.instantanea()
+        if not snap["activas"]: st.info("Métricas apagadas (variable de entorno METRICAS=0).")
+        ms = lambda s: None if s is None else round(s * 1000, 2)
+        st.caption(f"Acumulado desde {datetime.fromtimestamp(snap['desde']).strftime('%d/%m/%Y %H:%M:%S')} en este servidor")
+
+        activos = list(obtener_gestor_trabajos().activos)
+        if activos:
+            st.subheader("Descargas SRI en curso")
+            st.dataframe(pd.DataFrame([{"TRABAJO": t.id, "USUARIO": t.meta["usuario"], "TIPO": t.meta["tipo"], "XML": f"{t.hechos('xml')}/{t.total}",
+                                        "PDF": f"{t.hechos('pdf')}/{t.total}" if t.meta["pdf"] else ""} for t in activos]), width="stretch")
+        deposito = obtener_deposito_sesiones()
+        sesiones = deposito.resumen()
+        if sesiones:
+            st.subheader("Sesiones")
+            st.caption(f"{deposito.en_memoria / 1e6:.1f} de {deposito.max_bytes / 1e6:.0f} MB en memoria · lo menos usado baja a disco al pasarse")
+            st.dataframe(pd.DataFrame([{"USUARIO": s["usuario"], "ÚLTIMO USO": datetime.fromtimestamp(s["ultimo"]).strftime("%H:%M:%S"),
+                                        "MEMORIA MB": round(s["memoria"] / 1e6, 1), "DISCO MB": round(s["disco"] / 1e6, 1), "DATOS": ", ".join(s["datos"])}
+                                       for s in sesiones]), width="stretch")
+        if snap["histogramas"]:
+            st.subheader("Tiempos")
+            st.dataframe(pd.DataFrame([{"MÉTRICA": h["nombre"], "ETIQUETAS": " ".join(f"{k}={v}" for k, v in h["etiquetas"].items()), "N": h["n"],
+                                        "TOTAL s": round(h["suma"], 3), "MEDIA ms": ms(h["media"]), "P50 ms": ms(h["p50"]), "P95 ms": ms(h["p95"]), "P99 ms": ms(h["p99"])}
+                                       for h in snap["histogramas"]]), width="stretch")
+        if snap["contadores"]:
+            st.subheader("Contadores")
+            st.dataframe(pd.DataFrame([{"MÉTRICA": c["nombre"], "ETIQUETAS": " ".join(f"{k}={v}" for k, v in c["etiquetas"].items()), "VALOR": c["valor"]}
+                                       for c in snap["contadores"]]), width="stretch")
+        if snap["fallas"]:
+            st.subheader("Últimas fallas")
+            st.dataframe(pd.DataFrame([{"HORA": datetime.fromtimestamp(f["hora"]).strftime("%H:%M:%S"), "MÉTRICA": f["nombre"], "MOTIVO": f["motivo"], "DETALLE": f["detalle"]}
+                                       for f in reversed(snap["fallas"])]), width="stretch")
+
+        col1, col2, col3 = st.columns(3)
+        with col1: st.download_button("⬇️ JSON", json.dumps(snap, ensure_ascii=False, indent=2), f"metricas_{datetime.now().strftime('%Y%m%d_%H%M')}.json", "application/json")
+        with col2: st.download_button("⬇️ Prometheus", METRICAS.a_prometheus(), "metricas.prom", "text/plain")
+        with col3:
+            if st.button("♻️ Reiniciar métricas"): METRICAS.reiniciar(); st.rerun()
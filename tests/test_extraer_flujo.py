@@ -0,0 +1,39 @@
+"""El parseo en paralelo tiene que funcionar dentro de la app: bajo Streamlit, __main__ es srilinea.py (sin guarda
+__name__ == "__main__"), y un pool que vuelva a ejecutar __main__ en cada trabajador se rompe. Además tiene que
+activarse aunque los XML lleguen dentro de ZIP anidados, que la ingesta recién cuenta al abrirlos"""
+import os
+import sys
+import types
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [RAIZ, os.path.join(RAIZ, "benchmarks")]
+import motor_xml
+from generador import escribir_zip, generar
+
+def test_paralelo_con_main_de_streamlit(tmp_path, monkeypatch):
+    script = tmp_path / "pagina.py"
+    script.write_text("raise AttributeError('st.session_state has no attribute \"usuario_actual\"')\n", encoding="utf-8")
+    principal = types.ModuleType("__main__") # Como lo arma Streamlit: módulo nuevo con __file__ y sin __spec__
+    principal.__file__ = str(script)
+    monkeypatch.setitem(sys.modules, "__main__", principal)
+    items = list(generar(motor_xml.XML_MIN_PARALELO, soap=0.3, semilla=1))
+    resultados, errores = motor_xml.extraer_flujo(items, {"empresas": {}, "rucs": {}}, procesos=2, tam_bloque=50, total=len(items))
+    assert not errores
+    assert len(resultados) == len(items) and all(resultados)
+
+def test_zip_anidado_activa_el_pool(monkeypatch):
+    pools = []
+    class Pool(motor_xml.ProcessPoolExecutor):
+        def __init__(self, *args, **kwargs):
+            pools.append(self); super().__init__(*args, **kwargs)
+    monkeypatch.setattr(motor_xml, "ProcessPoolExecutor", Pool)
+    n = motor_xml.XML_MIN_PARALELO
+    externo = escribir_zip(None, [("interno.zip", escribir_zip(None, generar(n, semilla=2)).getvalue())])
+    externo.name = "lote.zip"; externo.seek(0)
+    ingesta = motor_xml.IngestaXML([externo])
+    assert ingesta.total_estimado == 0 # El ZIP interno se cuenta recién al abrirlo
+    avance = []
+    resultados, errores = motor_xml.extraer_flujo(ingesta, {"empresas": {}, "rucs": {}}, procesos=2, tam_bloque=50,
+                                                  progreso=lambda hechos, total: avance.append((hechos, total)), total=lambda: ingesta.total_estimado)
+    assert pools and not errores and not ingesta.errores
+    assert len(resultados) == n and all(resultados)
+    assert avance[-1] == (n, n)
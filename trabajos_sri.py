@@ -0,0 +1,271 @@
+"""Descargas del SRI como trabajos en segundo plano, fuera del ciclo de reruns de Streamlit.
+
+Cada trabajo vive en TRABAJOS_SRI_DIR/<id>/:
+    trabajo.json    parámetros (usuario, tipo, claves, PDF e histórico sí/no, resumen del TXT) y la hora de fin cuando terminó
+    avance.jsonl    punto de control: una línea por clave y etapa (xml/pdf); si una clave aparece varias veces manda la última
+    xml/ y pdf/     lo ya descargado, un archivo por clave
+    XML.zip, PDF.zip, reporte.xlsx   se arman al terminar
+
+Una recarga del navegador no lo interrumpe, y si se cae el servidor el trabajo se reanuda al volver pidiendo sólo lo
+que falta. Un trabajo que terminó con fallas se puede reanudar igual, y también sólo reintenta las claves pendientes."""
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+import zipfile
+from collections import Counter, deque
+from descarga_sri import (PDF_MAX_HILOS, SRI_MAX_HILOS, SRI_MAX_RPS, TIPOS_SRI, LimitadorTasa, ThrottleAdaptativo,
+                          consultar_autorizacion, crear_sesion_http, descargar_pdf, opciones_zip, parsear_respuesta)
+from metricas import METRICAS
+from reportes import generar_excel_multiexcel
+
+TRABAJOS_SRI_DIR = os.environ.get("TRABAJOS_SRI_DIR", "trabajos_sri")
+TRABAJOS_SRI_DIAS = float(os.environ.get("TRABAJOS_SRI_DIAS", "7")) # Los terminados hace más de esto se borran al arrancar
+ESTADOS_OK = {"xml": ("OK", "CACHE"), "pdf": ("OK",)}
+
+def _escribir_atomico(ruta, datos):
+    tmp = ruta + ".tmp"
+    with open(tmp, "wb") as f: f.write(datos)
+    os.replace(tmp, ruta)
+
+class TrabajoSRI:
+    """Estado de un trabajo. En memoria sólo se guardan los estados por clave; XML, PDF y registros quedan en disco"""
+    def __init__(self, ruta):
+        self.ruta = ruta
+        with open(os.path.join(ruta, "trabajo.json"), "r", encoding="utf-8") as f: self.meta = json.load(f)
+        self.id = self.meta["id"]
+        self.lock = threading.Lock()
+        self.estados = {"xml": {}, "pdf": {}} # {etapa: {clave: estado}}
+        self.reintentados = {"xml": 0, "pdf": 0} # Claves que necesitaron más de un intento
+        self.pendientes = {"xml": deque(), "pdf": deque()}
+        self.en_curso = 0
+        self.activo = False
+        self._avance = None
+        for linea in self._leer_avance():
+            self.estados[linea["etapa"]][linea["clave"]] = linea["estado"]
+            if linea.get("intentos", 0) > 1: self.reintentados[linea["etapa"]] += 1
+
+    @property
+    def total(self): return len(self.meta["claves"])
+
+    @property
+    def etapas(self): return ("xml", "pdf") if self.meta["pdf"] else ("xml",)
+
+    @property
+    def situacion(self):
+        if self.activo: return "EN CURSO"
+        if "fin" not in self.meta: return "INTERRUMPIDO"
+        if self.meta.get("cancelado"): return "CANCELADO"
+        return "CON FALLAS" if any(self.fallidas(e) for e in self.etapas) else "TERMINADO"
+
+    def ruta_archivo(self, nombre): return os.path.join(self.ruta, nombre)
+
+    def guardar_meta(self):
+        _escribir_atomico(self.ruta_archivo("trabajo.json"), json.dumps(self.meta, ensure_ascii=False).encode("utf-8"))
+
+    def _leer_avance(self):
+        try:
+            with open(self.ruta_archivo("avance.jsonl"), "r", encoding="utf-8") as f:
+                for linea in f:
+                    try: yield json.loads(linea)
+                    except ValueError: continue # Última línea a medio escribir si el proceso murió
+        except FileNotFoundError: return
+
+    def faltantes(self, etapa):
+        ok = ESTADOS_OK[etapa]
+        return [cl for cl in self.meta["claves"] if self.estados[etapa].get(cl) not in ok]
+
+    def fallidas(self, etapa):
+        ok = ESTADOS_OK[etapa]
+        return {cl: e for cl, e in self.estados[etapa].items() if e not in ok}
+
+    def hechos(self, etapa): return len(self.estados[etapa])
+
+    def resumen(self, etapa): return Counter(self.estados[etapa].values())
+
+    def guardar_descarga(self, etapa, clave, contenido):
+        _escribir_atomico(os.path.join(self.ruta, etapa, f"{clave}.{etapa}"), contenido)
+
+    def anotar(self, clave, etapa, estado, intentos=0, registro=None):
+        """Punto de control de una clave: el archivo descargado ya está en disco cuando se escribe esta línea"""
+        linea = {"clave": clave, "etapa": etapa, "estado": estado, "intentos": intentos}
+        if registro: linea["registro"] = registro
+        linea = json.dumps(linea, ensure_ascii=False) + "\n"
+        with self.lock:
+            if self._avance is None: self._avance = open(self.ruta_archivo("avance.jsonl"), "a", encoding="utf-8")
+            self._avance.write(linea); self._avance.flush()
+            self.estados[etapa][clave] = estado
+            if intentos > 1: self.reintentados[etapa] += 1
+
+    def registros(self):
+        """Registros parseados del tipo del trabajo, en el orden del TXT"""
+        por_clave = {}
+        for linea in self._leer_avance():
+            if linea["etapa"] == "xml" and "registro" in linea: por_clave[linea["clave"]] = linea["registro"]
+        tipos = TIPOS_SRI[self.meta["tipo"]]
+        return [d for d in map(por_clave.get, self.meta["claves"]) if d and d["TIPO"] in tipos]
+
+    @METRICAS.cronometrado("etapa_segundos", etapa="zip")
+    def empaquetar(self, etapa, destino):
+        """Arma el ZIP en disco leyendo cada archivo por partes (nunca entero en memoria) y lo publica al final con un
+        rename, para que la UI no sirva un ZIP a medio escribir"""
+        ok, opciones = ESTADOS_OK[etapa], opciones_zip(f".{etapa}")
+        with zipfile.ZipFile(destino + ".tmp", "w") as zf:
+            for cl in self.meta["claves"]:
+                if self.estados[etapa].get(cl) in ok: zf.write(os.path.join(self.ruta, etapa, f"{cl}.{etapa}"), f"{cl}.{etapa}", **opciones)
+        os.replace(destino + ".tmp", destino)
+
+    def cerrar(self):
+        with self.lock:
+            if self._avance: self._avance.close(); self._avance = None
+
+class GestorTrabajos:
+    """Un solo grupo de hilos (XML y PDF) para los trabajos de todos los usuarios. Los hilos toman claves de los trabajos
+    activos por turnos, así un lote grande no deja esperando a los demás, y todos comparten el tope de peticiones al WS"""
+    def __init__(self, clasificador, cache=None, directorio=TRABAJOS_SRI_DIR, max_hilos=SRI_MAX_HILOS, rps=SRI_MAX_RPS, hilos_pdf=PDF_MAX_HILOS, almacen=None):
+        self.clasificador, self.cache, self.directorio, self.almacen = clasificador, cache, directorio, almacen
+        self.limitador, self.throttle_pdf = LimitadorTasa(rps), ThrottleAdaptativo()
+        self.sesion, self.sesion_pdf = crear_sesion_http(max_hilos), crear_sesion_http(hilos_pdf)
+        self.cond = threading.Condition()
+        self.trabajos, self.activos = {}, []
+        self.turno = {"xml": 0, "pdf": 0}
+        os.makedirs(directorio, exist_ok=True)
+        self._cargar_existentes()
+        for etapa, n in (("xml", max_hilos), ("pdf", hilos_pdf)):
+            for _ in range(n): threading.Thread(target=self._trabajar, args=(etapa,), daemon=True).start()
+        for t in list(self.trabajos.values()):
+            if "fin" not in t.meta: self._activar(t) # El servidor se cayó con este trabajo en curso
+
+    def _cargar_existentes(self):
+        limite = time.time() - TRABAJOS_SRI_DIAS * 86400
+        for nombre in os.listdir(self.directorio):
+            ruta = os.path.join(self.directorio, nombre)
+            try: t = TrabajoSRI(ruta)
+            except (OSError, ValueError, KeyError): continue
+            if t.meta.get("fin", limite + 1) < limite: shutil.rmtree(ruta, ignore_errors=True)
+            else: self.trabajos[t.id] = t
+
+    def crear(self, usuario, titulo, tipo, claves, pdf=False, lectura="", historico=True):
+        id_trabajo = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:6]}"
+        ruta = os.path.join(self.directorio, id_trabajo)
+        for sub in ("xml", "pdf"): os.makedirs(os.path.join(ruta, sub))
+        meta = {"id": id_trabajo, "usuario": usuario, "titulo": titulo, "tipo": tipo, "pdf": bool(pdf), "claves": list(claves), "lectura": lectura, "historico": historico, "creado": time.time()}
+        _escribir_atomico(os.path.join(ruta, "trabajo.json"), json.dumps(meta, ensure_ascii=False).encode("utf-8"))
+        t = TrabajoSRI(ruta)
+        with self.cond: self.trabajos[t.id] = t
+        self._activar(t)
+        return t
+
+    def reanudar(self, id_trabajo):
+        """Vuelve a encolar sólo las claves sin XML (o sin PDF, si se pidieron)"""
+        t = self.trabajos[id_trabajo]
+        if t.activo: return t
+        t.meta.pop("fin", None); t.meta.pop("cancelado", None); t.guardar_meta()
+        self._activar(t)
+        return t
+
+    def cancelar(self, id_trabajo):
+        t = self.trabajos[id_trabajo]
+        with self.cond:
+            if not t.activo: return
+            t.meta["cancelado"] = True
+            for etapa in t.pendientes: t.pendientes[etapa].clear()
+            terminado = self._retirar_si_termino(t)
+        if terminado: self._finalizar(t)
+
+    def ultimo(self, usuario, tipo):
+        """Trabajo más reciente del usuario para ese tipo: la UI se vuelve a enganchar a él tras un rerun o una recarga"""
+        candidatos = [t for t in list(self.trabajos.values()) if t.meta["usuario"] == usuario and t.meta["tipo"] == tipo]
+        return max(candidatos, key=lambda t: t.meta["creado"], default=None)
+
+    def _activar(self, t):
+        pendientes = {etapa: t.faltantes(etapa) for etapa in t.etapas}
+        for etapa, claves in pendientes.items():
+            for cl in claves: t.estados[etapa].pop(cl, None) # Las fallidas vuelven a contar como pendientes
+        with self.cond:
+            for etapa, claves in pendientes.items(): t.pendientes[etapa].extend(claves)
+            t.activo = True
+            self.activos.append(t)
+            terminado = self._retirar_si_termino(t)
+            self.cond.notify_all()
+        if terminado: self._finalizar(t)
+
+    def _siguiente(self, etapa):
+        """Próxima clave de la etapa, rotando entre trabajos activos"""
+        with self.cond:
+            while True:
+                n = len(self.activos)
+                for k in range(n):
+                    i = (self.turno[etapa] + k) % n
+                    t = self.activos[i]
+                    if t.pendientes[etapa]:
+                        self.turno[etapa] = i + 1
+                        t.en_curso += 1
+                        return t, t.pendientes[etapa].popleft()
+                self.cond.wait()
+
+    def _retirar_si_termino(self, t):
+        """Con self.cond tomado. True si el trabajo ya no tiene nada pendiente ni en curso"""
+        if t.en_curso or any(t.pendientes.values()) or t not in self.activos: return False
+        self.activos.remove(t)
+        return True
+
+    def _trabajar(self, etapa):
+        while True:
+            t, clave = self._siguiente(etapa)
+            try: self._xml(t, clave) if etapa == "xml" else self._pdf(t, clave)
+            except Exception as e:
+                METRICAS.fallo("trabajos_errores_total", type(e).__name__, f"{t.id} {clave}: {e}")
+                try: t.anotar(clave, etapa, "ERROR_INTERNO")
+                except Exception as e2: # Disco lleno o sin permisos: el hilo sigue y la clave cuenta como hecha en memoria
+                    METRICAS.fallo("trabajos_errores_total", type(e2).__name__, f"{t.id} {clave}: avance.jsonl: {e2}")
+                    with t.lock: t.estados[etapa][clave] = "ERROR_INTERNO"
+            finally:
+                with self.cond:
+                    t.en_curso -= 1
+                    terminado = self._retirar_si_termino(t)
+                if terminado:
+                    try: self._finalizar(t)
+                    except Exception as e:
+                        METRICAS.fallo("trabajos_errores_total", type(e).__name__, f"{t.id}: {e}")
+                        t.activo = False
+
+    def _xml(self, t, clave):
+        en_cache = self.cache.obtener_varios([clave]).get(clave) if self.cache else None
+        if self.cache: METRICAS.contar("sri_cache_total", resultado="acierto" if en_cache else "fallo")
+        if en_cache: estado, contenido, intentos, registro = "CACHE", en_cache[0], 0, en_cache[1]
+        else:
+            estado, contenido, intentos = consultar_autorizacion(self.sesion, clave, self.limitador)
+            registro = None
+        if estado in ESTADOS_OK["xml"]:
+            registro = parsear_respuesta(clave, estado, contenido, self.clasificador.memoria, self.cache, registro)
+            t.guardar_descarga("xml", clave, contenido)
+        t.anotar(clave, "xml", estado, intentos, registro)
+
+    def _pdf(self, t, clave):
+        pdf, intentos = descargar_pdf(self.sesion_pdf, clave, self.throttle_pdf)
+        if pdf: t.guardar_descarga("pdf", clave, pdf)
+        t.anotar(clave, "pdf", "OK" if pdf else "FALLIDO", intentos)
+
+    def _finalizar(self, t):
+        """Arma los ZIP y el Excel en el directorio del trabajo, fuera del hilo de la UI"""
+        t.cerrar()
+        try:
+            t.empaquetar("xml", t.ruta_archivo("XML.zip"))
+            if t.meta["pdf"]: t.empaquetar("pdf", t.ruta_archivo("PDF.zip"))
+            lst = t.registros()
+            t.meta["documentos"] = len(lst)
+            if self.almacen and lst and t.meta.get("historico"):
+                guardados, omitidos = self.almacen.guardar(lst, "VENTAS" if t.meta["tipo"] == "RET" else "COMPRAS", t.meta["usuario"])
+                t.meta["historico_guardados"], t.meta["historico_omitidos"] = guardados, omitidos
+                if omitidos: METRICAS.fallo("trabajos_errores_total", "HISTORICO_OMITIDOS", f"{t.id}: {omitidos} de {len(lst)} sin RUC/fecha válidos o de otro tipo")
+            if lst: _escribir_atomico(t.ruta_archivo("reporte.xlsx"), generar_excel_multiexcel(data_sri_lista=lst, sri_mode=t.meta["tipo"]))
+            t.meta.pop("error", None)
+        except Exception as e:
+            METRICAS.fallo("trabajos_errores_total", type(e).__name__, f"{t.id}: {e}")
+            t.meta["error"] = str(e)
+        t.meta["fin"] = time.time()
+        t.guardar_meta()
+        t.activo = False
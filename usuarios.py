@@ -0,0 +1,103 @@
+import hashlib
+import hmac
+import io
+import json
+import logging
+import os
+import secrets
+import threading
+import time
+import pandas as pd
+import requests
+from metricas import METRICAS
+
+log = logging.getLogger(__name__)
+
+USUARIOS_TTL = float(os.environ.get("USUARIOS_TTL", "300"))
+USUARIOS_SNAPSHOT = os.environ.get("USUARIOS_SNAPSHOT", "usuarios_snapshot.json")
+USUARIOS_REINTENTO_DESCONOCIDO = 30 # Segundos mínimos entre recargas forzadas por un usuario que aún no está
+PBKDF2_ITERACIONES = 100_000
+
+def hashear_clave(clave, sal=None):
+    sal = sal or secrets.token_hex(16)
+    dk = hashlib.pbkdf2_hmac("sha256", str(clave).encode("utf-8"), bytes.fromhex(sal), PBKDF2_ITERACIONES)
+    return f"pbkdf2_sha256${PBKDF2_ITERACIONES}${sal}${dk.hex()}"
+
+def verificar_clave(clave, guardado):
+    try:
+        _, iteraciones, sal, esperado = guardado.split("$")
+        dk = hashlib.pbkdf2_hmac("sha256", str(clave).encode("utf-8"), bytes.fromhex(sal), int(iteraciones))
+        return hmac.compare_digest(dk.hex(), esperado)
+    except (ValueError, AttributeError): return False
+
+def leer_usuarios(fuente, timeout=10):
+    """Lee el CSV de usuarios (URL de Google Sheets o ruta local) y devuelve {usuario: clave} de los activos"""
+    if str(fuente).startswith(("http://", "https://")):
+        r = requests.get(fuente, timeout=timeout); r.raise_for_status()
+        df = pd.read_csv(io.StringIO(r.content.decode("utf-8")), dtype=str)
+    else: df = pd.read_csv(fuente, dtype=str)
+    df.columns = [c.lower().strip() for c in df.columns]
+    df = df.fillna("")
+    activos = df[df["estado"].str.lower().str.strip() == "activo"]
+    return dict(zip(activos["usuario"].str.strip(), activos["clave"].str.strip()))
+
+class DirectorioUsuarios:
+    """Directorio de login con TTL y recarga en segundo plano. Guarda sólo hashes con sal y conserva
+    en disco la última copia buena, para que se pueda entrar aunque la hoja no responda"""
+    def __init__(self, fuente, ruta_snapshot=USUARIOS_SNAPSHOT, ttl=USUARIOS_TTL):
+        self.fuente, self.ruta_snapshot, self.ttl = fuente, ruta_snapshot, ttl
+        self.lock = threading.Lock()
+        self.usuarios, self.cargado_en, self.ultimo_intento = {}, 0.0, 0.0
+        self.recargando = None
+        # Huella rápida (HMAC con una llave de este proceso) de la clave de la hoja que originó cada hash: detecta cambios
+        # de clave sin volver a derivar PBKDF2 por usuario. No va al snapshot, así que no sirve para adivinar claves
+        self._llave, self.huellas = secrets.token_bytes(32), {}
+        if ruta_snapshot and os.path.exists(ruta_snapshot):
+            try:
+                with open(ruta_snapshot, "r", encoding="utf-8") as f: snap = json.load(f)
+                self.usuarios, self.cargado_en = snap["usuarios"], snap["cargado_en"]
+            except Exception as e:
+                log.warning("Snapshot de usuarios ilegible: %s", e)
+                METRICAS.fallo("usuarios_errores_total", type(e).__name__, f"snapshot: {e}")
+        if not self.usuarios: self.recargar()
+
+    def recargar(self):
+        """Recarga síncrona; si falla se mantiene la última copia buena. Devuelve True si se actualizó"""
+        self.ultimo_intento = time.time()
+        try: claves = leer_usuarios(self.fuente)
+        except Exception as e:
+            log.warning("No se pudo leer el directorio de usuarios: %s", e)
+            METRICAS.fallo("usuarios_errores_total", type(e).__name__, f"directorio: {e}")
+            return False
+        with self.lock: anteriores, huellas_anteriores = dict(self.usuarios), dict(self.huellas)
+        usuarios, huellas = {}, {}
+        for u, c in claves.items():
+            if not u: continue
+            huella = hmac.new(self._llave, c.encode("utf-8"), hashlib.sha256).digest()
+            if u in anteriores and huella == huellas_anteriores.get(u): usuarios[u] = anteriores[u]
+            # Sin huella (recién arrancado desde el snapshot) se compara una vez con PBKDF2; si no, sólo se hashea
+            # a quien cambió de clave o es nuevo
+            elif u in anteriores and u not in huellas_anteriores and verificar_clave(c, anteriores[u]): usuarios[u] = anteriores[u]
+            else: usuarios[u] = hashear_clave(c)
+            huellas[u] = huella
+        with self.lock: self.usuarios, self.huellas, self.cargado_en = usuarios, huellas, time.time()
+        if self.ruta_snapshot:
+            tmp = f"{self.ruta_snapshot}.tmp"
+            with open(tmp, "w", encoding="utf-8") as f: json.dump({"usuarios": usuarios, "cargado_en": self.cargado_en}, f)
+            os.replace(tmp, self.ruta_snapshot)
+        return True
+
+    def _recargar_en_segundo_plano(self):
+        with self.lock:
+            if self.recargando and self.recargando.is_alive(): return
+            self.recargando = threading.Thread(target=self.recargar, daemon=True)
+            self.recargando.start()
+
+    def verificar(self, usuario, clave):
+        """Nunca espera a la hoja: un usuario que aún no está dispara una recarga en segundo plano (a lo más una cada
+        USUARIOS_REINTENTO_DESCONOCIDO segundos) y entra en el siguiente intento, sin esperar al TTL"""
+        ahora = time.time()
+        guardado = self.usuarios.get(usuario)
+        if ahora - self.cargado_en > self.ttl or (guardado is None and ahora - self.ultimo_intento > USUARIOS_REINTENTO_DESCONOCIDO):
+            self._recargar_en_segundo_plano()
+        return guardado is not None and verificar_clave(clave, guardado)